@@ -0,0 +1,44 @@
+"""Peak memory of pulling an ltla-sized feed with get_paginated_dataset (every page built up in memory) against
+stream_paginated_dataset (each page written straight to parquet). The API is faked with pages of records made
+from benchmark_tools.synthetic_feed, so only the ingest itself is measured. Note tracemalloc only sees python
+allocations, not arrow's, though arrow only ever holds one page here.
+Run from the repo root with:
+    python -m benchmarks.benchmark_ingest
+"""
+import shutil
+import tempfile
+import unittest.mock
+
+import pandas as pd
+
+import covid_data
+from benchmarks.benchmark_tools import measure, synthetic_feed
+
+
+def fake_api_pages(page_size=2500):
+    df_feed = synthetic_feed().assign(date=lambda df: df['date'].dt.strftime('%Y-%m-%d'),
+                                      maleCases=lambda df: [[{'age': '0_to_4', 'rate': 1.0, 'value': 2}]] * len(df))
+    records = df_feed.to_dict('records')
+    return [(page_number + 1, records[start:start + page_size])
+            for page_number, start in enumerate(range(0, len(records), page_size))]
+
+
+def benchmark_ingest():
+    pages = fake_api_pages()
+    root = tempfile.mkdtemp()
+    ingests = {'get_paginated_dataset': lambda: covid_data.get_paginated_dataset(["areaType=ltla"]),
+               'stream_paginated_dataset': lambda: covid_data.stream_paginated_dataset(["areaType=ltla"], 'ltla_raw',
+                                                                                       root)}
+    results = []
+    with unittest.mock.patch.object(covid_data.fetch_tools, 'iter_paginated', side_effect=lambda *a, **k: iter(pages)), \
+            unittest.mock.patch('builtins.print'):
+        for ingest_name, ingest in ingests.items():
+            _, seconds, peak_mb = measure(ingest)
+            results.append(dict(ingest=ingest_name, pages=len(pages), seconds=seconds, peak_memory_mb=peak_mb))
+    shutil.rmtree(root)
+    return pd.DataFrame(results).set_index('ingest')
+
+
+if __name__ == '__main__':
+    with pd.option_context('display.width', 200, 'display.max_columns', 10, 'display.precision', 3):
+        print(benchmark_ingest())
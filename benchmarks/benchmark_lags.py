@@ -0,0 +1,36 @@
+"""Compares finding the case -> admission lag for every area one pair at a time (find_optimum_lags) against
+all pairs at once (find_optimum_lags_batch).
+Run from the repo root with:
+    python -m benchmarks.benchmark_lags
+"""
+import contextlib
+import io
+
+import pandas as pd
+
+from benchmarks.benchmark_tools import measure, synthetic_feed
+from src import data_tools
+
+
+def benchmark_lags(n_areas=380, n_days=600, max_lag=30):
+    df_feed = synthetic_feed(n_areas=n_areas, n_days=n_days, metrics=['newCasesBySpecimenDate', 'newAdmissions'])
+    df_wide = df_feed.pivot(index='date', columns='code', values=['newCasesBySpecimenDate', 'newAdmissions'])
+    df_wide.columns = [f"{metric} {code}" for metric, code in df_wide.columns]
+    codes = df_feed['code'].unique()
+    pairs = [(f"newCasesBySpecimenDate {code}", f"newAdmissions {code}") for code in codes]
+
+    def loop():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return [data_tools.find_optimum_lags(df_wide[list(pair)]) for pair in pairs]
+
+    results = []
+    for name, function in [('find_optimum_lags (loop)', loop),
+                           ('find_optimum_lags_batch', lambda: data_tools.find_optimum_lags_batch(df_wide, pairs, max_lag=max_lag))]:
+        _, seconds, peak_mb = measure(function)
+        results.append(dict(function=name, pairs=len(pairs), seconds=seconds, peak_memory_mb=peak_mb))
+    return pd.DataFrame(results).set_index('function')
+
+
+if __name__ == '__main__':
+    with pd.option_context('display.width', 200, 'display.max_columns', 10, 'display.precision', 3):
+        print(benchmark_lags())
@@ -0,0 +1,40 @@
+"""The in-memory size of the committed feeds as read from csv, against after schema_tools.apply_schema, plus the
+english-only filter as a regex over every row against the categorical lookup.
+Run from the repo root with:
+    python -m benchmarks.benchmark_memory
+"""
+import os
+
+import pandas as pd
+
+from benchmarks.benchmark_tools import measure, synthetic_feed
+from src import schema_tools
+
+
+def benchmark_memory(data_dir='./data'):
+    frames = {file_name[:-len('.csv')]: pd.read_csv(f"{data_dir}/{file_name}", parse_dates=['date'])
+              for file_name in sorted(os.listdir(data_dir)) if file_name.endswith('_feed.csv')}
+    frames['synthetic ltla'] = synthetic_feed(metrics=('newCasesBySpecimenDate', 'newDeaths28DaysByDeathDate',
+                                                       'cumCasesBySpecimenDateRate'))
+    return schema_tools.memory_report(frames)
+
+
+def benchmark_english_filter():
+    df_feed = synthetic_feed()
+    df_feed['code'] = df_feed['code'].where(df_feed.index % 10 != 0, 'W06000001')
+    df_compact = schema_tools.apply_schema(df_feed)
+
+    results = []
+    for filter_name, filter_function, df in [
+            ('regex', lambda df: df[~df['code'].str.contains('[WSN]')], df_feed),
+            ('categorical lookup (object codes)', schema_tools.english_only, df_feed),
+            ('categorical lookup (categorical codes)', schema_tools.english_only, df_compact)]:
+        df_filtered, seconds, peak_mb = measure(filter_function, df)
+        results.append(dict(filter=filter_name, rows_kept=len(df_filtered), seconds=seconds, peak_memory_mb=peak_mb))
+    return pd.DataFrame(results).set_index('filter')
+
+
+if __name__ == '__main__':
+    with pd.option_context('display.width', 200, 'display.max_columns', 10, 'display.precision', 3):
+        print(benchmark_memory())
+        print(benchmark_english_filter())
@@ -0,0 +1,45 @@
+"""Times the daily SARIMAX refit with and without the model cache: a cold fit, a rerun on unchanged data, and a
+rerun after one new day has been added (filtered with the cached parameters, or warm-started from them).
+Run from the repo root with:
+    python -m benchmarks.benchmark_model_cache
+"""
+import shutil
+import tempfile
+
+import pandas as pd
+
+from benchmarks.benchmark_tools import measure, synthetic_feed
+from src import forecast_tools
+
+
+def benchmark_model_cache(n_areas=4, n_days=300, order=(14, 1, 7)):
+    df_feed = synthetic_feed(n_areas=n_areas, n_days=n_days + 1,
+                             metrics=['newCasesBySpecimenDate', 'newAdmissions'])
+    df_today = df_feed[df_feed['date'] < df_feed['date'].max()]
+    cache_dir = tempfile.mkdtemp()
+    kwargs = dict(endog_name='newAdmissions', exog_name='newCasesBySpecimenDate', order=order, max_workers=1)
+
+    def reseed_cache():
+        """Puts the day-before fits back in the cache, so there is a new day to warm start from"""
+        shutil.rmtree(cache_dir)
+        forecast_tools.fit_sarimax_by_area(df_today, cache_dir=cache_dir, **kwargs)
+
+    runs = [('no cache', df_today, dict(), None),
+            ('cache: cold', df_today, dict(cache_dir=cache_dir), None),
+            ('cache: unchanged data', df_today, dict(cache_dir=cache_dir), None),
+            ('cache: one new day, append', df_feed, dict(cache_dir=cache_dir, refit='append'), None),
+            ('cache: one new day, warm start', df_feed, dict(cache_dir=cache_dir, refit='warm'), reseed_cache)]
+    results = []
+    for run_name, df_run, run_kwargs, setup in runs:
+        if setup is not None:
+            setup()
+        (_, df_report), seconds, peak_mb = measure(forecast_tools.fit_sarimax_by_area, df_run, **kwargs, **run_kwargs)
+        results.append(dict(run=run_name, seconds=seconds, seconds_per_area=seconds / n_areas,
+                            cache=','.join(df_report['cache'].fillna('-').unique())))
+    shutil.rmtree(cache_dir)
+    return pd.DataFrame(results).set_index('run')
+
+
+if __name__ == '__main__':
+    with pd.option_context('display.width', 200, 'display.max_columns', 10, 'display.precision', 3):
+        print(benchmark_model_cache())
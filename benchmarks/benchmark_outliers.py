@@ -0,0 +1,37 @@
+"""Compares the original window-by-window outlier removal against the vectorised versions.
+Run from the repo root with:
+    python -m benchmarks.benchmark_outliers
+"""
+import pandas as pd
+
+import covid_data
+from benchmarks.benchmark_tools import measure, synthetic_feed
+
+
+def benchmark_outliers(n_areas=380, n_days=600, n_loop_areas=5):
+    metrics = ['newCasesBySpecimenDate', 'newDeaths28DaysByDeathDate']
+    df_feed = synthetic_feed(n_areas=n_areas, n_days=n_days, metrics=metrics)
+    series = df_feed.loc[df_feed['code'] == df_feed['code'].iloc[0], metrics[0]].reset_index(drop=True)
+
+    results = []
+    for name, function in [('remove_outlier_window_loop', covid_data.remove_outlier_window_loop),
+                           ('remove_outliers_rolling', covid_data.remove_outliers_rolling)]:
+        _, seconds, peak_mb = measure(function, series)
+        results.append(dict(case=f"one series of {n_days} days", function=name, seconds=seconds, peak_memory_mb=peak_mb))
+
+    # the loop is far too slow to run over every area, so time a few and scale up
+    _, seconds, peak_mb = measure(lambda: [covid_data.remove_outlier_window_loop(df_area[metric])
+                                           for _, df_area in df_feed[df_feed['code'].isin(df_feed['code'].unique()[:n_loop_areas])].groupby('code')
+                                           for metric in metrics])
+    results.append(dict(case=f"{n_areas} areas x {len(metrics)} metrics", function='remove_outlier_window_loop (extrapolated)',
+                        seconds=seconds * n_areas / n_loop_areas, peak_memory_mb=peak_mb))
+    _, seconds, peak_mb = measure(covid_data.remove_outliers_grouped, df_feed, metrics)
+    results.append(dict(case=f"{n_areas} areas x {len(metrics)} metrics", function='remove_outliers_grouped',
+                        seconds=seconds, peak_memory_mb=peak_mb))
+
+    return pd.DataFrame(results).set_index(['case', 'function'])
+
+
+if __name__ == '__main__':
+    with pd.option_context('display.width', 200, 'display.max_columns', 10, 'display.precision', 3):
+        print(benchmark_outliers())
@@ -0,0 +1,38 @@
+"""Compares loading the committed feeds from csv against the partitioned parquet datasets from storage_tools.
+Run from the repo root with:
+    python -m benchmarks.benchmark_storage
+"""
+import os
+import tempfile
+
+import pandas as pd
+
+from benchmarks.benchmark_tools import measure
+from src import storage_tools
+
+
+def benchmark_storage(data_dir='./data'):
+    parquet_root = tempfile.mkdtemp()
+    storage_tools.convert_csv_feeds(data_dir, parquet_root)
+
+    results = []
+    for file_name in sorted(os.listdir(data_dir)):
+        if not file_name.endswith('_feed.csv'):
+            continue
+        dataset_name = file_name[:-len('_feed.csv')]
+        loaders = {'csv': lambda: pd.read_csv(f"{data_dir}/{file_name}", parse_dates=['date']),
+                   'parquet': lambda: storage_tools.read_feed(dataset_name, root=parquet_root),
+                   'parquet (3 columns, 2021 only)': lambda: storage_tools.read_feed(
+                       dataset_name, root=parquet_root, columns=['date', 'code', 'hospitalCases'],
+                       date_from='2021-01-01', date_to='2021-12-31')}
+        for loader_name, load_function in loaders.items():
+            df, seconds, peak_mb = measure(load_function)
+            results.append(dict(dataset=dataset_name, loader=loader_name, seconds=seconds,
+                                peak_memory_mb=peak_mb, frame_mb=df.memory_usage(deep=True).sum() / 1e6))
+
+    return pd.DataFrame(results).set_index(['dataset', 'loader'])
+
+
+if __name__ == '__main__':
+    with pd.option_context('display.width', 200, 'display.max_columns', 10, 'display.precision', 3):
+        print(benchmark_storage())
@@ -0,0 +1,219 @@
+"""Times and memory-profiles the main steps of the pipeline - loading the feeds, cleaning, validation, outlier
+removal, interpolation, lag finding, a SARIMAX fit and the dashboard's filter/stack path - against the committed data/
+files and a synthetic ltla-sized feed, and saves the results as JSON so runs on different commits can be compared.
+Everything runs offline.
+Run from the repo root with:
+    python -m benchmarks.benchmark_suite                  # writes benchmarks/results/<time>-<commit>.json
+    python -m benchmarks.benchmark_suite --cases outlier  # just the cases with 'outlier' in their name
+    python -m benchmarks.benchmark_suite --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+
+import covid_data
+import dashboard_data
+from benchmarks.benchmark_tools import measure, synthetic_feed
+from src import data_tools, forecast_tools, validation_tools
+
+RESULTS_DIR = './benchmarks/results'
+
+
+def uncached_load(path: str) -> pd.DataFrame:
+    """covid_data.load_data_file, without its in-process cache"""
+    covid_data._data_cache.clear()
+    return covid_data.load_data_file(path)
+
+
+def early_series(n_days=200, start=60, seed=0) -> pd.Series:
+    """A series which only starts reporting 'start' days in, as interpolate_early_data is given"""
+    values = synthetic_feed(n_areas=1, n_days=n_days, seed=seed)['newCasesBySpecimenDate'].to_numpy(copy=True)
+    values[:start] = np.nan
+    return pd.Series(values, name='newCasesBySpecimenDate')
+
+
+def suite_cases(data_dir='./data', n_areas=380, n_days=600, sarimax_order=(7, 1, 1)) -> Dict[str, Callable[[], Callable]]:
+    """{case name: setup}, where setup builds the inputs and returns the function to be measured, so the setup
+    itself isn't timed. The SARIMAX order is smaller than the (30, 1, 10) default to keep the suite quick."""
+    metrics = ['newCasesBySpecimenDate', 'newAdmissions']
+
+    def ltla_feed():
+        return synthetic_feed(n_areas=n_areas, n_days=n_days, metrics=metrics)
+
+    def one_series():
+        df_feed = synthetic_feed(n_areas=1, n_days=n_days, metrics=metrics)
+        return df_feed['newCasesBySpecimenDate'].reset_index(drop=True)
+
+    def late_start_feed():
+        # each area starts reporting up to 60 days into the feed
+        df_feed = ltla_feed()
+        start_days = pd.to_timedelta(df_feed['code'].str[-2:].astype(int) % 60, unit='D')
+        return df_feed.assign(**{metric: df_feed[metric].where(df_feed['date'] >= df_feed['date'].min() + start_days)
+                                 for metric in metrics})
+
+    def raw_ltla_feed():
+        return ltla_feed().assign(date=lambda df: df['date'].dt.strftime('%Y-%m-%d'))
+
+    def validation_feed():
+        # cleaned, with as many count fields as the real ltla feed has, half of them cumulative
+        fields = [field for field, rules in validation_tools.FIELD_RULES.items() if 'non_negative' in rules][:12]
+        df_feed = synthetic_feed(n_areas=n_areas, n_days=n_days, metrics=fields)
+        cumulative = [field for field in fields if 'non_decreasing' in validation_tools.FIELD_RULES[field]]
+        df_feed[cumulative] = df_feed.groupby('code')[cumulative].cumsum()
+        return covid_data.clean_data(df_feed.assign(date=df_feed['date'].dt.strftime('%Y-%m-%d')))
+
+    def wide_ltla_feed():
+        df_feed = ltla_feed()
+        df_wide = df_feed.pivot(index='date', columns='code', values=metrics)
+        df_wide.columns = [f"{metric} {code}" for metric, code in df_wide.columns]
+        pairs = [(f"newCasesBySpecimenDate {code}", f"newAdmissions {code}") for code in df_feed['code'].unique()]
+        return df_wide, pairs
+
+    def quietly(function):
+        def quiet_function(*args, **kwargs):
+            with contextlib.redirect_stdout(io.StringIO()):
+                return function(*args, **kwargs)
+        return quiet_function
+
+    def dashboard_select(df_feeds):
+        data = dashboard_data.DashboardData(df_feeds)
+        areatype = data.areatype_options[-1]
+        names = data.areaname_options[areatype][:20]
+        return lambda: data.select(areatype, names, data.metric_options(areatype, names)[:2])
+
+    cases = dict()
+    for file_name in sorted(os.listdir(data_dir)):
+        if file_name.endswith('.csv'):
+            cases[f"load_data_file[{file_name}]"] = \
+                lambda path=f"{data_dir}/{file_name}": lambda: uncached_load(path)
+    cases.update({
+        'get_nhse_feed_local_data[data]': lambda: lambda: (covid_data._data_cache.clear(),
+                                                           dashboard_data.get_nhse_feed_local_data(data_dir))[1],
+        'clean_data[synthetic ltla]': lambda: lambda df=raw_ltla_feed(): covid_data.clean_data(df),
+        'validate_feed[synthetic ltla]':
+            lambda: lambda df=validation_feed(): validation_tools.validate_feed(df, 'ltla_nhse'),
+        'remove_outliers[one series]': lambda: lambda series=one_series(): covid_data.remove_outliers(series),
+        'remove_outlier_window[one series]':
+            lambda: lambda series=one_series(): covid_data.remove_outlier_window(series),
+        'remove_outliers_grouped[synthetic ltla]':
+            lambda: lambda df=ltla_feed(): covid_data.remove_outliers_grouped(df, metrics),
+        'interpolate_early_data[one series]':
+            lambda: lambda series=early_series(): covid_data.interpolate_early_data(series, seed=0),
+        'interpolate_early_feed[synthetic ltla]':
+            lambda: lambda df=late_start_feed(): covid_data.interpolate_early_feed(df, metrics, seed=0),
+        'find_optimum_lags[one pair]':
+            lambda: lambda df=wide_ltla_feed()[0].iloc[:, [0, n_areas]]: quietly(data_tools.find_optimum_lags)(df),
+        'find_optimum_lags_batch[synthetic ltla]':
+            lambda: (lambda df_wide, pairs: lambda: data_tools.find_optimum_lags_batch(df_wide, pairs))(*wide_ltla_feed()),
+        'fit_sarimax[one series]':
+            lambda: lambda series=one_series(): forecast_tools.fit_sarimax(series.to_numpy(), order=sarimax_order),
+        'DashboardData[data]': lambda: lambda df=dashboard_data.get_nhse_feed_local_data(data_dir):
+            dashboard_data.DashboardData(df),
+        'DashboardData.select[data]': lambda: dashboard_select(dashboard_data.get_nhse_feed_local_data(data_dir)),
+        'DashboardData[synthetic ltla]': lambda: lambda df=ltla_feed(): dashboard_data.DashboardData(df),
+        'DashboardData.select[synthetic ltla]': lambda: dashboard_select(ltla_feed()),
+    })
+    return cases
+
+
+def run_case(setup: Callable[[], Callable], repeat=3) -> dict:
+    """Runs the case once under tracemalloc for its peak memory, then 'repeat' times untraced for its timings
+    (tracemalloc slows python code down). A case which fails is recorded with its error rather than stopping the
+    suite."""
+    try:
+        function = setup()
+        _, _, peak_mb = measure(function)
+        timings = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start_time)
+    except Exception as error:
+        return dict(error=f"{type(error).__name__}: {error}")
+    return dict(seconds=min(timings), median_seconds=statistics.median(timings), peak_memory_mb=peak_mb,
+                repeat=repeat)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_suite(cases: List[str] = None, repeat=3, **case_kwargs) -> dict:
+    """Runs the suite_cases whose names contain any of 'cases' (all of them by default)"""
+    results = dict()
+    for case_name, setup in suite_cases(**case_kwargs).items():
+        if cases is None or any(case in case_name for case in cases):
+            results[case_name] = run_case(setup, repeat=repeat)
+            print(case_name, results[case_name], file=sys.stderr)
+    return dict(commit=git_commit(), run_at=datetime.datetime.now().isoformat(timespec='seconds'),
+                python=platform.python_version(), pandas=pd.__version__, numpy=np.__version__,
+                machine=platform.machine(), cpu_count=os.cpu_count(), case_kwargs=case_kwargs, results=results)
+
+
+def save_results(run: dict, results_dir=RESULTS_DIR) -> str:
+    os.makedirs(results_dir, exist_ok=True)
+    path = f"{results_dir}/{run['run_at'].replace(':', '')}-{run['commit']}.json"
+    with open(path, 'w') as results_file:
+        json.dump(run, results_file, indent=2)
+    return path
+
+
+def compare_results(base: dict, new: dict, threshold=1.25) -> pd.DataFrame:
+    """Each case's time and peak memory in both runs, flagging those 'threshold' times slower (or bigger)"""
+    rows = []
+    for case_name in dict.fromkeys(list(base['results']) + list(new['results'])):
+        base_case, new_case = base['results'].get(case_name, dict()), new['results'].get(case_name, dict())
+        row = dict(case=case_name,
+                   base_seconds=base_case.get('seconds'), new_seconds=new_case.get('seconds'),
+                   base_memory_mb=base_case.get('peak_memory_mb'), new_memory_mb=new_case.get('peak_memory_mb'),
+                   error=new_case.get('error'))
+        if row['base_seconds'] and row['new_seconds'] is not None:
+            row['time_ratio'] = row['new_seconds'] / row['base_seconds']
+        if row['base_memory_mb'] and row['new_memory_mb'] is not None:
+            row['memory_ratio'] = row['new_memory_mb'] / row['base_memory_mb']
+        row['regression'] = bool(row.get('time_ratio', 0) > threshold or row.get('memory_ratio', 0) > threshold
+                                 or (row['error'] is not None and base_case.get('error') is None))
+        rows.append(row)
+    return pd.DataFrame(rows).set_index('case')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the benchmark suite, or compare two of its result files")
+    parser.add_argument('--cases', nargs='*', help="only run the cases whose names contain one of these")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per case (the fastest is reported)")
+    parser.add_argument('--areas', type=int, default=380, help="areas in the synthetic feed")
+    parser.add_argument('--days', type=int, default=600, help="days in the synthetic feed")
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help="compare two result files instead")
+    parser.add_argument('--threshold', type=float, default=1.25, help="slow-down (or growth) counted as a regression")
+    args = parser.parse_args()
+
+    with pd.option_context('display.width', 200, 'display.max_columns', 10, 'display.precision', 3):
+        if args.compare:
+            runs = []
+            for path in args.compare:
+                with open(path) as results_file:
+                    runs.append(json.load(results_file))
+            df_comparison = compare_results(*runs, threshold=args.threshold)
+            print(df_comparison)
+            sys.exit(1 if df_comparison['regression'].any() else 0)
+
+        run = run_suite(args.cases, repeat=args.repeat, n_areas=args.areas, n_days=args.days)
+        print(pd.DataFrame(run['results']).T)
+        print(f"saved to {save_results(run, args.results_dir)}")
@@ -0,0 +1,37 @@
+"""Shared helpers for the benchmarks"""
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+def measure(function, *args, **kwargs):
+    """Runs function(*args, **kwargs), returning (result, seconds taken, peak python memory in MB)"""
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start_time
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak_bytes / 1e6
+
+
+def synthetic_feed(n_areas=380, n_days=600, metrics=('newCasesBySpecimenDate', 'newDeaths28DaysByDeathDate'),
+                   areatype='ltla', seed=0) -> pd.DataFrame:
+    """A long-format feed shaped like the ltla feed (380 areas by default), sorted by code then date, with
+    smooth wave-shaped metrics plus noise and the odd reporting spike"""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2020-02-01', periods=n_days)
+    codes = [f"E{6000001 + area:08d}" for area in range(n_areas)]
+    df_feed = pd.DataFrame(dict(areatype=areatype,
+                                date=np.tile(dates, n_areas),
+                                name=np.repeat([f"area {code}" for code in codes], n_days),
+                                code=np.repeat(codes, n_days)))
+    waves = 50 * (1 + np.sin(np.arange(n_days) / 40))
+    for metric in metrics:
+        values = np.tile(waves, n_areas) * rng.uniform(0.5, 2, n_areas).repeat(n_days) + rng.normal(0, 3, len(df_feed))
+        spikes = rng.random(len(df_feed)) < 0.002
+        values[spikes] *= 10
+        df_feed[metric] = np.round(np.clip(values, 0, None))
+    return df_feed
@@ -0,0 +1,53 @@
+"""Compares reading a trust admissions workbook sheet by sheet (the old nhse_weekly_covid19_admissions_excel, minus
+its seven downloads) against covid_data.parse_trust_workbook, in one pass and across a process pool. The workbook
+is a synthetic one shaped like the weekly NHSE file.
+Run from the repo root with:
+    python -m benchmarks.benchmark_trust_admissions
+"""
+import io
+
+import numpy as np
+import pandas as pd
+
+import covid_data
+from benchmarks.benchmark_tools import measure
+
+
+def synthetic_workbook(n_trusts=220, n_days=240, header=14) -> bytes:
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2020-08-01', periods=n_days).to_pydatetime().tolist()
+    workbook = io.BytesIO()
+    with pd.ExcelWriter(workbook) as writer:
+        for sheet in covid_data.WEEKLY_TRUST_ADMISSIONS_SHEETS:
+            df_sheet = pd.DataFrame(rng.poisson(5, (n_trusts, n_days)), columns=dates)
+            df_sheet.insert(0, 'Name', [f"Trust {trust}" for trust in range(n_trusts)])
+            df_sheet.insert(0, 'Code', [f"R{trust:03d}" for trust in range(n_trusts)])
+            df_sheet.insert(0, 'NHS England Region', rng.choice(['London', 'Midlands', 'North West'], n_trusts))
+            df_sheet.to_excel(writer, sheet_name=sheet, startrow=header, index=False)
+    return workbook.getvalue()
+
+
+def sheet_by_sheet(workbook: bytes) -> pd.DataFrame:
+    return pd.DataFrame([pd.read_excel(io.BytesIO(workbook), sheet_name=sheet, header=14)
+                         .dropna(how="all", axis=1).dropna(how="all", axis=0)
+                         .set_index(['NHS England Region', 'Code', 'Name']).rename_axis('date', axis=1).stack()
+                         .rename(sheet) for sheet in covid_data.WEEKLY_TRUST_ADMISSIONS_SHEETS]).T
+
+
+def benchmark_trust_admissions():
+    workbook = synthetic_workbook()
+    readers = {'sheet by sheet': lambda: sheet_by_sheet(workbook),
+               'one pass': lambda: covid_data.parse_trust_workbook(workbook, covid_data.WEEKLY_TRUST_ADMISSIONS_SHEETS),
+               'one pass, 4 processes': lambda: covid_data.parse_trust_workbook(
+                   workbook, covid_data.WEEKLY_TRUST_ADMISSIONS_SHEETS, max_workers=4)}
+    results = []
+    for reader_name, reader in readers.items():
+        df, seconds, peak_mb = measure(reader)
+        results.append(dict(reader=reader_name, seconds=seconds, peak_memory_mb=peak_mb,
+                            frame_mb=df.memory_usage(deep=True).sum() / 1e6))
+    return pd.DataFrame(results).set_index('reader')
+
+
+if __name__ == '__main__':
+    with pd.option_context('display.width', 200, 'display.max_columns', 10, 'display.precision', 3):
+        print(benchmark_trust_admissions())
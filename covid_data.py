@@ -1,27 +1,43 @@
-from typing import Iterable, Dict, Union, List
+from typing import Iterable, Iterator, Dict, Union, List
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 from json import dumps
-from requests import get
-from http import HTTPStatus
 import pandas as pd
 import zipfile
 import requests
 import io
+import datetime
+import hashlib
+import itertools
 import os
 import re
+import shutil
+import tempfile
 import scipy
 import scipy.stats
-import numpy.random as random
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src import fetch_tools
+from src import storage_tools
+from src import schema_tools
+from src import cache_tools
+from src import derived_tools
+from src import validation_tools
 
 
 def get_paginated_dataset(filters: Iterable[str], structure: Dict[str, Union[dict, str]] = None,
-                          start_page = 1, end_page=None) -> pd.DataFrame:
+                          start_page = 1, end_page=None, max_workers=4, max_retries=5,
+                          cache: cache_tools.ResponseCache = None) -> pd.DataFrame:
     """This is lifted from the NHSE website: https://coronavirus.data.gov.uk/developers-guide
     The "filters" param is used to determine what geographical level you will pull,
     whilst the "structure" param describes the fields you will pull. The function will loop
-    over all the pages requested (or all pages if none specified). 
+    over all the pages requested (or all pages if none specified), fetching up to "max_workers" pages
+    at a time over a shared connection pool (see src/fetch_tools.py). Pages which fail are retried with
+    a capped exponential backoff, up to "max_retries" times, before giving up with a RuntimeError.
     ISSUES: The API seems to time out for large datasets (i.e. UTLA), so you might need to pull
-    in multiple small batches of 5 or 10 pages at a time.
+    in multiple small batches of 5 or 10 pages at a time, or lower max_workers.
     -------
     Params
     -------
@@ -29,6 +45,12 @@ def get_paginated_dataset(filters: Iterable[str], structure: Dict[str, Union[dic
         The geographic area you want. Example: ["areaType=nation;areaName=england"]
         You can choose to not include areaName: ['areaType=nation"].
         Options for areaType: overview, nation, region, nhsRegion, utla, ltla
+    max_workers : int
+        The most pages to have in flight at once - the API throttles heavy users, so keep this modest.
+    max_retries : int
+        How many times to retry a failing page before giving up.
+    cache : cache_tools.ResponseCache
+        Where pages are cached (see src/cache_tools.py) - cache_tools.default_cache() if not given.
     structure : dict(str / dict(str))
         The columns you want. You specify it as either just a dictionary full of columm 
         names (the key of the dict defines what the column comes out as for you, so below, 
@@ -74,103 +96,143 @@ def get_paginated_dataset(filters: Iterable[str], structure: Dict[str, Union[dic
         # cumDeaths28DaysByDeathDate - Cumulative deaths within 28 days of positive test by death date
         # cumDeaths28DaysByDeathDateRate - Rate of cumulative deaths within 28 days of positive test by death date per 100k resident population
     """
+    page_frames = list(iter_paginated_dataset(filters, structure, start_page=start_page, end_page=end_page,
+                                              max_workers=max_workers, max_retries=max_retries, cache=cache))
+    if len(page_frames) == 0:
+        return pd.DataFrame()
+    return schema_tools.concat_feeds(page_frames).reset_index(drop=True)
+
+
+def iter_paginated_dataset(filters: Iterable[str], structure: Dict[str, Union[dict, str]] = None,
+                           start_page=1, end_page=None, max_workers=4, max_retries=5,
+                           cache: cache_tools.ResponseCache = None) -> Iterator[pd.DataFrame]:
+    """get_paginated_dataset a page at a time - yields each page (in page order) as a dataframe with the
+    schema_tools dtypes as soon as it arrives, so only a handful of pages are ever held in memory"""
     if structure is None:
-      structure = {"date": "date",
-                   "areatype": "areaType",
-                  "name": "areaName",
-                  "code": "areaCode",
-                  'newCasesByPublishDate' : 'newCasesByPublishDate',
-                  'cumCasesByPublishDate' : 'cumCasesByPublishDate',
-                  'cumCasesBySpecimenDateRate' : 'cumCasesBySpecimenDateRate',
-                  'newCasesBySpecimenDate' : 'newCasesBySpecimenDate',
-                  'cumCasesBySpecimenDateRate' : 'cumCasesBySpecimenDateRate',
-                  'cumCasesBySpecimenDate' : 'cumCasesBySpecimenDate',
-                  'maleCases' : 'maleCases',
-                  'femaleCases' : 'femaleCases',
-                  'newPillarOneTestsByPublishDate' : 'newPillarOneTestsByPublishDate',
-                  'cumPillarOneTestsByPublishDate' : 'cumPillarOneTestsByPublishDate',
-                  'newPillarTwoTestsByPublishDate' : 'newPillarTwoTestsByPublishDate',
-                  'cumPillarTwoTestsByPublishDate' : 'cumPillarTwoTestsByPublishDate',
-                  'newPillarThreeTestsByPublishDate' : 'newPillarThreeTestsByPublishDate',
-                  'cumPillarThreeTestsByPublishDate' : 'cumPillarThreeTestsByPublishDate',
-                  'newPillarFourTestsByPublishDate' : 'newPillarFourTestsByPublishDate',
-                  'cumPillarFourTestsByPublishDate' : 'cumPillarFourTestsByPublishDate',
-                  'newAdmissions' : 'newAdmissions',
-                  'cumAdmissions' : 'cumAdmissions',
-                  'cumAdmissionsByAge' : 'cumAdmissionsByAge',
-                  'cumTestsByPublishDate' : 'cumTestsByPublishDate',
-                  'newTestsByPublishDate' : 'newTestsByPublishDate',
-                  'covidOccupiedMVBeds' : 'covidOccupiedMVBeds',
-                  'hospitalCases' : 'hospitalCases',
-                  'plannedCapacityByPublishDate' : 'plannedCapacityByPublishDate',
-                  'newDeaths28DaysByPublishDate' : 'newDeaths28DaysByPublishDate',
-                  'cumDeaths28DaysByPublishDate' : 'cumDeaths28DaysByPublishDate',
-                  'cumDeaths28DaysByPublishDateRate' : 'cumDeaths28DaysByPublishDateRate',
-                  'newDeaths28DaysByDeathDate' : 'newDeaths28DaysByDeathDate',
-                  'cumDeaths28DaysByDeathDate' : 'cumDeaths28DaysByDeathDate',
-                  'cumDeaths28DaysByDeathDateRate' : 'cumDeaths28DaysByDeathDateRate',
-                  }
-    
+      structure = dict(schema_tools.API_STRUCTURE)
+
     endpoint = "https://api.coronavirus.data.gov.uk/v1/data"
     api_params = dict(filters=str.join(";", filters),
-                      structure=dumps(structure, separators=(",", ":")), 
-                      format="json", page=1)
-    data = list()
-    page_number = start_page
-    current_data = dict(pagination={'next':True}) # dummy initial "next" pagination
-
-    while current_data["pagination"]["next"] is not None:
-        api_params["page"] = page_number
-        if page_number == end_page: break
-
-        try:
-          response = get(endpoint, params=api_params, timeout=10)
-        except Exception as error:
-          print(f"    Trying page {page_number} again...")
-          continue
-
-        if response.status_code >= HTTPStatus.BAD_REQUEST:
-            raise RuntimeError(f'Request failed: {response.text}')
-        elif response.status_code == HTTPStatus.NO_CONTENT:
-            break
-
-        current_data = response.json()
-        page_data: List[StructureType] = current_data['data']
-        
-        data.extend(page_data)
-
-        print(f'{str.join(";", filters)} page {page_number}: {response.url}')
-        page_number += 1
-
-    return pd.DataFrame(data)
+                      structure=dumps(structure, separators=(",", ":")),
+                      format="json")
+
+    pages = fetch_tools.iter_paginated(endpoint, api_params, start_page=start_page, end_page=end_page,
+                                       max_workers=max_workers, max_retries=max_retries,
+                                       cache=cache or cache_tools.default_cache())
+    for page_number, page_data in pages:
+        print(f'{str.join(";", filters)} page {page_number}: {len(page_data)} records')
+        if len(page_data) > 0:
+            yield schema_tools.apply_schema(pd.DataFrame(page_data))
+
+
+def stream_paginated_dataset(filters: Iterable[str], dataset_name: str, root=storage_tools.DEFAULT_ROOT,
+                             structure: Dict[str, Union[dict, str]] = None, max_workers=4, max_retries=5,
+                             cache: cache_tools.ResponseCache = None) -> str:
+    """Pulls a dataset like get_paginated_dataset, but writes each page straight into a parquet dataset (see
+    storage_tools.write_feed_batches) rather than building it up in memory, so memory use is bounded by the
+    page size rather than the size of the dataset. Returns the path written to - read it back with
+    storage_tools.read_feed."""
+    if structure is None:
+      structure = dict(schema_tools.API_STRUCTURE)
+    pages = iter_paginated_dataset(filters, structure, max_workers=max_workers, max_retries=max_retries, cache=cache)
+    return storage_tools.write_feed_batches(pages, dataset_name, columns=list(structure), root=root)
 
           
-def google_mobility(country_filter="GB"):
+GOOGLE_MOBILITY_URL = "https://www.gstatic.com/covid19/mobility/Region_Mobility_Report_CSVs.zip"
+# google_mobility comes back sorted by these
+GOOGLE_MOBILITY_SORT_COLUMNS = ["country_region_code", "sub_region_1", "date"]
+GOOGLE_MOBILITY_TEXT_COLUMNS = ["country_region_code", "country_region", "sub_region_1", "sub_region_2", "metro_area",
+                                "iso_3166_2_code", "census_fips_code", "place_id"]
+
+
+def google_mobility_members(zip_file: zipfile.ZipFile, country_filter="GB") -> Dict[str, List[str]]:
+  """The csvs in the google mobility archive whose names contain country_filter, grouped by country code and
+  in year order, i.e. {'GB': ['2020_GB_Region_Mobility_Report.csv', '2021_GB_Region_Mobility_Report.csv']}"""
+  members = dict()
+  for name in sorted(zip_file.namelist()):
+    if country_filter not in name or not name.endswith('.csv'):
+      continue
+    parts = os.path.basename(name).split('_')
+    country = parts[1] if len(parts) > 2 and parts[0].isdigit() else parts[0]
+    members.setdefault(country, []).append(name)
+  return dict(sorted(members.items()))
+
+
+def write_google_mobility_extract(archive_path: str, extract_path: str, country_filter="GB", chunksize=200_000):
+  """Reads the matching csvs out of the google mobility archive in chunks, straight from the zip, and writes
+  them to a parquet file a country at a time. Each country is sorted on its own before it's written, so the
+  file as a whole is in GOOGLE_MOBILITY_SORT_COLUMNS order without ever sorting (or holding) all of it."""
+  temporary_path = f"{extract_path}.{os.getpid()}.tmp"
+  writer = None
+  with zipfile.ZipFile(archive_path) as zip_file:
+    for country, members in google_mobility_members(zip_file, country_filter).items():
+      chunks = []
+      for member in members:
+        with zip_file.open(member) as csv_file:
+          # only empty fields are missing - 'NA' is Namibia
+          chunks.extend(pd.read_csv(csv_file, chunksize=chunksize, parse_dates=['date'],
+                                    dtype={column: str for column in GOOGLE_MOBILITY_TEXT_COLUMNS},
+                                    keep_default_na=False, na_values=['']))
+      df_country = pd.concat(chunks, axis=0).sort_values(GOOGLE_MOBILITY_SORT_COLUMNS, kind='stable')
+      table = pa.Table.from_pandas(df_country, preserve_index=False)
+      if writer is None:
+        writer = pq.ParquetWriter(temporary_path, table.schema)
+      writer.write_table(table.cast(writer.schema))
+  if writer is None:
+    raise ValueError(f"No google mobility reports match {country_filter!r}")
+  writer.close()
+  os.replace(temporary_path, extract_path)
+
+
+def google_mobility(country_filter="GB", sub_regions: List[str] = None, date_from=None, date_to=None,
+                    columns: List[str] = None, cache_dir='./data/cache',
+                    cache: cache_tools.ResponseCache = None) -> pd.DataFrame:
   """Pulls data from the google mobility report website https://www.google.com/covid19/mobility/.
   Specify the country to filter by (two character code), i.e. GB for United Kingdom. If you leave 
   it blank, i.e. "", then you get everything. 
+  The archive is downloaded into cache_dir (and only downloaded again when it changes, see
+  cache_tools.ResponseCache.download), and the chosen countries are extracted from it once into a parquet file
+  (see write_google_mobility_extract). The sub_region_1 names, dates and columns asked for are then pushed
+  down into the parquet reader. The rows come back sorted by GOOGLE_MOBILITY_SORT_COLUMNS.
   """
-  response = requests.get("https://www.gstatic.com/covid19/mobility/Region_Mobility_Report_CSVs.zip")
-  zip_file = zipfile.ZipFile(io.BytesIO(response.content))
-  GB_google_mobility_report_paths = list(filter(lambda x: country_filter in x, zip_file.namelist()))
-  df_gb_google_mobility_report = pd.concat([pd.read_csv(zip_file.open(file)) for file in GB_google_mobility_report_paths],axis=0)
-  return df_gb_google_mobility_report
-
-
-def apple_mobility() -> pd.DataFrame:
+  archive_path = f"{cache_dir}/Region_Mobility_Report_CSVs.zip"
+  (cache or cache_tools.default_cache()).download(GOOGLE_MOBILITY_URL, archive_path, source='google_mobility')
+  extract_path = f"{cache_dir}/google_mobility_{country_filter or 'all'}.parquet"
+  if not os.path.exists(extract_path) or os.stat(extract_path).st_mtime_ns < os.stat(archive_path).st_mtime_ns:
+    write_google_mobility_extract(archive_path, extract_path, country_filter)
+
+  filters = []
+  if sub_regions is not None:
+    filters.append(('sub_region_1', 'in', list(sub_regions)))
+  if date_from is not None:
+    filters.append(('date', '>=', pd.Timestamp(date_from)))
+  if date_to is not None:
+    filters.append(('date', '<=', pd.Timestamp(date_to)))
+  table = pq.read_table(extract_path, columns=columns, filters=filters or None)
+  return table.to_pandas()
+
+
+def apple_mobility(cache: cache_tools.ResponseCache = None) -> pd.DataFrame:
   """Pulls data from the apple mobility report website https://covid19.apple.com/mobility
   It keeps trying dates going back from the most recent to 100 days before today 
   searching for the most recent file. Once it finds a file it gives you that as a dataframe
+  The dates which weren't there are remembered by the cache (see cache_tools.NEGATIVE_TTLS), so
+  running it again doesn't try them all again.
   """
   import datetime
+  cache = cache or cache_tools.default_cache()
   df_apple_mobility_report = None
-  for date in pd.date_range(datetime.date.today() - pd.Timedelta(days=100),datetime.date.today(),freq='D')[::-1]:
-    date_str = date.strftime("%Y-%m-%d")
-    try:
-      df_apple_mobility_report = pd.read_csv(f"https://covid19-static.cdn-apple.com/covid19-mobility-data/2021HotfixDev19/v3/en-us/applemobilitytrends-{date_str}.csv")
-      break
-    except Exception as error:
-      pass
+  with fetch_tools.make_session(pool_size=1) as session:
+    for date in pd.date_range(datetime.date.today() - pd.Timedelta(days=100),datetime.date.today(),freq='D')[::-1]:
+      date_str = date.strftime("%Y-%m-%d")
+      try:
+        response = cache.get(session, f"https://covid19-static.cdn-apple.com/covid19-mobility-data/2021HotfixDev19/v3/en-us/applemobilitytrends-{date_str}.csv",
+                             source='apple_mobility', max_retries=1)
+      except Exception as error:
+        continue
+      if response.ok:
+        df_apple_mobility_report = pd.read_csv(io.BytesIO(response.content))
+        break
 
   if df_apple_mobility_report is None:
     print("Couldn't find the apple mobility data")
@@ -178,37 +240,109 @@ def apple_mobility() -> pd.DataFrame:
   return df_apple_mobility_report
 
 
-def interpolate_early_data(series : pd.Series, 
-                           zeropoints : list = [-40,-20] ) -> pd.Series:
+def pchip_ramp_slopes(first_values: np.ndarray, next_slopes: np.ndarray, ramp_length: int,
+                      next_gaps: np.ndarray = 1.0) -> np.ndarray:
+    """The pchip derivative (as scipy's PchipInterpolator works it out) at the first data point of each series,
+    where the interpolation comes up from a run of zeros "ramp_length" steps before it. "next_slopes" is the
+    slope on to the following data point, "next_gaps" steps on, and NaN where there isn't one (so the first
+    point is the end point)."""
+    ramp_slopes = first_values / ramp_length
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # an interior point: the weighted harmonic mean of the slopes either side, or 0 at a turning point
+        weight_1, weight_2 = 2 * next_gaps + ramp_length, next_gaps + 2 * ramp_length
+        interior = (weight_1 + weight_2) / (weight_1 / ramp_slopes + weight_2 / next_slopes)
+        interior = np.where((np.sign(ramp_slopes) != np.sign(next_slopes)) | (ramp_slopes == 0) | (next_slopes == 0),
+                            0.0, interior)
+    # an end point: the one-sided three point estimate from the last zero and the ramp
+    end_point = (2 * ramp_length + 1) * ramp_slopes / (ramp_length + 1)
+    return np.where(np.isnan(next_slopes), end_point, interior)
+
+
+def interpolate_early_frame(df: pd.DataFrame, zeropoints=(-40, -20), noise_scale_factor=0.5,
+                            seed=None) -> pd.DataFrame:
     """
-    Interpolate the from zero up to the start of the data, prefilling the defined 
-    "zeropoints" range with 0s (relative to the first filled data point).
+    interpolate_early_data for every column of a wide (date x series) frame in one pass. Each column is
+    prefilled with 0s over the "zeropoints" range (relative to its first filled data point), then interpolated
+    (pchip, as before) from the end of the zeros up to that first point, and noise is added to the prefilled
+    part. The frame is extended back in time if a ramp would start before its first row. The rest of the data
+    is left as it is. The noise comes from a numpy Generator seeded with "seed", so a given seed (and frame)
+    always gives the same output.
     """
-    series_original = series.copy()
-    series_without_na = series_original.dropna()
+    zero_start, zero_end = zeropoints
+    values = df.to_numpy(dtype=float, copy=True)
+    filled = ~np.isnan(values)
+    has_data = filled.any(axis=0)
+    first_rows = np.where(has_data, filled.argmax(axis=0), 0)
+
+    # extend the index back so every ramp fits
+    extra_rows = max(0, -int((first_rows[has_data] + zero_start).min())) if has_data.any() else 0
+    if extra_rows:
+        step = df.index[1] - df.index[0] if len(df) > 1 else 1
+        index = pd.Index([df.index[0] - step * (extra_rows - row) for row in range(extra_rows)]).append(df.index)
+        values = np.vstack([np.full((extra_rows, values.shape[1]), np.nan), values])
+        first_rows = first_rows + extra_rows
+    else:
+        index = df.index
+
+    columns = np.flatnonzero(has_data)
+    first_rows = first_rows[columns]
+    first_values = values[first_rows, columns]
+    # each column's next filled row after its first one (len(values) if there isn't one), as missing days are skipped
+    filled_rows = np.where(np.isnan(values[:, columns]), len(values), np.arange(len(values))[:, None])
+    next_filled_rows = np.vstack([np.minimum.accumulate(filled_rows[::-1], axis=0)[::-1],
+                                  np.full((1, len(columns)), len(values))])
+    next_rows = next_filled_rows[first_rows + 1, np.arange(len(columns))]
+    next_gaps = next_rows - first_rows
+    next_values = values[np.minimum(next_rows, len(values) - 1), columns]
+    next_slopes = np.where(next_rows < len(values), (next_values - first_values) / next_gaps, np.nan)
+    ramp_length = -zero_end
+    slopes = pchip_ramp_slopes(first_values, next_slopes, ramp_length, next_gaps)
+
+    # rows relative to each column's first data point, over the whole prefilled range
+    offsets = np.arange(zero_start, 0)
+    rows = first_rows[None, :] + offsets[:, None]
+    t = np.clip((offsets - zero_end) / ramp_length, 0, None)[:, None]
+    ramp = first_values * (3 * t ** 2 - 2 * t ** 3) + ramp_length * slopes * (t ** 3 - t ** 2)
+
+    rng = np.random.default_rng(seed)
+    noise = rng.random(ramp.shape) - 0.5
+    values[rows, columns] = ramp + noise * ramp * noise_scale_factor
+    return pd.DataFrame(values, index=index, columns=df.columns)
 
-    earliest_filled_index = series_without_na.index[0]
-    zero_points_index = [earliest_filled_index+zeropoints[0],earliest_filled_index+zeropoints[1]]
 
-    # set some earlier points to zero to mark the area between which we need to interpolate
+def interpolate_early_data(series : pd.Series, 
+                           zeropoints : list = [-40,-20], seed=None) -> pd.Series:
+    """
+    Interpolate the from zero up to the start of the data, prefilling the defined 
+    "zeropoints" range with 0s (relative to the first filled data point). Now just interpolate_early_frame for
+    a single series - use that directly for many series at once.
+    """
+    return interpolate_early_frame(series.to_frame(), zeropoints, seed=seed).iloc[:, 0].dropna().rename(series.name)
 
-    empty_series = pd.Series(index=range(zero_points_index[0],earliest_filled_index-1)) # this goes from the zero point up to the start of the data
 
-    series_working = empty_series.append(series.dropna())
-    series_working.loc[zero_points_index[0]:zero_points_index[1]] = 0 # the zero point range as 0
+def interpolate_early_feed(df_feed: pd.DataFrame, value_columns: List[str], group_column='code',
+                           zeropoints=(-40, -20), seed=None) -> pd.DataFrame:
+    """interpolate_early_frame for every (group_column, value_column) series of a long-format feed at once,
+    returned in the same long format (sorted by group_column then date) - including any rows added before the
+    start of an area's data. The other columns are carried over from each group's first row."""
+    df_wide = df_feed.pivot(index='date', columns=group_column, values=value_columns)
+    df_wide = df_wide.reindex(pd.date_range(df_wide.index.min(), df_wide.index.max()))
+    df_interpolated = interpolate_early_frame(df_wide, zeropoints, seed=seed)
 
-    # do the interpolation
-    series_working = series_working.interpolate(method='pchip', limit_direction='both', limit=None)
+    # the wide columns are every (value_column, group) pair, value column first, so reshape straight to long
+    groups = df_wide.columns.get_level_values(group_column)[:df_wide.shape[1] // len(value_columns)]
+    values = df_interpolated.to_numpy().reshape(len(df_interpolated), len(value_columns), len(groups))
+    df_long = pd.DataFrame(values.transpose(2, 0, 1).reshape(-1, len(value_columns)), columns=value_columns)
+    df_long.insert(0, 'date', np.tile(df_interpolated.index.to_numpy(), len(groups)))
+    df_long.insert(0, group_column, np.repeat(groups.to_numpy(), len(df_interpolated)))
+    df_long = df_long[df_long[value_columns].notna().any(axis=1)]
 
-    # add some noise
-    noise_scale_factor = 0.5
-    interp_mask = pd.Series(data=np.zeros(len(series_working)),index = series_working.index, name='interp_mask')
-    interp_mask.loc[:earliest_filled_index-1] = random.rand(len(series_working.loc[:earliest_filled_index-1]))-0.5
+    df_keys = df_feed.drop(columns=['date'] + list(value_columns)).drop_duplicates(group_column)
+    df_long = df_long.merge(df_keys, on=group_column, how='left')[list(df_feed.columns)].reset_index(drop=True)
+    # keep a categorical group column (as schema_tools.apply_schema makes the codes) categorical
+    return df_long.astype({group_column: df_feed[group_column].dtype})
 
-    noisy_interp_data = (series_working + (interp_mask * series_working * noise_scale_factor))
-    return noisy_interp_data.rename(series.name)
 
-              
 def remove_outliers(series, z_score_threshold = 10):
   """Removes entries from a series which lie more than <threshold> times the standard deviation from the mean. The default should remove more obvious spikes."""
   series=series.copy()
@@ -220,56 +354,209 @@ def remove_outliers(series, z_score_threshold = 10):
   return series.interpolate(method='pchip', limit = 1,limit_direction='forward')            
 
 
+def rolling_z_scores(df: pd.DataFrame, window_length=20, groups=None) -> pd.DataFrame:
+  """The z-score of every value against the trailing window of "window_length" values ending with it (the
+  population standard deviation, as scipy.stats.zscore uses). Any window which isn't full (or has a gap in
+  it) gives NaN. If "groups" is given the rows of each group must be contiguous, and windows which would
+  reach back into the previous group are blanked out too - that way the whole frame is one rolling pass."""
+  rolling = df.rolling(window_length, min_periods=window_length)
+  z_scores = (df - rolling.mean()) / rolling.std(ddof=0)
+  if groups is not None:
+    position_in_group = pd.Series(groups, index=df.index).groupby(groups, sort=False).cumcount()
+    z_scores[position_in_group.to_numpy() < window_length - 1] = np.nan
+  return z_scores
+
+
+def replace_flagged(df: pd.DataFrame, flagged: pd.DataFrame, groups=None) -> pd.DataFrame:
+  """Replaces the flagged values by straight-line interpolation between the nearest unflagged values either
+  side of them (within the same group), or the nearest one if there is only one side."""
+  positions = pd.DataFrame(np.repeat(np.arange(len(df))[:, None], df.shape[1], axis=1),
+                           index=df.index, columns=df.columns, dtype=float)
+  kept_values = df.mask(flagged)
+  kept_positions = positions.mask(flagged | df.isna())
+  if groups is None:
+    groups = np.zeros(len(df))
+  grouped_values, grouped_positions = kept_values.groupby(groups, sort=False), kept_positions.groupby(groups, sort=False)
+  previous_values, next_values = grouped_values.ffill(), grouped_values.bfill()
+  previous_positions, next_positions = grouped_positions.ffill(), grouped_positions.bfill()
+
+  weights = ((positions - previous_positions) / (next_positions - previous_positions)).fillna(0)
+  interpolated = previous_values + (next_values - previous_values) * weights
+  interpolated = interpolated.fillna(previous_values).fillna(next_values)
+  return df.where(~flagged, interpolated)
+
+
+def remove_outliers_rolling(series: pd.Series, window_length=20, window_z_score_threshold=4) -> pd.Series:
+  """Removes outliers in one pass over the series: any value more than "window_z_score_threshold" standard
+  deviations from the mean of the "window_length" values ending with it is replaced by interpolating between
+  its neighbours. The first window_length-1 values are left alone."""
+  df = series.to_frame()
+  flagged = rolling_z_scores(df, window_length).abs() > window_z_score_threshold
+  return replace_flagged(df, flagged).iloc[:, 0]
+
+
+def remove_outliers_grouped(df_feed: pd.DataFrame, value_columns: List[str], group_column='code',
+                            window_length=20, window_z_score_threshold=4) -> pd.DataFrame:
+  """remove_outliers_rolling for every (group_column, value_column) series of a long-format feed at once.
+  The feed must already be sorted by group_column then date (as the saved feeds are)."""
+  df_feed = df_feed.copy()
+  df_values = df_feed[value_columns].astype(float)
+  groups = df_feed[group_column].to_numpy()
+  flagged = rolling_z_scores(df_values, window_length, groups=groups).abs() > window_z_score_threshold
+  df_feed[value_columns] = replace_flagged(df_values, flagged, groups=groups)
+  return df_feed
+
+
 def remove_outlier_window(series: pd.Series,window_length=20, window_z_score_threshold=4) -> pd.Series:
   """Removes outliers by scanning a window across the data and removing anything that exceeds the 
-  z_score threshold (replaces that datapoint through interpolation"""
+  z_score threshold (replaces that datapoint through interpolation). Now just remove_outliers_rolling - see
+  remove_outlier_window_loop for the original version."""
+  return remove_outliers_rolling(series, window_length=window_length, window_z_score_threshold=window_z_score_threshold)
+
+
+def remove_outlier_window_loop(series: pd.Series,window_length=20, window_z_score_threshold=4) -> pd.Series:
+  """The original, one-window-at-a-time version of remove_outlier_window, kept as the reference the
+  vectorised version is tested and benchmarked against. Note each output value is the cleaned value of the
+  day *before* it (the window ends one before idx)."""
   series_ = series.copy()
   series_index = series_.index
   series_ = series_.reset_index(drop=True)
   data_list = series_[:window_length].tolist()
 
   for idx in series_.index[window_length:]:
-    series_window = series[idx-window_length:idx].copy()
+    series_window = series_[idx-window_length:idx].copy()
     series_window = remove_outliers(series_window,z_score_threshold=window_z_score_threshold)
-    data_list.append(series_window[window_length-1])
+    data_list.append(series_window.iloc[window_length-1])
 
   return pd.Series(data_list, index=series_index)
 
 
-def nhse_weekly_covid19_admissions_excel(weekly_admissions_url = "https://www.england.nhs.uk/statistics/wp-content/uploads/sites/2/2020/10/Weekly-covid-admissions-publication-201029-2.xlsx"):
+def get_cached_content(url: str, source: str, cache: cache_tools.ResponseCache = None) -> bytes:
+    """The body of url, through the cache (cache_tools.default_cache() if not given)"""
+    with fetch_tools.make_session(pool_size=1) as session:
+        return (cache or cache_tools.default_cache()).get(session, url, source=source, timeout=60).content
+
+
+WEEKLY_TRUST_ADMISSIONS_SHEETS = ['Hosp ads & diag',
+                                  'New hosp cases',
+                                  'Hosp ads from comm',
+                                  'Hosp ads from comm with lag',
+                                  'Care home ads and diags',
+                                  'All beds COVID','MV beds COVID']
+TRUST_ADMISSIONS_COLUMNS = ['region', 'code', 'name', 'date', 'metric', 'value']
+
+
+def tidy_trust_sheet(df_sheet: pd.DataFrame, metric: str, region_column='NHS England Region') -> pd.DataFrame:
+    """One sheet of an NHSE trust admissions workbook (a row per trust, a column per date) as a long frame with
+    TRUST_ADMISSIONS_COLUMNS. Anything that isn't a date column or region/Code/Name is dropped."""
+    df_sheet = df_sheet.dropna(how='all', axis=1).dropna(how='all', axis=0)
+    df_sheet = df_sheet.rename(columns={region_column: 'region', 'Code': 'code', 'Name': 'name'})
+    date_columns = [column for column in df_sheet.columns if column not in ('region', 'code', 'name')
+                    and isinstance(column, (datetime.datetime, str)) and pd.notna(pd.to_datetime(column, errors='coerce'))]
+    df_long = df_sheet.melt(id_vars=['region', 'code', 'name'], value_vars=date_columns, var_name='date',
+                            value_name='value')
+    df_long = df_long.assign(date=pd.to_datetime(df_long['date']), metric=metric,
+                             value=pd.to_numeric(df_long['value'], errors='coerce'))
+    return df_long.dropna(subset=['value'])[TRUST_ADMISSIONS_COLUMNS]
+
+
+def _parse_trust_sheet(workbook: bytes, sheet: str, header: int, region_column: str) -> pd.DataFrame:
+    return tidy_trust_sheet(pd.read_excel(io.BytesIO(workbook), sheet_name=sheet, header=header), sheet, region_column)
+
+
+def parse_trust_workbook(workbook: bytes, sheets: List[str] = None, header=14, region_column='NHS England Region',
+                         max_workers=1) -> pd.DataFrame:
+    """All the chosen sheets (all of them if sheets is None) of a trust admissions workbook, as one long frame
+    (see tidy_trust_sheet). The workbook is opened once and each sheet parsed from it, or with max_workers > 1
+    the sheets are parsed in parallel across a pool of processes (openpyxl only reads the sheet it is asked for,
+    so each process only pays for its own sheets)."""
+    excel_file = pd.ExcelFile(io.BytesIO(workbook))
+    sheets = excel_file.sheet_names if sheets is None else list(sheets)
+    if max_workers == 1:
+        frames = [tidy_trust_sheet(excel_file.parse(sheet, header=header), sheet, region_column) for sheet in sheets]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            frames = list(executor.map(_parse_trust_sheet, itertools.repeat(workbook), sheets,
+                                       itertools.repeat(header), itertools.repeat(region_column)))
+    df_long = pd.concat(frames, axis=0, ignore_index=True)
+    return df_long.astype(dict(region='category', code='category', name='category', metric='category'))
+
+
+def trust_admissions(url: str, sheets: List[str] = None, header=14, region_column='NHS England Region',
+                     skip_sheets=0, max_workers=1, output_dir='./data/cache/trust_admissions', refresh=False,
+                     cache: cache_tools.ResponseCache = None) -> pd.DataFrame:
+    """An NHSE trust admissions workbook as a long (region, code, name, date, metric, value) frame - one metric
+    per sheet. The workbook is downloaded once (through the response cache) and parsed in one pass (see
+    parse_trust_workbook), then the result is saved as parquet in output_dir, keyed on the url and the arguments
+    which change the parse (sheets, skip_sheets, header and region_column). Later calls with the same ones just read
+    that back, unless refresh=True. If sheets isn't given every sheet after the first "skip_sheets" is read."""
+    parse_key = dumps([url, sheets, skip_sheets, header, region_column])
+    output_path = f"{output_dir}/{hashlib.sha1(parse_key.encode()).hexdigest()}.parquet"
+    if os.path.exists(output_path) and not refresh:
+        return pd.read_parquet(output_path)
+
+    workbook = get_cached_content(url, 'nhse_excel', cache)
+    if sheets is None:
+        sheets = pd.ExcelFile(io.BytesIO(workbook)).sheet_names[skip_sheets:]
+    df_long = parse_trust_workbook(workbook, sheets, header=header, region_column=region_column,
+                                   max_workers=max_workers)
+
+    os.makedirs(output_dir, exist_ok=True)
+    temporary_path = f"{output_path}.{os.getpid()}.tmp"
+    df_long.to_parquet(temporary_path, index=False)
+    os.replace(temporary_path, output_path)
+    return df_long
+
+
+def wide_trust_admissions(df_long: pd.DataFrame) -> pd.DataFrame:
+    """A long trust_admissions frame back in the wide layout of the old excel readers - indexed by
+    (NHS England Region, Code, Name, date), with a column per sheet"""
+    metrics = df_long['metric'].unique().tolist()
+    df_wide = (df_long.astype(dict(region=object, code=object, name=object, metric=object))
+               .set_index(['region', 'code', 'name', 'date', 'metric'])['value'].unstack('metric'))
+    return df_wide[metrics].rename_axis(['NHS England Region', 'Code', 'Name', 'date']).rename_axis(None, axis=1)
+
+
+def nhse_weekly_covid19_admissions_excel(weekly_admissions_url = "https://www.england.nhs.uk/statistics/wp-content/uploads/sites/2/2020/10/Weekly-covid-admissions-publication-201029-2.xlsx",
+                                         cache: cache_tools.ResponseCache = None):
     """Pulls the weekly NHSE COVID19 Trust admissions file - useful as it is at a trust level and more recent than the
     monthly one, however it only goes back a few monhts.. It combines the different sheets into a single dataframe.
     Taken from the below URL:
-    https://www.england.nhs.uk/statistics/statistical-work-areas/covid-19-hospital-activity/"""
-    df_nhse_weekly_covid19_admissions = pd.DataFrame([pd.read_excel(weekly_admissions_url, sheet_name = sheet,header=14).dropna(how="all",axis=1).dropna(how="all",axis=0)
-                                                                                  .set_index(['NHS England Region', 'Code', 'Name']).rename_axis('date',axis=1).stack().rename(sheet)
-                                                                    for sheet in ['Hosp ads & diag',
-                                                                                  'New hosp cases',
-                                                                                  'Hosp ads from comm',
-                                                                                  'Hosp ads from comm with lag',
-                                                                                  'Care home ads and diags',
-                                                                                  'All beds COVID','MV beds COVID']]).T
+    https://www.england.nhs.uk/statistics/statistical-work-areas/covid-19-hospital-activity/
+    See trust_admissions for the same data in long format."""
+    df_nhse_weekly_covid19_admissions = wide_trust_admissions(
+        trust_admissions(weekly_admissions_url, sheets=WEEKLY_TRUST_ADMISSIONS_SHEETS, header=14, cache=cache))
     filename = (weekly_admissions_url[-(weekly_admissions_url[::-1].find("/")):]).replace("xlsx","csv")
     df_nhse_weekly_covid19_admissions.to_csv(filename)
     return df_nhse_weekly_covid19_admissions
 
 
-def nhse_monthly_covid19_admissions_historic_excel(url="https://www.england.nhs.uk/statistics/wp-content/uploads/sites/2/2020/11/Covid-Publication-12-11-2020_v4-CB.xlsx"):
+def nhse_monthly_covid19_admissions_historic_excel(url="https://www.england.nhs.uk/statistics/wp-content/uploads/sites/2/2020/11/Covid-Publication-12-11-2020_v4-CB.xlsx",
+                                                   cache: cache_tools.ResponseCache = None):
     """Pulls the monthly NHSE COVID19 Trust admissions file - useful as it is at a trust level and covers the full
     history , however it doesn't contain the most recent weeks. It combines the different sheets into a single
     dataframe. Taken from the below URL:
-    https://www.england.nhs.uk/statistics/statistical-work-areas/covid-19-hospital-activity/"""
-    Excel_nhse_covid_trust_historic = pd.ExcelFile(url)
-    output_df =  pd.DataFrame([(Excel_nhse_covid_trust_historic.parse(sheet,header=12)
-    .drop(columns='NHS England Region').rename(columns={"Unnamed: 2":"NHS England Region"})
-    .dropna(how='all',axis=1).dropna(how='all',axis=0)
-    .set_index(['NHS England Region', 'Code', 'Name']).rename_axis('date',axis=1).stack().rename(sheet)) for sheet in Excel_nhse_covid_trust_historic.sheet_names[1:]]).T
+    https://www.england.nhs.uk/statistics/statistical-work-areas/covid-19-hospital-activity/
+    See trust_admissions for the same data in long format."""
+    # in this one the region names are in the unlabelled third column
+    output_df = wide_trust_admissions(trust_admissions(url, header=12, region_column='Unnamed: 2', skip_sheets=1,
+                                                       cache=cache))
 
     filename = (url[-(url[::-1].find("/")):]).replace("xlsx","csv")
     output_df.to_csv(filename)
     return output_df
 
 
+# the API filters behind each of the saved "<dataset_name>_feed.csv" files
+# the uk feed goes first, as the other feeds' per-test derived metrics divide by its test counts
+NHSE_FEED_FILTERS = {'uk_nhse': ["areaType=overview"],
+                     'england_nhse': ["areaType=nation;areaName=england"],
+                     'nhsregion_nhse': ["areaType=nhsRegion"],
+                     'region_nhse': ["areaType=region"],
+                     'utla_nhse': ["areaType=utla"],
+                     'ltla_nhse': ["areaType=ltla"]}
+
+
 def covid_england_data_blob(utla=True, ltla=True) -> dict:
     """Gives you a steaming pile of fresh COVID-19 data from NHSE, Google and Apple
     ToDo: Need to change this to be a class with methods really.
@@ -297,13 +584,13 @@ def covid_england_data_blob(utla=True, ltla=True) -> dict:
                   #  "femaleCases":"femaleCases"}
 
     # England Only
-    output['england_nhse'] = get_paginated_dataset([f"areaType=nation;areaName=england"], query_structure).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
+    output['england_nhse'] = get_paginated_dataset(NHSE_FEED_FILTERS['england_nhse'], query_structure).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
     # All UK (some of the metrics only work for the UK as a whole...)
-    output['uk_nhse'] = get_paginated_dataset([f"areaType=overview"], query_structure).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
+    output['uk_nhse'] = get_paginated_dataset(NHSE_FEED_FILTERS['uk_nhse'], query_structure).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
     # NHS Regions
-    output['nhsregion_nhse'] = get_paginated_dataset([f"areaType=nhsRegion"], query_structure).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
+    output['nhsregion_nhse'] = get_paginated_dataset(NHSE_FEED_FILTERS['nhsregion_nhse'], query_structure).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
     # Regions (geographic regions) - some different metrics than NHS Regions
-    output['region_nhse'] = get_paginated_dataset([f"areaType=region"], query_structure).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
+    output['region_nhse'] = get_paginated_dataset(NHSE_FEED_FILTERS['region_nhse'], query_structure).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
 
     # Changed the structure for these next two filters, because they simply don't have many of the above columns
     # later note: changed to use default as the function just strips unused data anyway
@@ -318,14 +605,14 @@ def covid_england_data_blob(utla=True, ltla=True) -> dict:
 
     if utla:
         # upper tier local authorities (counties and unitary authorities, i.e. Lancashire, York, Somerset, etc...)
-        output['utla_nhse'] = get_paginated_dataset([f"areaType=utla"], query_structure_2).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
+        output['utla_nhse'] = get_paginated_dataset(NHSE_FEED_FILTERS['utla_nhse'], query_structure_2).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
     df_ltla_nhse_feed = None
     if ltla:
         # lower tier local authorities (councils and unitary authorities, i.e. Leeds council, Bradford council, York, etc...)
-        output['ltla_nhse'] = get_paginated_dataset([f"areaType=ltla"], query_structure_2).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
+        output['ltla_nhse'] = get_paginated_dataset(NHSE_FEED_FILTERS['ltla_nhse'], query_structure_2).dropna(how='all',axis=1).sort_values(['code','date',]).reset_index(drop=True)
 
     # google and apple mobility
-    output['google_mobility'] = google_mobility().sort_values(["country_region_code","sub_region_1",'date']).reset_index(drop=True)
+    output['google_mobility'] = google_mobility()
     # output['apple_mobility'] = (apple_mobility().set_index(['geo_type','region','transportation_type','alternative_name','sub-region','country'])
     #                                                     .rename_axis('date',axis=1).stack()
     #                                                     .unstack('transportation_type').reset_index())
@@ -342,39 +629,362 @@ def clean_data(df_nhs_api_data):
         date=pd.to_datetime(df_nhs_api_data['date'], format="%Y-%m-%d", errors='coerce')).set_index(
         ['areatype', 'date', 'name'])
 
-    df_nhs_api_data = df_nhs_api_data[~df_nhs_api_data['code'].str.contains("[WSN]")]
+    df_nhs_api_data = schema_tools.english_only(df_nhs_api_data)
     df_nhs_api_data = df_nhs_api_data.query("code != 'null'")  # remove all scottish welsh and NI records and code IS NULL records
 
     return df_nhs_api_data
 
 
-def download_and_save_data():
-    """"""
+# the columns which hold an age breakdown (a list of {'age', 'rate', 'value'} dicts per row), and the
+# (metric, sex) each becomes in the age table
+AGE_COLUMNS = {'maleCases': ('cases', 'male'),
+               'femaleCases': ('cases', 'female'),
+               'cumAdmissionsByAge': ('cumAdmissions', 'all')}
+AGE_TABLE_KEY_COLUMNS = ['areatype', 'date', 'code', 'metric', 'sex', 'age_band']
+
+
+def age_band_dtype(age_bands: Iterable[str]) -> pd.CategoricalDtype:
+    """An ordered categorical of the age bands (i.e. '0_to_4', '5_to_9', ... '90+'), youngest first"""
+    age_bands = sorted(set(age_bands), key=lambda age_band: int(re.match(r"\d+", age_band).group()))
+    return pd.CategoricalDtype(age_bands, ordered=True)
+
+
+def parse_age_column(column: pd.Series) -> pd.DataFrame:
+    """Explodes an age breakdown column into a long frame of age_band, value and rate, indexed by the row of
+    the column each entry came from. The column can hold the lists straight from the API, or the strings they
+    become once saved to csv - those are picked apart with regular expressions rather than ast.literal_eval."""
+    column = column.dropna()
+    is_string = column.map(lambda entry: isinstance(entry, str)).astype(bool)
+    age_frames = []
+    if is_string.any():
+        strings = column[is_string]
+        # the API gives the keys in alphabetical order, so normally one pass pulls out all three...
+        entries = strings.str.extractall(r"'age':\s*'([^']*)',\s*'rate':\s*([^,}\s]+),\s*'value':\s*([^,}\s]+)")
+        entries.columns = ['age_band', 'rate', 'value']
+        if len(entries) != strings.str.count(r"\{").sum():
+            # ...but if not, take each dict apart key by key
+            dicts = strings.str.extractall(r"\{([^}]*)\}")[0]
+            entries = pd.DataFrame(dict(age_band=dicts.str.extract(r"'age':\s*'([^']*)'")[0],
+                                        rate=dicts.str.extract(r"'rate':\s*([^,}\s]+)")[0],
+                                        value=dicts.str.extract(r"'value':\s*([^,}\s]+)")[0]))
+        age_frames.append(pd.DataFrame(dict(age_band=entries['age_band'].to_numpy(),
+                                            value=pd.to_numeric(entries['value'], errors='coerce').to_numpy(),
+                                            rate=pd.to_numeric(entries['rate'], errors='coerce').to_numpy()),
+                                       index=entries.index.get_level_values(0)))
+    if not is_string.all():
+        entries = column[~is_string].explode().dropna()
+        age_frames.append(pd.DataFrame(entries.tolist(), index=entries.index, columns=['age', 'value', 'rate'])
+                          .rename(columns={'age': 'age_band'}))
+    if len(age_frames) == 0:
+        return pd.DataFrame(columns=['age_band', 'value', 'rate'])
+    return pd.concat(age_frames).sort_index(kind='stable')
+
+
+def make_age_table(df_nhs_api_data: pd.DataFrame) -> pd.DataFrame:
+    """Pulls the AGE_COLUMNS out of a feed into one long-format table of areatype, date, code, metric, sex,
+    age_band, value, rate - with categorical dtypes for the repeated text columns"""
+    df_nhs_api_data = df_nhs_api_data.reset_index() if 'date' not in df_nhs_api_data.columns else df_nhs_api_data
+    df_nhs_api_data = df_nhs_api_data.reset_index(drop=True)
+
+    age_frames = []
+    for age_column, (metric, sex) in AGE_COLUMNS.items():
+        if age_column not in df_nhs_api_data.columns:
+            continue
+        df_ages = parse_age_column(df_nhs_api_data[age_column])
+        df_keys = df_nhs_api_data.loc[df_ages.index, ['areatype', 'date', 'code']]
+        age_frames.append(df_keys.reset_index(drop=True).assign(metric=metric, sex=sex)
+                          .join(df_ages.reset_index(drop=True)))
+    if len(age_frames) == 0:
+        return pd.DataFrame(columns=AGE_TABLE_KEY_COLUMNS + ['value', 'rate'])
+    return set_age_table_dtypes(pd.concat(age_frames, ignore_index=True)).sort_values(
+        ['code', 'date', 'metric', 'sex', 'age_band']).reset_index(drop=True)
+
+
+def set_age_table_dtypes(df_ages: pd.DataFrame) -> pd.DataFrame:
+    return df_ages.astype(dict(areatype='category', code='category', metric='category', sex='category',
+                               age_band=age_band_dtype(df_ages['age_band'].dropna()),
+                               value='float64', rate='float64')).assign(date=pd.to_datetime(df_ages['date']))
+
+
+def split_age_data(df_nhs_api_data: pd.DataFrame):
+    """Splits a (cleaned) feed into (the feed without the age breakdown columns, the age table)"""
+    return (df_nhs_api_data.drop(columns=[column for column in AGE_COLUMNS if column in df_nhs_api_data.columns]),
+            make_age_table(df_nhs_api_data))
+
+
+def merge_age_update(df_existing_ages: pd.DataFrame, df_update_ages: pd.DataFrame) -> pd.DataFrame:
+    """Merge a freshly pulled age table into an existing one, the fresh records winning"""
+    df_merged = pd.concat([df_ages.astype(dict(age_band=str, code=str, areatype=str, metric=str, sex=str))
+                           .assign(date=pd.to_datetime(df_ages['date']))
+                           for df_ages in [df_existing_ages, df_update_ages]], ignore_index=True, sort=False)
+    df_merged = df_merged.drop_duplicates(AGE_TABLE_KEY_COLUMNS, keep='last')
+    return set_age_table_dtypes(df_merged).sort_values(['code', 'date', 'metric', 'sex', 'age_band']).reset_index(drop=True)
+
+
+def get_age_table(dataset_name: str, data_dir='./data', areatypes: List[str] = None, date_from=None,
+                  date_to=None) -> pd.DataFrame:
+    """Loads a saved age table (i.e. "england_nhse"), from parquet if it's been saved as that, or else csv,
+    with its categorical dtypes"""
+    if os.path.isdir(storage_tools.dataset_path(f"{dataset_name}_ages", root=f"{data_dir}/parquet")):
+        df_ages = storage_tools.read_feed(f"{dataset_name}_ages", root=f"{data_dir}/parquet", areatypes=areatypes,
+                                          date_from=date_from, date_to=date_to)
+    else:
+        df_ages = load_data_file(f"{data_dir}/{dataset_name}_ages.csv", areatypes=areatypes,
+                                 date_from=date_from, date_to=date_to)
+    return set_age_table_dtypes(df_ages[AGE_TABLE_KEY_COLUMNS + ['value', 'rate']])
+
+
+def latest_stored_dates(df_feed: pd.DataFrame) -> pd.Series:
+    """The most recent date held for each area code in a saved feed"""
+    return pd.to_datetime(df_feed['date']).groupby(df_feed['code'], observed=True).max()
+
+
+def refresh_start_date(df_feed: pd.DataFrame, revision_days=7, stale_days=28) -> pd.Timestamp:
+    """Works out the first date an incremental refresh of a saved feed needs to pull: the latest date of the
+    area furthest behind, less "revision_days". Areas which stopped reporting more than "stale_days" before
+    the rest of the feed (i.e. abolished local authorities) are ignored, otherwise they'd drag the refresh
+    all the way back to when they stopped."""
+    latest_dates = latest_stored_dates(df_feed)
+    active_latest_dates = latest_dates[latest_dates >= latest_dates.max() - pd.Timedelta(days=stale_days)]
+    return active_latest_dates.min() - pd.Timedelta(days=revision_days)
+
+
+def get_nhse_feed_for_dates(dataset_name: str, dates: Iterable, max_workers=4) -> pd.DataFrame:
+    """Pulls just the given dates of one of the NHSE_FEED_FILTERS feeds. The API can only filter on a single
+    date at a time, but a day of even the ltla feed is only a page or so, so this is far cheaper than pulling
+    the full history."""
+    day_frames = [get_paginated_dataset(NHSE_FEED_FILTERS[dataset_name] + [f"date={pd.Timestamp(date):%Y-%m-%d}"],
+                                        max_workers=max_workers)
+                  for date in dates]
+    day_frames = [df_day for df_day in day_frames if len(df_day) > 0]
+    if len(day_frames) == 0:
+        return pd.DataFrame()
+    return pd.concat(day_frames, axis=0, sort=False).dropna(how='all', axis=1)
+
+
+def merge_feed_update(df_existing: pd.DataFrame, df_update: pd.DataFrame) -> pd.DataFrame:
+    """Merge freshly pulled (cleaned) records into an existing (cleaned) feed. Where both have a record for
+    the same (areatype, date, code) the fresh one wins, so back-dated revisions replace what was stored."""
+    df_merged = pd.concat([df_existing.reset_index(), df_update.reset_index()], axis=0, sort=False)
+    df_merged['date'] = pd.to_datetime(df_merged['date'])
+    df_merged = (df_merged.drop_duplicates(['areatype', 'date', 'code'], keep='last')
+                 .sort_values(['code', 'date']).reset_index(drop=True))
+    return df_merged.set_index(['areatype', 'date', 'name'])
+
+
+def incremental_feed_update(dataset_name: str, data_directory='./data', revision_days=7, max_workers=4) -> pd.DataFrame:
+    """Brings a saved "<dataset_name>_feed.csv" up to date by only pulling the dates after the latest
+    one stored. The last "revision_days" days already stored are pulled again as well, so any back-dated
+    corrections the API has made get picked up. If there is no saved feed yet, the full history is pulled.
+    Returns the cleaned, merged feed (it doesn't save it)."""
+    feed_path = f"{data_directory}/{dataset_name}_feed.csv"
+    if not os.path.exists(feed_path):
+        df_full = get_paginated_dataset(NHSE_FEED_FILTERS[dataset_name], max_workers=max_workers)
+        return clean_data(df_full.dropna(how='all', axis=1).sort_values(['code', 'date']).reset_index(drop=True))
+
+    df_existing = pd.read_csv(feed_path, parse_dates=['date']).set_index(['areatype', 'date', 'name'])
+    # the area furthest behind decides where to start, as the API can't filter on date per area
+    since_date = refresh_start_date(df_existing.reset_index(), revision_days=revision_days)
+    dates = pd.date_range(since_date, pd.Timestamp.today().normalize(), freq='D')
+    print(f"{dataset_name}: refreshing {len(dates)} days from {since_date:%Y-%m-%d}")
+
+    df_update = get_nhse_feed_for_dates(dataset_name, dates, max_workers=max_workers)
+    if len(df_update) == 0:
+        return df_existing
+    return merge_feed_update(df_existing, clean_data(df_update))
+
+
+def streamed_feed(dataset_name: str, staging_root: str, max_workers=4) -> pd.DataFrame:
+    """Pulls the full history of one of the NHSE_FEED_FILTERS feeds a page at a time into a raw parquet dataset
+    under staging_root (see stream_paginated_dataset), then reads it back cleaned. The raw download is never
+    held in memory as a whole."""
+    path = stream_paginated_dataset(NHSE_FEED_FILTERS[dataset_name], f"{dataset_name}_raw", staging_root,
+                                    max_workers=max_workers)
+    if not os.path.isdir(path):
+        return clean_data(pd.DataFrame(columns=list(schema_tools.API_STRUCTURE)))
+    df_raw = schema_tools.apply_schema(storage_tools.read_feed(f"{dataset_name}_raw", staging_root))
+    return clean_data(df_raw.dropna(how='all', axis=1))
+
+
+def download_and_save_data(incremental=False, revision_days=7, stream=False, validate=True):
+    """Pulls the NHSE API feeds plus google mobility and saves them into ./data. With incremental=True each
+    NHSE feed is only topped up with the dates since it was last saved (plus a "revision_days" window of
+    re-pulled dates, see incremental_feed_update) rather than being pulled in full. With stream=True a full pull
+    goes a page at a time through disk (see streamed_feed) rather than holding every feed in memory at once.
+    Either way the feeds are cleaned, saved and dropped one at a time, along with their derived metrics (see
+    derived_tools), which an incremental run only works out for the dates it re-pulled. Unless validate=False,
+    each cleaned feed is also run through the validation_tools checks, and the violations and a summary of the
+    checks are saved as data_quality_violations.csv and data_quality_summary.csv."""
     data_directory = './data'
-    covid_data_blob = covid_england_data_blob(utla=True, ltla=True)
+    staging_root = None
+    if incremental:
+        cleaned_feeds = ((dataset_name, incremental_feed_update(dataset_name, data_directory, revision_days))
+                         for dataset_name in NHSE_FEED_FILTERS)
+        df_dataset = google_mobility()
+    elif stream:
+        staging_root = tempfile.mkdtemp()
+        cleaned_feeds = ((dataset_name, streamed_feed(dataset_name, staging_root)) for dataset_name in NHSE_FEED_FILTERS)
+        df_dataset = google_mobility()
+    else:
+        covid_data_blob = covid_england_data_blob(utla=True, ltla=True)
+        # deal with google mobility data
+        df_dataset = covid_data_blob.pop('google_mobility')
+        cleaned_feeds = ((dataset_name, clean_data(covid_data_blob.pop(dataset_name)))
+                         for dataset_name in NHSE_FEED_FILTERS if dataset_name in covid_data_blob)
 
-    # deal with google mobility data
-    df_dataset = covid_data_blob.pop('google_mobility')
     df_dataset.to_csv(f"{data_directory}/gb_google_mobility_report.csv")
-
-    # save the nhse API data
-    for dataset_name, df_dataset in covid_data_blob.items():
-        clean_data(df_dataset).to_csv(f"{data_directory}/{dataset_name}_feed.csv")
+    del df_dataset
+
+    # save the nhse API data - as csv, and as partitioned parquet for the faster readers. The age breakdowns
+    # go into their own long-format "<dataset_name>_ages" tables
+    lookup_frames = []
+    population_path = f"{data_directory}/population_lookup.csv"
+    population = derived_tools.load_population(population_path)
+    tests = None
+    violation_frames, summary_frames = [], []
+    try:
+        for dataset_name, df_dataset in cleaned_feeds:
+            df_dataset, df_ages = split_age_data(df_dataset)
+            if validate:
+                df_violations, df_summary = validation_tools.validate_feed(df_dataset, dataset_name)
+                violation_frames.append(df_violations)
+                summary_frames.append(df_summary)
+            ages_path = f"{data_directory}/{dataset_name}_ages.csv"
+            if incremental and os.path.exists(ages_path):
+                df_ages = merge_age_update(pd.read_csv(ages_path), df_ages)
+
+            population = derived_tools.update_population(population, df_dataset)
+            if dataset_name == 'uk_nhse':
+                tests = derived_tools.test_counts(df_dataset)
+            derived_path = f"{data_directory}/{dataset_name}_derived.csv"
+            df_existing_derived = (pd.read_csv(derived_path, parse_dates=['date'])
+                                   if incremental and os.path.exists(derived_path) else None)
+            df_derived = derived_tools.update_derived(df_dataset, df_existing_derived, population, tests,
+                                                      revision_days=revision_days)
+
+            df_dataset.to_csv(f"{data_directory}/{dataset_name}_feed.csv")
+            storage_tools.write_feed(df_dataset, dataset_name, root=f"{data_directory}/parquet")
+            df_ages.to_csv(ages_path, index=False)
+            storage_tools.write_feed(df_ages, f"{dataset_name}_ages", root=f"{data_directory}/parquet")
+            df_derived.to_csv(derived_path, index=False)
+            storage_tools.write_feed(df_derived, f"{dataset_name}_derived", root=f"{data_directory}/parquet")
+            lookup_frames.append(df_dataset.reset_index()[['code', 'name', 'areatype']].astype(str).drop_duplicates())
+    finally:
+        if staging_root is not None:
+            shutil.rmtree(staging_root, ignore_errors=True)
 
     # make lookup # ToDo: eventually get this lookup from a more authorative source, like GeoPortal
-    df_nhs_api_data = pd.concat(list(covid_data_blob.values()), sort=True)
-    df_lookup = clean_data(df_nhs_api_data).reset_index()[['code', 'name', 'areatype']].drop_duplicates().set_index('code')  # reference data
+    df_lookup = pd.concat(lookup_frames, sort=True).drop_duplicates().set_index('code')  # reference data
     df_lookup.to_csv(f"{data_directory}/code_name_areatype_lookup.csv")
-
-def get_data(data_dir = './data'):
-    """Trawls the data_dir and returns a dictionary with each of the files loaded as pandas dataframes"""
-    files_list = os.listdir(data_dir)
-    data_pack = dict()
-    for file_name in files_list:
-        file_name_without_extension = file_name.rsplit(".",1)[0]
-        data_pack[file_name_without_extension] = pd.read_csv(f"{data_dir}/{file_name}")
-    return data_pack
+    population.to_csv(population_path)
+
+    if validate and summary_frames:
+        df_summary = pd.concat(summary_frames, ignore_index=True)
+        print(validation_tools.summary_report(df_summary))
+        df_summary.to_csv(f"{data_directory}/data_quality_summary.csv", index=False)
+        pd.concat(violation_frames, ignore_index=True).to_csv(f"{data_directory}/data_quality_violations.csv",
+                                                              index=False)
+
+
+KEY_COLUMNS = ['areatype', 'date', 'name', 'code']
+
+# parsed frames, keyed by (path, read arguments) -> (modified time of the path, frame)
+_data_cache = dict()
+
+
+def load_data_file(path: str, columns: List[str] = None, areatypes: List[str] = None,
+                   date_from=None, date_to=None) -> pd.DataFrame:
+    """Loads a csv file, or a parquet dataset directory written by storage_tools, keeping only the requested
+    columns (plus whichever of the KEY_COLUMNS it has), areatypes and dates. For parquet the filters are pushed
+    into the reader, for csv only the requested columns are parsed. The API fields get the compact dtypes from
+    schema_tools (categorical areas, Int32 counts, float32 rates). The result is cached in process until the
+    file changes on disk, so don't modify the frames you get back in place."""
+    cache_key = (path, tuple(columns) if columns is not None else None,
+                 tuple(areatypes) if areatypes is not None else None,
+                 None if date_from is None else pd.Timestamp(date_from),
+                 None if date_to is None else pd.Timestamp(date_to))
+    modified_time = os.stat(path).st_mtime_ns
+    if cache_key in _data_cache and _data_cache[cache_key][0] == modified_time:
+        return _data_cache[cache_key][1]
+
+    if os.path.isdir(path):
+        dataset_name, root = os.path.basename(path), os.path.dirname(path)
+        available_columns = storage_tools.feed_columns(dataset_name, root)
+    else:
+        available_columns = pd.read_csv(path, nrows=0).columns.tolist()
+    if columns is not None:
+        available_columns = [column for column in available_columns if column in KEY_COLUMNS or column in columns]
+    has_areatype, has_date = 'areatype' in available_columns, 'date' in available_columns
+
+    if os.path.isdir(path):
+        df = storage_tools.read_feed(dataset_name, root, columns=available_columns,
+                                     areatypes=areatypes if has_areatype else None,
+                                     date_from=date_from if has_date else None,
+                                     date_to=date_to if has_date else None)
+    else:
+        df = pd.read_csv(path, usecols=available_columns, parse_dates=['date'] if has_date else False)
+        if areatypes is not None and has_areatype:
+            df = df[df['areatype'].isin(areatypes)]
+        if date_from is not None and has_date:
+            df = df[df['date'] >= pd.Timestamp(date_from)]
+        if date_to is not None and has_date:
+            df = df[df['date'] <= pd.Timestamp(date_to)]
+        df = df.reset_index(drop=True)
+    df = schema_tools.apply_schema(df)
+
+    _data_cache[cache_key] = (modified_time, df)
+    return df
+
+
+class DataPack(Mapping):
+    """A read-only dictionary of the datasets in a data directory, which only loads each one (through
+    load_data_file) the first time it is looked up. Keys are the file names without their extension, i.e.
+    'england_nhse_feed'. Where a feed has also been saved as parquet (under <data_dir>/parquet) that is read
+    instead of the csv."""
+    def __init__(self, data_dir='./data', columns: List[str] = None, areatypes: List[str] = None,
+                 date_from=None, date_to=None):
+        self.data_dir = data_dir
+        self.read_kwargs = dict(columns=columns, areatypes=areatypes, date_from=date_from, date_to=date_to)
+
+        self.paths = dict()
+        for file_name in sorted(os.listdir(data_dir)):
+            if os.path.isfile(f"{data_dir}/{file_name}"):
+                self.paths[file_name.rsplit(".", 1)[0]] = f"{data_dir}/{file_name}"
+        parquet_root = f"{data_dir}/parquet"
+        if os.path.isdir(parquet_root):
+            for dataset_name in sorted(os.listdir(parquet_root)):
+                # the feeds' csvs are "<dataset_name>_feed.csv", the age and derived tables' just "<dataset_name>.csv"
+                key = dataset_name if dataset_name.endswith(('_ages', '_derived')) else f"{dataset_name}_feed"
+                self.paths[key] = f"{parquet_root}/{dataset_name}"
+
+    def __getitem__(self, key) -> pd.DataFrame:
+        return load_data_file(self.paths[key], **self.read_kwargs)
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __repr__(self):
+        return f"DataPack({self.data_dir!r}, {list(self.paths)})"
+
+
+def get_data(data_dir = './data', columns: List[str] = None, areatypes: List[str] = None,
+             date_from=None, date_to=None) -> DataPack:
+    """Trawls the data_dir and returns a dictionary-like DataPack of the files in it, each loaded as a pandas
+    dataframe the first time you ask for it. "columns", "areatypes" and "date_from"/"date_to" cut down what is
+    read from every file they apply to (the areatype/date/name/code columns are always kept)."""
+    return DataPack(data_dir, columns=columns, areatypes=areatypes, date_from=date_from, date_to=date_to)
 
 
 if __name__ == '__main__':
-    download_and_save_data()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Download the latest covid data into ./data")
+    parser.add_argument('--full', action='store_true', help="re-pull the full history rather than topping up the saved feeds")
+    parser.add_argument('--stream', action='store_true', help="with --full, pull each feed a page at a time through disk to keep memory down")
+    parser.add_argument('--revision-days', type=int, default=7, help="how many already-saved days to re-pull for revisions")
+    parser.add_argument('--no-validate', action='store_true', help="skip the data quality checks")
+    args = parser.parse_args()
+    download_and_save_data(incremental=not args.full, revision_days=args.revision_days, stream=args.stream,
+                           validate=not args.no_validate)
\ No newline at end of file
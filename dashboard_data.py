@@ -0,0 +1,79 @@
+"""Data access for the streamlit dashboard (streamlit_app.py). The feeds are loaded and indexed once, and the
+widget option lists are worked out up front, so a rerun only has to look up the selected slice of data."""
+from typing import Dict, List
+
+import pandas as pd
+
+import covid_data
+from src import schema_tools
+
+NHSE_FEED_NAMES = ['uk_nhse_feed', 'england_nhse_feed', 'region_nhse_feed', 'nhsregion_nhse_feed',
+                   'utla_nhse_feed', 'ltla_nhse_feed']
+
+
+def filter_english_only(df):
+    return schema_tools.english_only(df)
+
+
+def get_nhse_feed_local_data(data_dir='./data') -> pd.DataFrame:
+    """Gets the local NHSE feeds (whichever of NHSE_FEED_NAMES have been saved) and combines them into one
+    pandas dataframe"""
+    data_pack = covid_data.get_data(data_dir)
+    return schema_tools.concat_feeds(data_pack[feed_name] for feed_name in NHSE_FEED_NAMES if feed_name in data_pack)
+
+
+class DashboardData(object):
+    """The combined NHSE feeds, split up by areatype and indexed by (name, date), along with the precomputed
+    lists the dashboard widgets need:
+        areatype_options - the areatypes, in the order they appear in the feeds
+        areaname_options - {areatype: [area names]}
+        metric_availability - {areatype: boolean frame of which metrics each area has any data for}
+        area_codes - {areatype: the code of each area, indexed by name}"""
+    def __init__(self, df_feeds: pd.DataFrame):
+        df_feeds = filter_english_only(df_feeds)
+        self.metrics = [column for column in df_feeds.columns if column not in covid_data.KEY_COLUMNS]
+
+        self.areatype_options: List[str] = df_feeds['areatype'].unique().tolist()
+        self.areaname_options: Dict[str, List[str]] = dict()
+        self.metric_availability: Dict[str, pd.DataFrame] = dict()
+        self.frames: Dict[str, pd.DataFrame] = dict()
+        self.area_codes: Dict[str, pd.Series] = dict()
+        for areatype, df_areatype in df_feeds.groupby('areatype', sort=False, observed=True):
+            self.areaname_options[areatype] = df_areatype['name'].unique().tolist()
+            self.area_codes[areatype] = df_areatype.drop_duplicates('name').set_index('name')['code'].astype(str)
+            df_areatype = (df_areatype.assign(date=pd.to_datetime(df_areatype['date']),
+                                              name=df_areatype['name'].astype('category').cat.remove_unused_categories())
+                           .set_index(['name', 'date'])[self.metrics].sort_index())
+            self.frames[areatype] = df_areatype
+            self.metric_availability[areatype] = df_areatype.notna().groupby(level='name', observed=True).any()
+
+    def metric_options(self, areatype: str, names: List[str]) -> List[str]:
+        """The metrics which any of the named areas has data for"""
+        availability = self.metric_availability[areatype]
+        return availability.columns[availability.loc[availability.index.intersection(names)].any()].tolist()
+
+    def select(self, areatype: str, names: List[str], metrics: List[str]) -> pd.DataFrame:
+        """The chosen metrics for the chosen areas, stacked into a long frame of date, areatype, name, metric,
+        value (with any missing values dropped)"""
+        df_areatype = self.frames[areatype]
+        names = sorted(set(names).intersection(self.metric_availability[areatype].index))
+        df_selected = df_areatype.loc[(names, slice(None)), list(metrics)]
+        return (df_selected.rename_axis(columns='metric').stack().dropna().rename('value').reset_index()
+                .assign(areatype=areatype, name=lambda df: df['name'].astype(str))
+                [['date', 'areatype', 'name', 'metric', 'value']])
+
+    def values_on(self, areatype: str, metric: str, date) -> pd.Series:
+        """One metric for every area of an areatype on a date, indexed by area code - what a map of it needs"""
+        df_areatype = self.frames[areatype]
+        values = df_areatype[metric].xs(pd.Timestamp(date), level='date')
+        return pd.Series(values.to_numpy(), index=self.area_codes[areatype].reindex(values.index.astype(str)).to_numpy(),
+                         name=metric).rename_axis('code')
+
+    def latest_date(self, areatype: str, metric: str):
+        """The last date any area of the areatype has the metric for"""
+        values = self.frames[areatype][metric].dropna()
+        return values.index.get_level_values('date').max() if len(values) else None
+
+
+def load_dashboard_data(data_dir='./data') -> DashboardData:
+    return DashboardData(get_nhse_feed_local_data(data_dir))
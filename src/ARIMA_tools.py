@@ -1,6 +1,6 @@
-from statsmodels.tsa.statespace.sarimax import SARIMAX
 import matplotlib.pyplot as plt
 import plot_tools
+import forecast_tools
 import numpy as np
 import pandas as pd
 
@@ -33,11 +33,8 @@ def SARIMAX_model(df_data : pd.DataFrame, endog_name, exog_name, order=(30, 1, 1
     exogenous_actual = df_actual[exog_name]
     exogenous_forecast = df_data[df_data['type'] == 'forecast'].copy()[exog_name]
 
-    # define the model
-    model = SARIMAX(endog=endogenous_actual, exog=exogenous_actual, order=order)
-
-    # fit the model to the data
-    model_fit = model.fit();
+    # define the model and fit it to the data
+    model_fit = forecast_tools.fit_sarimax(endogenous_actual, exogenous_actual, order=order)
     if plot_diagnostics is True:
         model_fit.plot_diagnostics()
     if fit_summary is True:
@@ -56,4 +53,20 @@ def SARIMAX_model(df_data : pd.DataFrame, endog_name, exog_name, order=(30, 1, 1
     ax.set_ylim(-70, )
     plt.legend()
 
+    return model_fit
+
 
+def plot_area_predictions(df_predictions: pd.DataFrame, ax=None, ci_alpha=0.3):
+    """Plot one area's tidy predictions, as made by forecast_tools.fit_sarimax_by_area: the actual data, the
+    in-sample forecast and the out-of-sample forecast with their confidence intervals"""
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(15, 7))
+    df_predictions = df_predictions.set_index('date')
+    df_predictions['actual'].plot(ax=ax, marker='x', linewidth=0)
+    for prediction_type, label, ci_label in [('insample', 'insample forecast', 'confidence'),
+                                             ('forecast', 'out-of-sample forecast', None)]:
+        df_type = df_predictions[df_predictions['type'] == prediction_type]
+        df_type['mean'].plot(ax=ax, label=label, linestyle='--')
+        plot_tools.plot_ci(df_type[['lower', 'upper']], label=ci_label, ax=ax, alpha=ci_alpha)
+    ax.legend()
+    return ax
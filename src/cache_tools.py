@@ -0,0 +1,209 @@
+"""An on-disk cache of HTTP responses, shared by all the fetchers in covid_data (the NHSE API pages, the google and
+apple mobility reports and the NHSE trust admissions workbooks).
+
+Each response is kept for a time-to-live which depends on where it came from (SOURCE_TTLS), and is used without
+asking the server at all until then. After that it is revalidated with If-None-Match / If-Modified-Since, so an
+unchanged response costs a 304 rather than a full download. "Not found" style responses (NEGATIVE_STATUSES, i.e.
+the apple report for a date which was never published) are remembered too, for NEGATIVE_TTLS. The cache is kept
+under "max_bytes" by evicting the least recently used responses, and counts what it did in "stats".
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+from http import HTTPStatus
+from typing import Dict, Optional
+
+import requests
+
+from src import fetch_tools
+
+DEFAULT_CACHE_DIR = './data/cache/http'
+
+HOUR = 60 * 60
+# how long (in seconds) a response is used without asking the server again, by source
+SOURCE_TTLS = {'nhse_api': HOUR,
+               'google_mobility': 6 * HOUR,
+               'apple_mobility': 24 * HOUR,
+               'nhse_excel': 7 * 24 * HOUR,
+               'default': HOUR}
+# how long a NEGATIVE_STATUSES response is remembered, by source
+NEGATIVE_TTLS = {'apple_mobility': 6 * HOUR,
+                 'default': 10 * 60}
+NEGATIVE_STATUSES = {HTTPStatus.FORBIDDEN, HTTPStatus.NOT_FOUND, HTTPStatus.GONE}
+
+# the response headers worth keeping
+CACHED_HEADERS = ['ETag', 'Last-Modified', 'Content-Type']
+
+
+class CachedResponse(object):
+    """The parts of a requests.Response the fetchers use, for a response which came out of the cache"""
+    def __init__(self, status_code: int, content: bytes, headers: Dict[str, str]):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < HTTPStatus.BAD_REQUEST
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseCache(object):
+    """An on-disk cache of GET responses: one "<key>.json" file of metadata (status, validators and when the
+    server was last asked) plus one "<key>.body" file per (url, params). Safe to share between threads. The
+    cache_dir is only made when the first response is stored."""
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=500_000_000, ttls: Dict[str, float] = None,
+                 negative_ttls: Dict[str, float] = None, evict_every=50):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttls = dict(SOURCE_TTLS, **(ttls or dict()))
+        self.negative_ttls = dict(NEGATIVE_TTLS, **(negative_ttls or dict()))
+        self.evict_every = evict_every
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._stored_since_evict = 0
+
+    def key(self, url: str, params: dict = None) -> str:
+        return hashlib.sha1(json.dumps([url, sorted((params or dict()).items())], default=str).encode()).hexdigest()
+
+    def path(self, key) -> str:
+        return f"{self.cache_dir}/{key}"
+
+    def ttl(self, source: str, status_code: int) -> float:
+        ttls = self.negative_ttls if status_code in NEGATIVE_STATUSES else self.ttls
+        return ttls.get(source, ttls['default'])
+
+    def count(self, outcome: str):
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def load(self, key) -> Optional[dict]:
+        try:
+            with open(f"{self.path(key)}.json") as metadata_file:
+                return json.load(metadata_file)
+        except (OSError, ValueError):
+            return None
+
+    def read_body(self, key, entry: dict) -> Optional[CachedResponse]:
+        try:
+            with open(f"{self.path(key)}.body", 'rb') as body_file:
+                content = body_file.read()
+        except OSError:
+            return None
+        os.utime(f"{self.path(key)}.body")  # mark as recently used
+        return CachedResponse(entry['status_code'], content, entry['headers'])
+
+    def store(self, key, entry: dict, content: bytes = None):
+        """Saves the metadata (and the body, unless it is None) for key"""
+        temporary_suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if content is not None:
+            with open(f"{self.path(key)}.body.{temporary_suffix}", 'wb') as body_file:
+                body_file.write(content)
+            os.replace(f"{self.path(key)}.body.{temporary_suffix}", f"{self.path(key)}.body")
+        with open(f"{self.path(key)}.json.{temporary_suffix}", 'w') as metadata_file:
+            json.dump(entry, metadata_file)
+        os.replace(f"{self.path(key)}.json.{temporary_suffix}", f"{self.path(key)}.json")
+
+        if content is not None:
+            with self._lock:
+                self._stored_since_evict += 1
+                evict = self._stored_since_evict >= self.evict_every
+                if evict:
+                    self._stored_since_evict = 0
+            if evict:
+                self.evict()
+
+    def get(self, session: requests.Session, url: str, params: dict = None, source='default',
+            **retry_kwargs) -> CachedResponse:
+        """GET url (through fetch_tools.get_with_retries), unless a fresh enough response is cached. Counts each
+        call in stats as a 'hit' / 'negative_hit' (straight from the cache), 'revalidated' (the server said the
+        cached copy is still good) or 'miss' / 'negative_miss' (downloaded)."""
+        key = self.key(url, params)
+        entry = self.load(key)
+        now = time.time()
+        if entry is not None and now - entry['checked_at'] < self.ttl(source, entry['status_code']):
+            response = self.read_body(key, entry)
+            if response is not None:
+                self.count('negative_hit' if entry['status_code'] in NEGATIVE_STATUSES else 'hit')
+                return response
+
+        headers = dict()
+        if (entry is not None and entry['status_code'] == HTTPStatus.OK
+                and os.path.exists(f"{self.path(key)}.body")):
+            if 'ETag' in entry['headers']:
+                headers['If-None-Match'] = entry['headers']['ETag']
+            if 'Last-Modified' in entry['headers']:
+                headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        response = fetch_tools.get_with_retries(session, url, params=params, headers=headers or None,
+                                                ok_statuses=NEGATIVE_STATUSES, **retry_kwargs)
+
+        if response.status_code == HTTPStatus.NOT_MODIFIED and entry is not None:
+            cached_response = self.read_body(key, entry)
+            if cached_response is not None:
+                self.store(key, dict(entry, checked_at=now))
+                self.count('revalidated')
+                return cached_response
+
+        entry = dict(url=url, status_code=response.status_code, checked_at=now,
+                     headers={header: response.headers[header] for header in CACHED_HEADERS
+                              if header in response.headers})
+        self.store(key, entry, response.content)
+        self.count('negative_miss' if response.status_code in NEGATIVE_STATUSES else 'miss')
+        return CachedResponse(response.status_code, response.content, entry['headers'])
+
+    def download(self, url: str, path: str, source='default', **download_kwargs) -> bool:
+        """fetch_tools.download_file, for files too big to keep in the cache itself (i.e. the google mobility
+        archive) - the server isn't asked at all if the file at path was checked less than the source's ttl ago.
+        Returns True if a new copy was downloaded."""
+        metadata_path = f"{path}.json"
+        if (os.path.exists(path) and os.path.exists(metadata_path)
+                and time.time() - os.stat(metadata_path).st_mtime < self.ttl(source, HTTPStatus.OK)):
+            self.count('hit')
+            return False
+        downloaded = fetch_tools.download_file(url, path, **download_kwargs)
+        if not downloaded and os.path.exists(metadata_path):
+            os.utime(metadata_path)  # remember when it was last checked
+        self.count('miss' if downloaded else 'revalidated')
+        return downloaded
+
+    def evict(self):
+        """Deletes the least recently used responses until the cache is within max_bytes"""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.body'):
+                entry_stat = entry.stat()
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path[:-len('.body')]))
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        while entries and total_bytes > self.max_bytes:
+            _, size, path = entries.pop(0)
+            for suffix in ['.json', '.body']:
+                if os.path.exists(f"{path}{suffix}"):
+                    os.remove(f"{path}{suffix}")
+            total_bytes -= size
+
+    def hit_rate(self) -> float:
+        """The fraction of calls answered without a full download"""
+        calls = sum(self.stats.values())
+        return (calls - self.stats['miss'] - self.stats['negative_miss']) / calls if calls else 0.0
+
+
+_default_cache = None
+
+
+def default_cache() -> ResponseCache:
+    """The ResponseCache the covid_data fetchers use unless they're given one"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResponseCache()
+    return _default_cache
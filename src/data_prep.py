@@ -1,6 +1,8 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 
+import schema_tools
+
 #import feature_tools
 #import pyspark_tools
 
@@ -10,20 +12,19 @@ import matplotlib.pyplot as plt
 
 def get_nhse_feed_local_data():
 	"""Gets the local csv files for the NHSE feed and combines them into one pandas dataframe"""
-	df = pd.concat([
-				pd.read_csv("../data/uk_nhse_feed.csv").tail(100),
-				pd.read_csv("../data/england_nhse_feed.csv").tail(100),
-				pd.read_csv("../data/region_nhse_feed.csv"),
-				#pd.read_csv("../data/nhsregion_nhse_feed.csv").tail(100),
-				pd.read_csv("../data/utla_nhse_feed.csv").tail(100),
-				pd.read_csv("../data/ltla_nhse_feed.csv").tail(100),
-					],
-			   axis=0)
+	df = schema_tools.concat_feeds([
+				schema_tools.apply_schema(pd.read_csv("../data/uk_nhse_feed.csv").tail(100)),
+				schema_tools.apply_schema(pd.read_csv("../data/england_nhse_feed.csv").tail(100)),
+				schema_tools.apply_schema(pd.read_csv("../data/region_nhse_feed.csv")),
+				#schema_tools.apply_schema(pd.read_csv("../data/nhsregion_nhse_feed.csv").tail(100)),
+				schema_tools.apply_schema(pd.read_csv("../data/utla_nhse_feed.csv").tail(100)),
+				schema_tools.apply_schema(pd.read_csv("../data/ltla_nhse_feed.csv").tail(100)),
+					])
 	return df
 
 def filter_english_only(df):
 
-	return df[~df['code'].str.contains('[WSN]')]
+	return schema_tools.english_only(df)
 
 
 df = get_nhse_feed_local_data()
@@ -1,3 +1,5 @@
+from typing import List, Tuple
+
 import pandas as pd
 import statsmodels.tsa.stattools as stattools
 import numpy as np
@@ -11,6 +13,59 @@ def find_optimum_lags(df: pd.DataFrame) -> int:
   return optimum_lags
 
 
+def cross_correlations(x: np.ndarray, y: np.ndarray, max_lag: int = 30, min_lag: int = 0) -> np.ndarray:
+    """
+    Cross-correlates every column of x with the same column of y at once, using FFTs. Row i of the result is
+    lag min_lag + i, where the correlation at lag k is between x[t+k] and y[t] - the same definition as
+    statsmodels' ccf (with adjusted=True). Rows where either series of a pair is NaN are left out of that pair.
+    :param x: array of shape (number of time points, number of pairs)
+    :param y: array of the same shape as x
+    :return: array of shape (max_lag - min_lag + 1, number of pairs)
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    n_valid = valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_demeaned = np.where(valid, x - np.where(valid, x, 0).sum(axis=0) / n_valid, 0)
+        y_demeaned = np.where(valid, y - np.where(valid, y, 0).sum(axis=0) / n_valid, 0)
+        x_std = np.sqrt((x_demeaned ** 2).sum(axis=0) / n_valid)
+        y_std = np.sqrt((y_demeaned ** 2).sum(axis=0) / n_valid)
+
+    n_fft = 1 << int(np.ceil(np.log2(2 * len(x))))
+
+    def lagged_products(a, b):
+        """sum over t of a[t+k] * b[t], for lags k = min_lag..max_lag"""
+        products = np.fft.irfft(np.fft.rfft(a, n_fft, axis=0) * np.conj(np.fft.rfft(b, n_fft, axis=0)), n_fft, axis=0)
+        return products[np.arange(min_lag, max_lag + 1) % n_fft]
+
+    covariances = lagged_products(x_demeaned, y_demeaned)
+    overlaps = np.round(lagged_products(valid.astype(float), valid.astype(float)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(overlaps > 0, covariances / overlaps, np.nan) / (x_std * y_std)
+
+
+def find_optimum_lags_batch(df: pd.DataFrame, pairs: List[Tuple[str, str]], max_lag: int = 30,
+                            min_lag: int = 0) -> pd.DataFrame:
+    """
+    The batch version of find_optimum_lags: finds the offset (lag) which best aligns each pair of columns in a
+    wide frame (i.e. date by region), by cross-correlating all the pairs at once. Only lags between min_lag and
+    max_lag are considered.
+    :param df: wide data frame holding the series
+    :param pairs: (x column, y column) pairs to align, i.e. [('cases London', 'admissions London'), ...]
+    :return: data frame with a row per pair: x, y, optimum_lag, peak_correlation
+    """
+    x = df[[x_column for x_column, _ in pairs]].to_numpy(dtype=float)
+    y = df[[y_column for _, y_column in pairs]].to_numpy(dtype=float)
+    correlations = cross_correlations(x, y, max_lag=max_lag, min_lag=min_lag)
+
+    all_nan = np.isnan(correlations).all(axis=0)
+    peak_rows = np.nanargmax(np.where(np.isnan(correlations), -np.inf, correlations), axis=0)
+    peak_correlations = correlations[peak_rows, np.arange(len(pairs))]
+    return pd.DataFrame(dict(x=[x_column for x_column, _ in pairs], y=[y_column for _, y_column in pairs],
+                             optimum_lag=np.where(all_nan, np.nan, peak_rows + min_lag),
+                             peak_correlation=np.where(all_nan, np.nan, peak_correlations)))
+
+
 def min_max_scale_df(df: pd.DataFrame) -> pd.DataFrame:
     """
     Scales the data frame values between 0 and 1 across the columns allowing for easier comparison of line shape on plots
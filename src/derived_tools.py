@@ -0,0 +1,169 @@
+"""Derived metrics - rolling averages, per-100k rates, per-test normalisation and scaled series - worked out once
+at ingest (see covid_data.download_and_save_data) and saved next to each feed as "<dataset_name>_derived", so the
+dashboard and notebooks just load the columns rather than recomputing them from the full feed every time.
+
+DERIVED_METRICS says what to derive: {derived column: spec}, where spec['kind'] is one of
+    rolling_mean - the mean of spec['source'] over the trailing spec['window'] days
+    per_100k - spec['source'] per 100,000 people, from the population lookup (see update_population)
+    per_test - spec['source'] divided by the UK wide spec['tests'] on the same date (see test_counts)
+    scaled - spec['source'] divided by its maximum for the area, as data_tools.min_max_scale_df does
+A spec's source can be an earlier derived column. Metrics whose inputs a feed doesn't have are skipped.
+"""
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ['areatype', 'date', 'name', 'code']
+
+DERIVED_METRICS = {
+    'newCasesBySpecimenDateRollingMean': dict(kind='rolling_mean', source='newCasesBySpecimenDate', window=7),
+    'newCasesByPublishDateRollingMean': dict(kind='rolling_mean', source='newCasesByPublishDate', window=7),
+    'newAdmissionsRollingMean': dict(kind='rolling_mean', source='newAdmissions', window=7),
+    'newDeaths28DaysByDeathDateRollingMean': dict(kind='rolling_mean', source='newDeaths28DaysByDeathDate', window=7),
+    'newCasesBySpecimenDateRollingMeanPer100k': dict(kind='per_100k', source='newCasesBySpecimenDateRollingMean'),
+    'newAdmissionsRollingMeanPer100k': dict(kind='per_100k', source='newAdmissionsRollingMean'),
+    'newDeaths28DaysByDeathDateRollingMeanPer100k': dict(kind='per_100k',
+                                                         source='newDeaths28DaysByDeathDateRollingMean'),
+    'newCasesByPublishDatePerUKPillarTwoTest': dict(kind='per_test', source='newCasesByPublishDate',
+                                                    tests='newPillarTwoTestsByPublishDate'),
+    'newCasesBySpecimenDateRollingMeanScaled': dict(kind='scaled', source='newCasesBySpecimenDateRollingMean'),
+    'newAdmissionsRollingMeanScaled': dict(kind='scaled', source='newAdmissionsRollingMean'),
+}
+
+# the cumulative count and its per-100k rate which populations are estimated from, when there isn't a reference one
+POPULATION_COUNT, POPULATION_RATE = 'cumCasesBySpecimenDate', 'cumCasesBySpecimenDateRate'
+
+
+def estimate_population(df_feed: pd.DataFrame) -> pd.Series:
+    """The population of each area (indexed by code), backed out of the feed's cumulative cases and their rate
+    per 100k (the median over the days both are reported)"""
+    df_feed = df_feed.reset_index() if 'code' not in df_feed.columns else df_feed
+    if POPULATION_COUNT not in df_feed.columns or POPULATION_RATE not in df_feed.columns:
+        return pd.Series(dtype=float, name='population').rename_axis('code')
+    rate = pd.to_numeric(df_feed[POPULATION_RATE], errors='coerce').astype(float)
+    population = pd.to_numeric(df_feed[POPULATION_COUNT], errors='coerce').astype(float) / rate.where(rate > 0) * 1e5
+    return (population.groupby(df_feed['code'].astype(str).to_numpy()).median().dropna().round()
+            .rename('population').rename_axis('code'))
+
+
+def load_population(path: str) -> pd.Series:
+    """The population lookup saved by a previous run (code, population), or an empty one"""
+    try:
+        return pd.read_csv(path, index_col='code')['population']
+    except FileNotFoundError:
+        return pd.Series(dtype=float, name='population').rename_axis('code')
+
+
+def update_population(population: pd.Series, df_feed: pd.DataFrame) -> pd.Series:
+    """Adds estimates (see estimate_population) for any of the feed's areas the lookup doesn't have yet. Areas
+    already in it keep their population, so a reference table can be dropped in over the estimates."""
+    estimates = estimate_population(df_feed)
+    return pd.concat([population, estimates[~estimates.index.isin(population.index)]]).rename('population')
+
+
+def test_counts(df_uk_feed: pd.DataFrame) -> pd.DataFrame:
+    """The UK wide test counts the per_test metrics divide by, indexed by date"""
+    df_uk_feed = df_uk_feed.reset_index() if 'date' not in df_uk_feed.columns else df_uk_feed
+    tests = {spec['tests'] for spec in DERIVED_METRICS.values() if spec['kind'] == 'per_test'}
+    return (df_uk_feed.assign(date=pd.to_datetime(df_uk_feed['date'])).set_index('date')
+            [[column for column in df_uk_feed.columns if column in tests]].astype(float))
+
+
+def history_days(metrics: Dict[str, dict], name: str) -> int:
+    """How many days before a date the feed is needed from to derive 'name' for that date"""
+    spec = metrics.get(name)
+    if spec is None:
+        return 0
+    window_days = spec['window'] - 1 if spec['kind'] == 'rolling_mean' else 0
+    return window_days + history_days(metrics, spec['source'])
+
+
+def derive_metrics(df_feed: pd.DataFrame, population: pd.Series = None, tests: pd.DataFrame = None,
+                   metrics: Dict[str, dict] = None, date_from=None) -> pd.DataFrame:
+    """The derived metrics for a (cleaned) feed, as a frame of the KEY_COLUMNS plus one float32 column per
+    derived metric. With date_from, only the rows from that date on are derived (and returned) - the feed is
+    only read back as far as the rolling windows need. Note scaled metrics are then only scaled by the maximum
+    since date_from, until merge_derived_update rescales them over the whole history."""
+    metrics = DERIVED_METRICS if metrics is None else metrics
+    df_feed = df_feed.reset_index() if 'date' not in df_feed.columns else df_feed
+    if date_from is not None:
+        date_from = pd.Timestamp(date_from)
+        history = max([history_days(metrics, name) for name in metrics], default=0)
+        df_feed = df_feed[pd.to_datetime(df_feed['date']) >= date_from - pd.Timedelta(days=history)]
+
+    df = df_feed[KEY_COLUMNS].assign(date=pd.to_datetime(df_feed['date']), code=df_feed['code'].astype(str))
+    columns = {column: pd.to_numeric(df_feed[column], errors='coerce').astype(float).to_numpy()
+               for column in df_feed.columns if column not in KEY_COLUMNS}
+    order = np.lexsort((df['date'].to_numpy(), df['code'].to_numpy()))
+    df = df.iloc[order].reset_index(drop=True)
+    columns = {column: values[order] for column, values in columns.items()}
+    codes = df['code'].to_numpy()
+
+    derived = dict()
+    for name, spec in metrics.items():
+        source = derived.get(spec['source'], columns.get(spec['source']))
+        if source is None:
+            continue
+        if spec['kind'] == 'rolling_mean':
+            # a time based window, so a missing day isn't bridged over
+            rolling = (pd.Series(source, index=df['date']).groupby(codes, sort=False)
+                       .rolling(f"{spec['window']}D", min_periods=spec['window']).mean())
+            derived[name] = rolling.to_numpy()
+        elif spec['kind'] == 'per_100k' and population is not None:
+            area_population = df['code'].map(population).to_numpy(dtype=float)
+            if np.isnan(area_population).all():
+                continue  # no population for any of the feed's areas
+            derived[name] = source / area_population * 1e5
+        elif spec['kind'] == 'per_test' and tests is not None and spec['tests'] in tests.columns:
+            tests_on_date = df['date'].map(tests[spec['tests']]).to_numpy(dtype=float)
+            derived[name] = source / np.where(tests_on_date > 0, tests_on_date, np.nan)
+        elif spec['kind'] == 'scaled':
+            derived[name] = source / pd.Series(source).groupby(codes, sort=False).transform('max').to_numpy()
+
+    df_derived = df.assign(**{name: values.astype('float32') for name, values in derived.items()})
+    if date_from is not None:
+        df_derived = df_derived[df_derived['date'] >= date_from].reset_index(drop=True)
+    return df_derived
+
+
+def rescale(df_derived: pd.DataFrame, metrics: Dict[str, dict] = None) -> pd.DataFrame:
+    """Works out the scaled metrics again over everything in df_derived"""
+    metrics = DERIVED_METRICS if metrics is None else metrics
+    rescaled = {name: (df_derived[spec['source']] / df_derived.groupby('code')[spec['source']].transform('max'))
+                .astype('float32')
+                for name, spec in metrics.items()
+                if spec['kind'] == 'scaled' and name in df_derived.columns and spec['source'] in df_derived.columns}
+    return df_derived.assign(**rescaled)
+
+
+def merge_derived_update(df_existing: pd.DataFrame, df_update: pd.DataFrame,
+                         metrics: Dict[str, dict] = None) -> pd.DataFrame:
+    """Replaces the existing derived rows for every (code, date) in the update, and rescales the scaled metrics
+    over the merged history"""
+    df_existing = df_existing.assign(date=pd.to_datetime(df_existing['date']), code=df_existing['code'].astype(str))
+    updated = pd.MultiIndex.from_frame(df_update[['code', 'date']])
+    df_kept = df_existing[~pd.MultiIndex.from_frame(df_existing[['code', 'date']]).isin(updated)]
+    df_merged = (pd.concat([df_kept, df_update], ignore_index=True).sort_values(['code', 'date'])
+                 .reset_index(drop=True))
+    return rescale(df_merged, metrics)
+
+
+def update_derived(df_feed: pd.DataFrame, df_existing: Optional[pd.DataFrame], population: pd.Series = None,
+                   tests: pd.DataFrame = None, metrics: Dict[str, dict] = None, revision_days=7) -> pd.DataFrame:
+    """Brings the saved derived metrics for a feed up to date. Only the dates from "revision_days" before the
+    latest one already derived are worked out again (the rest are kept), except for areas which are new to the
+    feed, or when the set of derived metrics has changed, which are derived in full."""
+    if df_existing is None or len(df_existing) == 0:
+        return derive_metrics(df_feed, population, tests, metrics)
+    df_update = derive_metrics(df_feed, population, tests, metrics, date_from=pd.Timestamp(df_existing['date'].max())
+                               - pd.Timedelta(days=revision_days))
+    if set(df_update.columns) != set(df_existing.columns):
+        return derive_metrics(df_feed, population, tests, metrics)
+
+    df_feed = df_feed.reset_index() if 'code' not in df_feed.columns else df_feed
+    new_codes = ~df_feed['code'].astype(str).isin(df_existing['code'].astype(str).unique())
+    if new_codes.any():
+        df_update = pd.concat([df_update[~df_update['code'].isin(df_feed.loc[new_codes, 'code'].astype(str))],
+                               derive_metrics(df_feed[new_codes], population, tests, metrics)], ignore_index=True)
+    return merge_derived_update(df_existing, df_update, metrics)
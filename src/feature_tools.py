@@ -1,20 +1,84 @@
 import dataclasses
-import pyspark_tools
+import hashlib
+import inspect
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List
+
+import pandas as pd
 import pyspark.sql.functions as f
 from pyspark.sql import DataFrame, Column
 
+from src import pyspark_tools
+
+DEFAULT_FEATURE_STORE = './data/features'
+
+
+def function_hash(function) -> str:
+    """a hash of the feature function's code, so a feature is recomputed when its function is edited"""
+    try:
+        code = inspect.getsource(function).encode()
+    except (OSError, TypeError):
+        code = function.__code__.co_code + repr(function.__code__.co_consts).encode()
+    return hashlib.sha1(code).hexdigest()
+
+
+def store_key(function, name: str = None) -> str:
+    """the directory name a feature's outputs are kept under: its name (the function's qualified name by default),
+    made safe for any filesystem as lambdas are "<lambda>", and the start of the function's hash - so features made
+    from different functions with the same name don't share (and clear out) one directory"""
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', name or function.__qualname__).strip('_.') or 'feature'
+    return f"{safe_name}-{function_hash(function)[:12]}"
+
+
+def files_version(paths: List[str]) -> str:
+    """a hash of the names, sizes and modification times of the files under 'paths' (which may be directories, i.e.
+    partitioned parquet, or spark's "file:..." uris). Files which aren't local (dbfs, s3...) only count by name,
+    which still changes when spark rewrites them."""
+    file_stats = []
+    for path in paths:
+        path = path[len('file:'):] if path.startswith('file:') else path
+        walked = [(root, name) for root, _, names in os.walk(path) for name in names] if os.path.isdir(path) \
+            else [os.path.split(path)]
+        for root, name in walked:
+            file_path = os.path.join(root, name)
+            if os.path.isfile(file_path):
+                file_stat = os.stat(file_path)
+                file_stats.append((file_path, file_stat.st_size, file_stat.st_mtime_ns))
+            else:
+                file_stats.append((file_path, None, None))
+    return hashlib.sha1(json.dumps(sorted(file_stats)).encode()).hexdigest()
+
+
+def data_version(data) -> str:
+    """a hash identifying the contents of a pandas or spark dataframe. Spark dataframes read from files are
+    identified by those files (see files_version) rather than by reading them."""
+    if isinstance(data, pd.DataFrame):
+        return hashlib.sha1(pd.util.hash_pandas_object(data).to_numpy().tobytes()
+                            + json.dumps(data.columns.astype(str).tolist()).encode()).hexdigest()
+    input_files = data.inputFiles()
+    if input_files:
+        return files_version(input_files)
+    return str(data.semanticHash())
+
+
 class FeaturePipeline(object):
     """This class wraps the feature pipeline function, and allows for the source and destination to be defined."""
-    def __init__(self, feature_function, source: str = 'local', source_path: str = '', conn=None):
+    def __init__(self, feature_function, source='local', source_path: str = '', conn=None):
         """
         Parameters
         ----------
         feature_function: function
-            This is the actual function which this pipeline will run - this class is just a wrapper around this function so we can encode the source
+            This is the actual function which this pipeline will run - this class is just a wrapper around this function so we can encode the source.
+            It is called with the source data (if there is a source) followed by the data of each of the feature's inputs, in order
         source: str
-            The source from which the data will be pulled, i.e. 'local' or 'spark'
+            The source from which the data will be pulled, i.e. 'local' or 'spark', or the (pandas or spark) dataframe itself.
+            None if the feature is made only from other features
         source_path: str
-            The 'path' to the data, i.e. for local it will be a filepath - "./data/test.csv"
+            The 'path' to the data, i.e. for local it will be a filepath - "./data/test.csv" - and for spark a table name
         conn
             In the case of database sources, this is the connection object, i.e. the spark connection for a spark source
         """
@@ -23,22 +87,47 @@ class FeaturePipeline(object):
         self.conn = conn
         self.feature_function = feature_function
 
-    def run(self):
-        """runs the feature function with the specified source, outputting the specfied feature data object"""
+    def load_source(self):
+        """the source data, or None if there is no source. Spark sources are only read lazily."""
+        if self.source is None or isinstance(self.source, (DataFrame, pd.DataFrame)):
+            return self.source
+        if self.source == 'local':
+            data_format = 'csv' if self.source_path.endswith('.csv') else 'parquet'
+            return pyspark_tools.DataStore(source='local', data_format=data_format,
+                                           spark_session=self.conn).get_table(self.source_path)
+        if self.source == 'spark':
+            return (self.conn or pyspark_tools.initialise_spark()).table(self.source_path)
+        raise ValueError(f"unknown feature source {self.source!r}")
+
+    def version(self) -> str:
+        """identifies the source data and the feature function - if neither changes, nor do the feature's outputs"""
+        source_data = self.load_source()
+        source_version = None if source_data is None else data_version(source_data)
+        return hashlib.sha1(json.dumps([function_hash(self.feature_function), source_version]).encode()).hexdigest()
 
-        if isinstance(self.source, DataFrame):
-            return self.feature_function(self.source)
+    def run(self, *input_data):
+        """runs the feature function with the specified source, outputting the specfied feature data object"""
+        source_data = self.load_source()
+        if source_data is None:
+            return self.feature_function(*input_data)
+        return self.feature_function(source_data, *input_data)
 
 
 class DataFeature(object):
     """This class will contain a feature and will the be the output of a feature pipeline.
 
-    "Features" are a set attributes which describe some subject, so the dates of birth (feature) of a cohort of patients (subject)"""
+    "Features" are a set attributes which describe some subject, so the dates of birth (feature) of a cohort of patients (subject).
+    Features can be made from other features (their "inputs"), so together they form a graph which FeatureGraph runs.
+    Their outputs are kept, in memory and in 'store_dir', keyed by the version of everything they were made from, and
+    only recomputed when that changes."""
     def __init__(self,
                  subject: str,
                  feature_pipeline: FeaturePipeline,
                  output_format: str = 'pandas dataframe',
-                 feature_list: list=None,):
+                 feature_list: list=None,
+                 inputs: list = None,
+                 name: str = None,
+                 store_dir: str = DEFAULT_FEATURE_STORE):
         """
         Parameters
         ----------
@@ -48,15 +137,125 @@ class DataFeature(object):
             the list of attributes described about the subject in this "Feature" class object.
         output_format
             the format of the output - allows for compatibility.
+        inputs
+            the DataFeatures this one is made from - their data is passed to the feature function after the source data.
+        name
+            identifies the feature (it must be unique within a FeatureGraph), the feature function's name by default.
+        store_dir
+            where the feature's outputs are persisted, or None to only keep them in memory. Each feature's go in a
+            directory of their own, named by store_key.
         """
         self.subject = subject
         self.feature_list = feature_list
         self.output_format = output_format
         self.feature_data = None
         self.feature_pipeline = feature_pipeline
+        self.inputs = list(inputs or [])
+        self.name = name or feature_pipeline.feature_function.__name__
+        self.store_key = store_key(feature_pipeline.feature_function, name)
+        self.store_dir = store_dir
+        self.version = None
+
+    def input_version(self) -> str:
+        """the version the feature's data should have, given its pipeline and the (already updated) inputs"""
+        return hashlib.sha1(json.dumps([self.feature_pipeline.version()]
+                                       + [feature.version for feature in self.inputs]).encode()).hexdigest()
+
+    def stored_path(self, version: str) -> str:
+        return f"{self.store_dir}/{self.store_key}/{version}"
+
+    def load(self, version: str) -> bool:
+        """loads the persisted data for 'version', if there is any"""
+        if self.store_dir is None or not os.path.exists(f"{self.stored_path(version)}.json"):
+            return False
+        with open(f"{self.stored_path(version)}.json") as metadata_file:
+            metadata = json.load(metadata_file)
+        if metadata['kind'] == 'spark':
+            spark = self.feature_pipeline.conn or pyspark_tools.initialise_spark()
+            self.feature_data = spark.read.parquet(f"{self.stored_path(version)}.parquet")
+        else:
+            self.feature_data = pd.read_parquet(f"{self.stored_path(version)}.parquet")
+        self.version = version
+        return True
+
+    def save(self):
+        """persists the feature data (pandas or spark) under its version, replacing older versions"""
+        if self.store_dir is None:
+            return
+        feature_dir = f"{self.store_dir}/{self.store_key}"
+        os.makedirs(feature_dir, exist_ok=True)
+        if isinstance(self.feature_data, DataFrame):
+            kind = 'spark'
+            self.feature_data.write.mode('overwrite').parquet(f"{self.stored_path(self.version)}.parquet")
+        else:
+            kind = 'pandas'
+            temporary_path = f"{self.stored_path(self.version)}.{os.getpid()}.tmp"
+            self.feature_data.to_parquet(temporary_path)
+            os.replace(temporary_path, f"{self.stored_path(self.version)}.parquet")
+        with open(f"{self.stored_path(self.version)}.json", 'w') as metadata_file:
+            json.dump(dict(kind=kind, inputs=[feature.name for feature in self.inputs]), metadata_file)
+
+        for entry in os.scandir(feature_dir):
+            if not entry.name.startswith(self.version):
+                shutil.rmtree(entry.path) if entry.is_dir() else os.remove(entry.path)
+
+    def refresh(self) -> bool:
+        """brings the feature data up to date, assuming the inputs already are. Returns True if it was recomputed,
+        rather than already being in memory or loaded from the store."""
+        version = self.input_version()
+        if version == self.version and self.feature_data is not None:
+            return False
+        if self.load(version):
+            return False
+        self.feature_data = self.feature_pipeline.run(*[feature.feature_data for feature in self.inputs])
+        self.version = version
+        self.save()
+        return True
+
+    def update(self) -> List[str]:
+        """Tells the feature to update itself with the latest data, via the defined feature pipeline - and its
+        inputs before it. Returns the names of the features which had to be recomputed."""
+        return FeatureGraph([self]).update()
+
+
+class FeatureGraph(object):
+    """Runs a set of DataFeatures (and everything they are made from) in dependency order, with features which don't
+    depend on each other running in parallel threads"""
+    def __init__(self, features: List[DataFeature], max_workers=4):
+        self.max_workers = max_workers
+        self.features = []
+        for feature in features:
+            self.add(feature)
 
-        #ToDo: How do we handle running of the Feature -> will this be triggered by something else? Perhaps need a method to do that, which will call the run method of the pipeline
+    def add(self, feature: DataFeature, path: tuple = ()):
+        """adds the feature and (first) everything it is made from, checking none of them depend on each other and
+        that no two features have the same name (or store their outputs in the same place)"""
+        if feature in path:
+            raise ValueError(f"features depend on each other: {' -> '.join(node.name for node in path + (feature,))}")
+        if feature in self.features:
+            return
+        for other in self.features:
+            if other.name == feature.name or other.store_key == feature.store_key:
+                raise ValueError(f"two features are called {feature.name!r} - give them different names")
+        for input_feature in feature.inputs:
+            self.add(input_feature, path + (feature,))
+        self.features.append(feature)
 
-    def update(self):
-        """Tells the feature to update itself with the latest data, via the defined feature pipeline."""
-        self.feature_data = self.feature_pipeline.run()
+    def update(self) -> List[str]:
+        """Brings every feature up to date. Returns the names of the features which had to be recomputed."""
+        waiting = {feature: list(feature.inputs) for feature in self.features}
+        done = set()
+        recomputed = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = dict()
+            while waiting or running:
+                for feature in [feature for feature, inputs in waiting.items() if done.issuperset(inputs)]:
+                    running[executor.submit(feature.refresh)] = feature
+                    del waiting[feature]
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    feature = running.pop(future)
+                    if future.result():
+                        recomputed.append(feature.name)
+                    done.add(feature)
+        return recomputed
@@ -0,0 +1,189 @@
+"""Tools for pulling paginated data from HTTP APIs (i.e. the coronavirus.data.gov.uk API) concurrently, and for
+downloading big files (i.e. the google mobility archive) only when they have changed"""
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http import HTTPStatus
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS_CODES = {HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.INTERNAL_SERVER_ERROR, HTTPStatus.BAD_GATEWAY,
+                      HTTPStatus.SERVICE_UNAVAILABLE, HTTPStatus.GATEWAY_TIMEOUT}
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """Make a requests session whose connection pool is big enough for 'pool_size' concurrent workers,
+    so the TCP/TLS connections are re-used between pages rather than re-opened for every request"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def backoff_delay(attempt: int, backoff_factor: float = 0.5, max_backoff: float = 30) -> float:
+    """Capped exponential backoff: backoff_factor * 2^attempt seconds, never more than max_backoff"""
+    return min(max_backoff, backoff_factor * (2 ** attempt))
+
+
+def get_with_retries(session: requests.Session, url: str, params: dict = None, timeout: float = 10,
+                     max_retries: int = 5, backoff_factor: float = 0.5, max_backoff: float = 30,
+                     headers: dict = None, stream: bool = False, ok_statuses: Iterable[int] = ()) -> requests.Response:
+    """GET the url, retrying connection errors, timeouts and 429/5xx responses with a capped exponential
+    backoff. Raises RuntimeError once 'max_retries' retries have been used up, or straight away on any other
+    4xx response (other than those in 'ok_statuses', which are returned like any other response)."""
+    for attempt in range(max_retries + 1):
+        try:
+            response = session.get(url, params=params, timeout=timeout, headers=headers, stream=stream)
+        except requests.RequestException as error:
+            failure = f"{type(error).__name__}: {error}"
+        else:
+            if response.status_code in RETRY_STATUS_CODES:
+                failure = f"status {response.status_code}"
+            elif response.status_code >= HTTPStatus.BAD_REQUEST and response.status_code not in ok_statuses:
+                raise RuntimeError(f'Request failed: {response.text}')
+            else:
+                return response
+
+        if attempt < max_retries:
+            delay = backoff_delay(attempt, backoff_factor, max_backoff)
+            print(f"    {url} failed ({failure}), retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+    raise RuntimeError(f"Request failed after {max_retries} retries: {url} ({failure})")
+
+
+def download_file(url: str, path: str, session: requests.Session = None, chunk_size: int = 1 << 20,
+                  timeout: float = 60, **retry_kwargs) -> bool:
+    """Streams the file at url to path a chunk at a time, without ever holding it in memory. The ETag,
+    Last-Modified and size of each download are kept next to it (in path + '.json'), and sent back as
+    If-None-Match / If-Modified-Since next time - if the server says the file hasn't changed (a 304, or the
+    same ETag and size) the download is skipped. Returns True if a new copy was downloaded."""
+    metadata_path = f"{path}.json"
+    metadata = dict()
+    if os.path.exists(path) and os.path.exists(metadata_path):
+        with open(metadata_path) as metadata_file:
+            metadata = json.load(metadata_file)
+    headers = dict()
+    if metadata.get('etag'):
+        headers['If-None-Match'] = metadata['etag']
+    if metadata.get('last_modified'):
+        headers['If-Modified-Since'] = metadata['last_modified']
+
+    own_session = session is None
+    if own_session:
+        session = make_session(pool_size=1)
+    try:
+        with get_with_retries(session, url, timeout=timeout, headers=headers, stream=True,
+                              **retry_kwargs) as response:
+            size = response.headers.get('Content-Length')
+            unchanged = (response.status_code == HTTPStatus.NOT_MODIFIED
+                         or (metadata.get('etag') is not None and response.headers.get('ETag') == metadata['etag']
+                             and size is not None and int(size) == metadata.get('size')))
+            if unchanged:
+                return False
+
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            with open(temporary_path, 'wb') as file:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+            os.replace(temporary_path, path)
+            with open(metadata_path, 'w') as metadata_file:
+                json.dump(dict(etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'),
+                               size=os.path.getsize(path)), metadata_file)
+            return True
+    finally:
+        if own_session:
+            session.close()
+
+
+def last_page_number(pagination: dict) -> Optional[int]:
+    """Read the final page number out of the API's pagination block, i.e. {'last': '/v1/data?...&page=12'}"""
+    last = (pagination or {}).get('last')
+    if not last:
+        return None
+    page = parse_qs(urlparse(last).query).get('page')
+    return int(page[0]) if page else None
+
+
+def fetch_page(session: requests.Session, endpoint: str, params: dict, page_number: int, cache=None,
+               **retry_kwargs) -> Tuple[int, Optional[dict]]:
+    """Fetch a single page of the API, returning (page_number, json) - the json is None if the page has no content.
+    If a cache (a cache_tools.ResponseCache) is given the page goes through that."""
+    if cache is not None:
+        response = cache.get(session, endpoint, params=dict(params, page=page_number), source='nhse_api', **retry_kwargs)
+    else:
+        response = get_with_retries(session, endpoint, params=dict(params, page=page_number), **retry_kwargs)
+    if response.status_code == HTTPStatus.NO_CONTENT:
+        return page_number, None
+    return page_number, response.json()
+
+
+def iter_paginated(endpoint: str, params: dict, start_page: int = 1, end_page: int = None, max_workers: int = 4,
+                   session: requests.Session = None, cache=None, **retry_kwargs) -> Iterator[Tuple[int, List[dict]]]:
+    """Fetch all the pages of a paginated API concurrently, using a pool of at most 'max_workers' threads
+    sharing one pooled session, yielding (page_number, records) in page order as soon as each page (and every
+    page before it) has arrived. Pages are requested from 'start_page' up to (but not including) 'end_page',
+    or until the API says there are no more pages.
+
+    The total number of pages isn't always known up front, so pages are requested speculatively - at most
+    'max_workers' pages are in flight or waiting for an earlier page at once, so however big the dataset only
+    a few pages are ever held here. Once a page comes back as the last one (no 'next' page, or an empty
+    response) no further pages are requested and anything fetched beyond it is thrown away.
+
+    Pages go through the cache if one is given (see fetch_page). Any extra keyword arguments (timeout,
+    max_retries, backoff_factor, max_backoff) go to get_with_retries.
+    """
+    own_session = session is None
+    if own_session:
+        session = make_session(pool_size=max_workers)
+
+    waiting: Dict[int, List[dict]] = dict()  # pages which have arrived ahead of an earlier one
+    final_page = end_page - 1 if end_page is not None else None
+    next_page, next_to_yield = start_page, start_page
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = set()
+            while True:
+                while (len(in_flight) + len(waiting) < max_workers
+                       and (final_page is None or next_page <= final_page)):
+                    in_flight.add(executor.submit(fetch_page, session, endpoint, params, next_page, cache=cache,
+                                                   **retry_kwargs))
+                    next_page += 1
+                if not in_flight:
+                    break
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page_number, page_json = future.result()
+                    if page_json is None:
+                        final_page = min(page_number - 1, final_page if final_page is not None else page_number)
+                        continue
+                    waiting[page_number] = page_json.get('data', [])
+
+                    pagination = page_json.get('pagination', {})
+                    page_last = page_number if pagination.get('next') is None else last_page_number(pagination)
+                    if page_last is not None:
+                        final_page = page_last if final_page is None else min(final_page, page_last)
+
+                while next_to_yield in waiting and (final_page is None or next_to_yield <= final_page):
+                    yield next_to_yield, waiting.pop(next_to_yield)
+                    next_to_yield += 1
+                if final_page is not None:
+                    waiting = {page_number: records for page_number, records in waiting.items()
+                               if page_number <= final_page}
+    finally:
+        if own_session:
+            session.close()
+
+
+def fetch_paginated(endpoint: str, params: dict, start_page: int = 1, end_page: int = None, max_workers: int = 4,
+                    session: requests.Session = None, cache=None, **retry_kwargs) -> List[Tuple[int, List[dict]]]:
+    """iter_paginated, collected into a list of (page_number, records) in page order"""
+    return list(iter_paginated(endpoint, params, start_page=start_page, end_page=end_page, max_workers=max_workers,
+                               session=session, cache=cache, **retry_kwargs))
@@ -0,0 +1,328 @@
+"""Fitting SARIMAX models without any plotting, so they can be fitted for many areas at once across a pool of
+processes, caching the fitted parameters so the daily refit only has to deal with the new days, and searching
+for cheaper model orders. See ARIMA_tools for plotting the results."""
+import hashlib
+import itertools
+import json
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.statespace.sarimax import SARIMAX
+
+PREDICTION_COLUMNS = ['date', 'type', 'actual', 'mean', 'lower', 'upper']
+
+
+def split_actual_forecast(df_data: pd.DataFrame, endog_name, exog_name=None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Splits one area's data into the 'actual' rows the model is fitted to and the 'forecast' rows it predicts.
+    If there is a 'type' column (as SARIMAX_model expects) that decides it, otherwise the actual rows are those
+    where the endog (and exog) are known, and the forecast rows are those after them where only the exog is."""
+    value_columns = [endog_name] + ([exog_name] if exog_name is not None else [])
+    if 'type' in df_data.columns:
+        df_actual = df_data[df_data['type'] == 'actual'].dropna(subset=value_columns)
+        df_forecast = df_data[df_data['type'] == 'forecast']
+    else:
+        df_actual = df_data.dropna(subset=value_columns)
+        df_forecast = df_data[(df_data['date'] > df_actual['date'].max()) & df_data[endog_name].isna()]
+        if exog_name is not None:
+            df_forecast = df_forecast.dropna(subset=[exog_name])
+    return df_actual, df_forecast
+
+
+def fit_sarimax(endog, exog=None, order=(30, 1, 10), **fit_kwargs):
+    """Fits a SARIMAX model, returning the statsmodels results object"""
+    model = SARIMAX(endog=endog, exog=exog, order=order)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return model.fit(disp=False, **fit_kwargs)
+
+
+def data_hash(endog: np.ndarray, exog: np.ndarray = None) -> str:
+    """A hash of the data a model is fitted to"""
+    digest = hashlib.sha1(np.ascontiguousarray(endog, dtype=float).tobytes())
+    if exog is not None:
+        digest.update(np.ascontiguousarray(exog, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+class ModelCache(object):
+    """An on-disk cache of fitted model parameters, one small json file per (area, endog, exog, order).
+    Each entry remembers a hash of the data the parameters were last used on and how many observations that was,
+    so a later run can tell whether the series is unchanged, has just had new days added to the end, or has
+    changed (i.e. been revised), along with how many observations the parameters were actually estimated from.
+    The cache is kept to at most "max_entries" files and "max_bytes" in total by evicting the least recently used
+    entries."""
+    def __init__(self, cache_dir='./model_cache', max_entries=2000, max_bytes=50_000_000):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, area, endog_name, exog_name, order) -> str:
+        return hashlib.sha1(json.dumps([str(area), endog_name, exog_name, list(order)]).encode()).hexdigest()
+
+    def path(self, key) -> str:
+        return f"{self.cache_dir}/{key}.json"
+
+    def get(self, key) -> Optional[dict]:
+        try:
+            with open(self.path(key)) as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        os.utime(self.path(key))  # mark as recently used
+        return entry
+
+    def put(self, key, entry: dict):
+        temporary_path = f"{self.path(key)}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as cache_file:
+            json.dump(entry, cache_file)
+        os.replace(temporary_path, self.path(key))
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache is within max_entries and max_bytes"""
+        entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                   for entry in os.scandir(self.cache_dir) if entry.name.endswith('.json')]
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+            _, size, path = entries.pop(0)
+            os.remove(path)
+            total_bytes -= size
+
+
+def fit_sarimax_cached(cache: ModelCache, area, endog: np.ndarray, exog: np.ndarray = None, endog_name='endog',
+                       exog_name=None, order=(30, 1, 10), refit='append', warm_start_maxiter=10, refit_after_days=28,
+                       **fit_kwargs):
+    """fit_sarimax, reusing the parameters in the cache where it can. Returns (model fit, how it was fitted):
+        'hit' - the data hasn't changed, so the stored parameters are just run through the Kalman filter
+        'append' - new days have been added to the end of the data the stored parameters were used on, and
+            refit='append': the stored parameters are run through the filter over the longer series
+        'warm' - the maximum likelihood fit is re-run, starting from the stored parameters and limited to
+            warm_start_maxiter iterations (or fit_kwargs' maxiter, if that is lower). This is how new days are
+            dealt with when refit='warm', and also when the stored parameters were estimated more than
+            "refit_after_days" days before the end of the data (so appending never leaves them stale for long), or
+            when the earlier data has been revised (i.e. the re-pulled days of an incremental ingest)
+        'miss' - nothing in the cache, so a full fit
+    Both the filter and the warm start are a fraction of the cost of a full fit at high orders."""
+    endog = np.asarray(endog, dtype=float)
+    exog = None if exog is None else np.asarray(exog, dtype=float)
+    key = cache.key(area, endog_name, exog_name, order)
+    entry = cache.get(key)
+    full_hash = data_hash(endog, exog)
+
+    how = 'miss'
+    if entry is not None and entry['data_hash'] == full_hash:
+        how = 'hit'
+    elif entry is not None:
+        # entries from before fitted_observations was kept were fitted to all the data they were saved with
+        fitted_observations = entry.get('fitted_observations', entry['n_observations'])
+        appended = entry['n_observations'] < len(endog) and entry['data_hash'] == data_hash(
+            endog[:entry['n_observations']], None if exog is None else exog[:entry['n_observations']])
+        if appended and refit == 'append' and len(endog) - fitted_observations <= refit_after_days:
+            how = 'append'
+        else:
+            how = 'warm'
+
+    model = SARIMAX(endog=endog, exog=exog, order=order)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if how in ('hit', 'append'):
+            model_fit = model.filter(np.asarray(entry['params']))
+        elif how == 'warm':
+            warm_kwargs = dict(fit_kwargs, maxiter=min(warm_start_maxiter,
+                                                       fit_kwargs.get('maxiter', warm_start_maxiter)))
+            model_fit = model.fit(start_params=np.asarray(entry['params']), disp=False, **warm_kwargs)
+        else:
+            model_fit = model.fit(disp=False, **fit_kwargs)
+
+    if how != 'hit':
+        cache.put(key, dict(area=str(area), endog_name=endog_name, exog_name=exog_name, order=list(order),
+                            data_hash=full_hash, n_observations=len(endog),
+                            fitted_observations=fitted_observations if how == 'append' else len(endog),
+                            params=np.asarray(model_fit.params).tolist()))
+    return model_fit, how
+
+
+def predictions_frame(model_fit, df_actual: pd.DataFrame, df_forecast: pd.DataFrame, endog_name, exog_name=None,
+                      alpha=0.05) -> pd.DataFrame:
+    """The in-sample predictions and out-of-sample forecasts of a fitted model, with their confidence intervals,
+    as a tidy frame of PREDICTION_COLUMNS"""
+    frames = []
+    predict = model_fit.get_prediction()
+    frames.append((df_actual, 'insample', predict, df_actual[endog_name].to_numpy(dtype=float)))
+    if len(df_forecast) > 0:
+        exog_forecast = None if exog_name is None else np.atleast_2d(df_forecast[exog_name].to_numpy(dtype=float)).T
+        forecast = model_fit.get_forecast(steps=len(df_forecast), exog=exog_forecast)
+        frames.append((df_forecast, 'forecast', forecast, df_forecast[endog_name].to_numpy(dtype=float)))
+
+    output = []
+    for df_rows, prediction_type, prediction, actual in frames:
+        conf_int = np.asarray(prediction.conf_int(alpha=alpha))
+        output.append(pd.DataFrame(dict(date=df_rows['date'].to_numpy(), type=prediction_type, actual=actual,
+                                        mean=np.asarray(prediction.predicted_mean),
+                                        lower=conf_int[:, 0], upper=conf_int[:, 1])))
+    return pd.concat(output, ignore_index=True)
+
+
+def fit_area(area, df_area: pd.DataFrame, endog_name, exog_name=None, order=(30, 1, 10), alpha=0.05,
+             fit_kwargs: dict = None, cache: ModelCache = None, refit='append',
+             refit_after_days=28) -> Tuple[dict, pd.DataFrame]:
+    """Fits one area's model (through the cache, if one is given), returning (fit report, predictions). Any error
+    is caught and reported, so one bad area doesn't stop a batch."""
+    start_time = time.perf_counter()
+    report = dict(area=area, order=order, n_observations=0, status='ok', converged=None, aic=np.nan, error=None,
+                  cache=None)
+    df_predictions = pd.DataFrame(columns=PREDICTION_COLUMNS)
+    try:
+        df_area = df_area.sort_values('date')
+        df_actual, df_forecast = split_actual_forecast(df_area, endog_name, exog_name)
+        report['n_observations'] = len(df_actual)
+        endog = df_actual[endog_name].to_numpy(dtype=float)
+        exog = None if exog_name is None else df_actual[exog_name].to_numpy(dtype=float)
+        if cache is None:
+            model_fit = fit_sarimax(endog, exog, order=order, **(fit_kwargs or {}))
+        else:
+            model_fit, report['cache'] = fit_sarimax_cached(cache, area, endog, exog, endog_name, exog_name,
+                                                            order=order, refit=refit,
+                                                            refit_after_days=refit_after_days, **(fit_kwargs or {}))
+        report['converged'] = bool(model_fit.mle_retvals.get('converged', True)) if model_fit.mle_retvals else None
+        report['aic'] = model_fit.aic
+        df_predictions = predictions_frame(model_fit, df_actual, df_forecast, endog_name, exog_name, alpha=alpha)
+    except Exception as error:
+        report.update(status='failed', error=f"{type(error).__name__}: {error}")
+    report['fit_seconds'] = time.perf_counter() - start_time
+    return report, df_predictions
+
+
+def _fit_area_star(arguments):
+    return fit_area(*arguments)
+
+
+def fit_sarimax_by_area(df_feed: pd.DataFrame, endog_name, exog_name=None, order=(30, 1, 10), group_column='code',
+                        max_workers=None, alpha=0.05, fit_kwargs: dict = None, cache_dir: str = None,
+                        refit='append', refit_after_days=28) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Fits a separate SARIMAX model for every area (group_column) of a long-format feed, spreading the fits
+    over a pool of "max_workers" processes (max_workers=1 fits them one after another in this process).
+    Each area's rows are split into actual and forecast rows by split_actual_forecast. If a "cache_dir" is given
+    the fitted parameters are kept in a ModelCache there, and re-used on later runs (see fit_sarimax_cached).
+
+    Returns (predictions, fit report):
+        predictions - group_column plus PREDICTION_COLUMNS, i.e. the in-sample predictions and forecasts of
+            every area with their (1-alpha) confidence intervals
+        fit report - one row per area, with its fit time, convergence, AIC, how the cache was used, and any error
+    """
+    columns = ['date', endog_name] + ([exog_name] if exog_name is not None else []) \
+        + (['type'] if 'type' in df_feed.columns else [])
+    cache = None if cache_dir is None else ModelCache(cache_dir)
+    tasks = [(area, df_area[columns], endog_name, exog_name, order, alpha, fit_kwargs, cache, refit,
+              refit_after_days)
+             for area, df_area in df_feed.groupby(group_column, sort=True, observed=True)]
+
+    if max_workers == 1:
+        results = [_fit_area_star(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_fit_area_star, tasks))
+    if cache is not None:
+        cache.evict()
+
+    df_report = pd.DataFrame([report for report, _ in results]).rename(columns={'area': group_column})
+    df_predictions = pd.concat([df_predictions.assign(**{group_column: report['area']})
+                                for report, df_predictions in results], ignore_index=True)
+    df_predictions = df_predictions[[group_column] + PREDICTION_COLUMNS]
+    return df_predictions, df_report
+
+
+def evaluate_order(endog: np.ndarray, exog: Optional[np.ndarray], order, train_end: int, horizon: int,
+                   fit_kwargs: dict = None) -> dict:
+    """Fits the order to endog[:train_end] and scores its forecast of the next "horizon" values (the mean absolute
+    error), for one fold of a rolling-origin evaluation"""
+    start_time = time.perf_counter()
+    result = dict(order=tuple(order), train_end=train_end, aic=np.nan, abs_error=np.nan, status='ok', error=None)
+    try:
+        model_fit = fit_sarimax(endog[:train_end], None if exog is None else exog[:train_end], order=order,
+                                **(fit_kwargs or {}))
+        forecast = model_fit.forecast(steps=horizon,
+                                      exog=None if exog is None else exog[train_end:train_end + horizon])
+        result['aic'] = model_fit.aic
+        result['abs_error'] = float(np.mean(np.abs(np.asarray(forecast) - endog[train_end:train_end + horizon])))
+    except Exception as error:
+        result.update(status='failed', error=f"{type(error).__name__}: {error}")
+    result['fit_seconds'] = time.perf_counter() - start_time
+    return result
+
+
+def _evaluate_order_star(arguments):
+    return evaluate_order(*arguments)
+
+
+def search_orders(endog, exog=None, p_values: Iterable[int] = range(0, 8), d_values: Iterable[int] = (0, 1),
+                  q_values: Iterable[int] = range(0, 4), n_origins=3, horizon=7, prune_factor=1.5, max_workers=None,
+                  fit_kwargs: dict = None) -> pd.DataFrame:
+    """Searches the grid of (p, d, q) orders for the model which forecasts the series best, so the accuracy of
+    cheaper orders can be weighed up against their fitting time.
+
+    Each candidate is scored by rolling-origin evaluation: it is fitted up to "n_origins" cut-off points, each
+    "horizon" days apart at the end of the series, and forecasts the "horizon" days after each cut-off. The
+    folds are run one round at a time (earliest cut-off first), with every surviving candidate's fit for that
+    round spread across a pool of "max_workers" processes (max_workers=1 fits them one after another in this
+    process). After each round any candidate whose mean error so far is more than "prune_factor" times the best
+    one's is dropped, so clearly worse orders don't use up the remaining fits. The series must be longer than
+    n_origins * horizon days.
+
+    Returns one row per candidate, ranked by mean holdout error (candidates which made it through every round
+    first), with the AIC of its first fit (note that AICs are only comparable between orders with the same d),
+    how many rounds it reached, and its fit times."""
+    endog = np.asarray(endog, dtype=float)
+    exog = None if exog is None else np.asarray(exog, dtype=float)
+    if n_origins < 1 or n_origins * horizon >= len(endog):
+        raise ValueError(f"{n_origins} origins {horizon} days apart don't fit in a series of {len(endog)} days")
+    candidates = [tuple(order) for order in itertools.product(p_values, d_values, q_values)]
+    origins = [len(endog) - horizon * fold for fold in range(n_origins, 0, -1)]
+
+    fold_results = {order: [] for order in candidates}
+    surviving = list(candidates)
+    pruned_after = dict()
+    executor = None if max_workers == 1 else ProcessPoolExecutor(max_workers=max_workers)
+    map_tasks = map if executor is None else executor.map
+    try:
+        for round_number, train_end in enumerate(origins, start=1):
+            tasks = [(endog, exog, order, train_end, horizon, fit_kwargs) for order in surviving]
+            for result in map_tasks(_evaluate_order_star, tasks):
+                fold_results[result['order']].append(result)
+
+            mean_errors = {order: np.mean([result['abs_error'] for result in fold_results[order]])
+                           for order in surviving}
+            finite_errors = [error for error in mean_errors.values() if np.isfinite(error)]
+            best_error = min(finite_errors) if finite_errors else np.nan
+            still_surviving = []
+            for order in surviving:
+                if not np.isfinite(mean_errors[order]) or mean_errors[order] > prune_factor * best_error:
+                    pruned_after[order] = round_number
+                else:
+                    still_surviving.append(order)
+            surviving = still_surviving
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    rows = []
+    for order in candidates:
+        results = fold_results[order]
+        fit_seconds = [result['fit_seconds'] for result in results]
+        rows.append(dict(order=order, p=order[0], d=order[1], q=order[2],
+                         mean_abs_error=np.mean([result['abs_error'] for result in results]),
+                         aic=results[0]['aic'], rounds=len(results), pruned_after=pruned_after.get(order),
+                         total_fit_seconds=np.sum(fit_seconds), mean_fit_seconds=np.mean(fit_seconds),
+                         status=results[-1]['status'], error=results[-1]['error']))
+    df_search = pd.DataFrame(rows)
+    df_search['completed'] = df_search['rounds'] == len(origins)
+    df_search = (df_search.sort_values(['completed', 'mean_abs_error'], ascending=[False, True], na_position='last')
+                 .drop(columns='completed').reset_index(drop=True))
+    df_search.insert(0, 'rank', np.arange(1, len(df_search) + 1))
+    return df_search
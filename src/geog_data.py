@@ -5,4 +5,296 @@
 # https://geoportal.statistics.gov.uk/
 
 # local authority districts combine lookup to regions here:
-# https://geoportal.statistics.gov.uk/datasets/ons::local-authority-district-to-region-april-2021-lookup-in-england/about
\ No newline at end of file
+# https://geoportal.statistics.gov.uk/datasets/ons::local-authority-district-to-region-april-2021-lookup-in-england/about
+"""The hierarchy of areas the feeds report on - ltla -> utla -> region -> nation -> overview - built from the LAD to
+region lookup (above) and the code_name_areatype_lookup covid_data saves, for rolling figures up from one level to
+another without merging on names. Also the simplified district shapes (from the LAD GeoJSON above) the dashboard's
+map draws, cached once per level of detail - see build_geometry_cache."""
+import json
+import os
+import shutil
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+LAD_REGION_LOOKUP_PATH = './shapefiles/Local_Authority_District_to_Region_(April_2021)_Lookup_in_England.csv'
+AREA_LOOKUP_PATH = './data/code_name_areatype_lookup.csv'
+LAD_GEOJSON_PATH = './shapefiles/Local_Authority_Districts_(December_2020)_UK_BGC.geojson'
+GEOMETRY_CACHE_DIR = './data/cache/geometry'
+# streamlit serves the files in here at app/static/ (with enableStaticServing on, see .streamlit/config.toml)
+STATIC_DIR = './static'
+
+# {level of detail: simplification tolerance}, in degrees as the GeoJSON is in WGS84 - 0.01 is roughly 1km
+SIMPLIFY_TOLERANCES = {'low': 0.01, 'medium': 0.002, 'high': 0.0005}
+# decimal places kept in the GeoJSON payload, 5 is roughly 1m
+COORDINATE_PRECISION = 5
+
+# the levels, lowest first. nhsRegions don't nest with these, so aren't part of the hierarchy
+LEVELS = ['ltla', 'utla', 'region', 'nation', 'overview']
+ENGLAND_CODE, UK_CODE = 'E92000001', 'K02000001'
+
+
+class AreaHierarchy(object):
+    """The areas as integer ids 0..n-1, held in arrays: code, name, level (an index into LEVELS) and parent (the id
+    of the area one level up, or the nearest level up that is known, -1 for none). So an ltla's parent is its utla
+    where that is known and its region otherwise - the lookups say which region every district is in, but not
+    which county. Lookups go through ids_for, and ancestor(level) gives every area's ancestor at a level at once."""
+    def __init__(self, codes, names, levels, parents):
+        self.code = np.asarray(codes, dtype=object)
+        self.name = np.asarray(names, dtype=object)
+        self.level = np.asarray(levels, dtype=np.int8)
+        self.parent = np.asarray(parents, dtype=np.int32)
+        self._index = pd.MultiIndex.from_arrays([self.level, self.code])
+        self._ancestors: Dict[int, np.ndarray] = dict()
+
+    def __len__(self):
+        return len(self.code)
+
+    @classmethod
+    def from_lookups(cls, area_lookup_path=AREA_LOOKUP_PATH, lad_region_lookup_path=LAD_REGION_LOOKUP_PATH,
+                     ltla_utla_lookup: Dict[str, str] = None) -> 'AreaHierarchy':
+        """Builds the hierarchy from the saved area lookup and the LAD to region lookup. "ltla_utla_lookup"
+        ({ltla code: utla code}) places districts in their counties, otherwise only unitary authorities (which are
+        both an ltla and a utla, under the same code) get a utla."""
+        df_areas = pd.read_csv(area_lookup_path)
+        df_lad_regions = pd.read_csv(lad_region_lookup_path, encoding='utf-8-sig')
+        df_areas = pd.concat([
+            df_areas[['code', 'name', 'areatype']],
+            df_lad_regions[['LAD21CD', 'LAD21NM']].set_axis(['code', 'name'], axis=1).assign(areatype='ltla'),
+            df_lad_regions[['RGN21CD', 'RGN21NM']].set_axis(['code', 'name'], axis=1).assign(areatype='region'),
+            pd.DataFrame(dict(code=[ENGLAND_CODE, UK_CODE], name=['England', 'United Kingdom'],
+                              areatype=['nation', 'overview']))])
+        df_areas = (df_areas[df_areas['areatype'].isin(LEVELS)].drop_duplicates(['areatype', 'code'])
+                    .reset_index(drop=True))
+        levels = df_areas['areatype'].map(LEVELS.index).to_numpy()
+        codes = df_areas['code'].to_numpy()
+
+        region_of = dict(zip(df_lad_regions['LAD21CD'], df_lad_regions['RGN21CD']))
+        ltla_utla_lookup = dict(ltla_utla_lookup or dict())
+        for ltla_code, utla_code in ltla_utla_lookup.items():
+            if utla_code not in region_of and ltla_code in region_of:
+                region_of[utla_code] = region_of[ltla_code]  # a county is in the region of its districts
+
+        # each area's parent is the first of these candidates which is in the hierarchy
+        ltla, utla, region, nation = (levels == LEVELS.index(level) for level in ['ltla', 'utla', 'region', 'nation'])
+        utlas = [ltla_utla_lookup.get(code, code) for code in codes]
+        regions = pd.Series(codes).map(region_of).to_numpy()
+        candidates = [
+            (np.where(ltla, LEVELS.index('utla'), -1), utlas),
+            (np.where(ltla | utla, LEVELS.index('region'), -1), regions),
+            (np.where(region, LEVELS.index('nation'), -1), np.full(len(codes), ENGLAND_CODE, dtype=object)),
+            (np.where(nation, LEVELS.index('overview'), -1), np.full(len(codes), UK_CODE, dtype=object))]
+        index = pd.MultiIndex.from_arrays([levels, codes])
+        parents = np.full(len(df_areas), -1, dtype=np.int32)
+        for parent_levels, parent_codes in candidates:
+            found = index.get_indexer(pd.MultiIndex.from_arrays([parent_levels, np.asarray(parent_codes, dtype=object)]))
+            parents = np.where((parents < 0) & (found >= 0), found, parents)
+        return cls(codes, df_areas['name'].to_numpy(), levels, parents)
+
+    def ids_for(self, areatypes, codes) -> np.ndarray:
+        """The ids of the (areatype, code) areas, -1 for any which aren't in the hierarchy"""
+        levels = pd.Series(np.asarray(areatypes, dtype=object)).map({level: LEVELS.index(level) for level in LEVELS})
+        return self._index.get_indexer(pd.MultiIndex.from_arrays([levels.fillna(-1).astype(int).to_numpy(),
+                                                                  np.asarray(codes, dtype=object)]))
+
+    def ancestor(self, level: str) -> np.ndarray:
+        """For every area, the id of its ancestor at 'level' (itself if it is at that level), -1 if it has none.
+        Worked out for all the areas at once by following the parent pointers up, one step per level."""
+        level_number = LEVELS.index(level)
+        if level_number not in self._ancestors:
+            current = np.arange(len(self), dtype=np.int32)
+            ancestors = np.full(len(self), -1, dtype=np.int32)
+            for _ in LEVELS:
+                found = (current >= 0) & (self.level[np.maximum(current, 0)] == level_number)
+                ancestors[found] = current[found]
+                current = np.where((current >= 0) & ~found, self.parent[np.maximum(current, 0)], -1)
+            self._ancestors[level_number] = ancestors
+        return self._ancestors[level_number]
+
+    def unplaced(self, level: str, from_level='ltla') -> pd.DataFrame:
+        """The areas at from_level which have no ancestor at level (i.e. ltlas whose codes have changed since
+        the lookup was made), which a roll up will leave out"""
+        missing = (self.level == LEVELS.index(from_level)) & (self.ancestor(level) < 0)
+        return pd.DataFrame(dict(code=self.code[missing], name=self.name[missing]))
+
+    def roll_up(self, df_feed: pd.DataFrame, value_columns: List[str], to_level='region', from_level='ltla',
+                how='sum') -> pd.DataFrame:
+        """Aggregates the from_level rows of a long-format feed up to to_level, by date, giving a feed in the same
+        long format (areatype, date, name, code, value_columns) plus the number of areas each row is made from.
+        Rows for areas the hierarchy can't place at to_level are left out (see unplaced)."""
+        df_feed = df_feed.reset_index() if 'code' not in df_feed.columns else df_feed
+        df_feed = df_feed[df_feed['areatype'] == from_level]
+        ids = self.ids_for(df_feed['areatype'], df_feed['code'])
+        ancestors = np.where(ids >= 0, self.ancestor(to_level)[ids], -1)
+        placed = ancestors >= 0
+
+        df_values = df_feed.loc[placed, value_columns].astype(float)
+        grouped = df_values.groupby([ancestors[placed], pd.to_datetime(df_feed.loc[placed, 'date']).to_numpy()])
+        df_rolled = (grouped.sum(min_count=1) if how == 'sum' else grouped.agg(how)).rename_axis(['id', 'date'])
+        df_rolled['areas'] = grouped.size()
+        ids = df_rolled.index.get_level_values('id').to_numpy()
+        return df_rolled.reset_index().assign(areatype=to_level, code=self.code[ids], name=self.name[ids])[
+            ['areatype', 'date', 'name', 'code'] + list(value_columns) + ['areas']]
+
+    def check_roll_up(self, df_feed: pd.DataFrame, df_published: pd.DataFrame, value_columns: List[str],
+                      to_level='region', from_level='ltla', tolerance=0.01) -> pd.DataFrame:
+        """Compares the from_level figures rolled up to to_level against the to_level feed as published, returning
+        the (code, date, metric)s where they differ by more than 'tolerance' (as a fraction of the published
+        figure). Areas which couldn't be rolled up at all are left out of the roll up - see unplaced for those."""
+        df_rolled = self.roll_up(df_feed, value_columns, to_level, from_level)
+        df_published = df_published.reset_index() if 'code' not in df_published.columns else df_published
+        df_published = df_published.assign(date=pd.to_datetime(df_published['date']),
+                                           code=df_published['code'].astype(str))
+        df_compared = (df_rolled.melt(id_vars=['code', 'name', 'date'], value_vars=value_columns, var_name='metric',
+                                      value_name='rolled_up')
+                       .merge(df_published.melt(id_vars=['code', 'date'], value_vars=value_columns,
+                                                var_name='metric', value_name='published'),
+                              on=['code', 'date', 'metric'], how='inner')
+                       .dropna(subset=['rolled_up', 'published']))
+        difference = (df_compared['rolled_up'] - df_compared['published']).abs()
+        df_compared['relative_difference'] = difference / df_compared['published'].abs().where(
+            df_compared['published'] != 0, 1)
+        return (df_compared[df_compared['relative_difference'] > tolerance]
+                .sort_values(['code', 'metric', 'date']).reset_index(drop=True))
+
+
+_hierarchy = None
+
+
+def area_hierarchy() -> AreaHierarchy:
+    """The AreaHierarchy from the default lookups, built the first time it is asked for"""
+    global _hierarchy
+    if _hierarchy is None:
+        _hierarchy = AreaHierarchy.from_lookups()
+    return _hierarchy
+
+
+def round_coordinates(coordinates, precision=COORDINATE_PRECISION):
+    """The (nested) GeoJSON coordinate lists, rounded to 'precision' decimal places"""
+    if isinstance(coordinates[0], (int, float)):
+        return [round(coordinate, precision) for coordinate in coordinates]
+    return [round_coordinates(part, precision) for part in coordinates]
+
+
+def source_version(path: str) -> dict:
+    file_stat = os.stat(path)
+    return dict(path=os.path.basename(path), size=file_stat.st_size, mtime_ns=file_stat.st_mtime_ns)
+
+
+def geometry_cache_paths(level: str, cache_dir=GEOMETRY_CACHE_DIR) -> Dict[str, str]:
+    return dict(parquet=f"{cache_dir}/lad_{level}.parquet", geojson=f"{cache_dir}/lad_{level}.geojson")
+
+
+def build_geometry_cache(geojson_path=LAD_GEOJSON_PATH, cache_dir=GEOMETRY_CACHE_DIR,
+                         tolerances: Dict[str, float] = None, code_column='LAD20CD', name_column='LAD20NM',
+                         precision=COORDINATE_PRECISION) -> dict:
+    """Simplifies the district shapes once for each level of detail in 'tolerances', and saves each level twice:
+        lad_<level>.parquet - the shapes as GeoParquet (WKB geometry) indexed by code, for notebooks
+        lad_<level>.geojson - the FeatureCollection plotly draws, each feature's id being its code, so a map only
+                              needs the codes and a values array per redraw
+    Needs geopandas, which reading the cache back (lad_geojson) doesn't. Returns the metadata it saves."""
+    import geopandas
+
+    tolerances = SIMPLIFY_TOLERANCES if tolerances is None else tolerances
+    gdf_shapes = geopandas.read_file(geojson_path)
+    if gdf_shapes.crs is not None:
+        gdf_shapes = gdf_shapes.to_crs(epsg=4326)
+    gdf_shapes = gdf_shapes.set_index(code_column)[[name_column, 'geometry']].rename(columns={name_column: 'name'})
+    gdf_shapes.index = gdf_shapes.index.rename('code')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    metadata = dict(source=source_version(geojson_path), tolerances=dict(tolerances), precision=precision, levels={})
+    for level, tolerance in tolerances.items():
+        paths = geometry_cache_paths(level, cache_dir)
+        gdf_simplified = gdf_shapes.assign(geometry=gdf_shapes.geometry.simplify(tolerance, preserve_topology=True))
+
+        temporary_path = f"{paths['parquet']}.{os.getpid()}.tmp"
+        gdf_simplified.to_parquet(temporary_path)
+        os.replace(temporary_path, paths['parquet'])
+
+        features = [dict(type='Feature', id=code, properties=dict(name=name),
+                         geometry=dict(type=geometry.geom_type,
+                                       coordinates=round_coordinates(geometry.__geo_interface__['coordinates'],
+                                                                     precision)))
+                    for code, name, geometry in zip(gdf_simplified.index, gdf_simplified['name'],
+                                                    gdf_simplified.geometry)
+                    if geometry is not None and not geometry.is_empty]
+        temporary_path = f"{paths['geojson']}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as geojson_file:
+            json.dump(dict(type='FeatureCollection', features=features), geojson_file, separators=(',', ':'))
+        os.replace(temporary_path, paths['geojson'])
+        metadata['levels'][level] = dict(features=len(features), vertices=int(
+            gdf_simplified.geometry.count_coordinates().sum()), geojson_bytes=os.path.getsize(paths['geojson']))
+
+    with open(f"{cache_dir}/metadata.json", 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+    return metadata
+
+
+def geometry_cache_is_current(geojson_path=LAD_GEOJSON_PATH, cache_dir=GEOMETRY_CACHE_DIR,
+                              tolerances: Dict[str, float] = None) -> bool:
+    """Whether the cache was built from the GeoJSON as it is now, at the same tolerances. Without the GeoJSON
+    (which isn't committed) an existing cache is taken as current."""
+    tolerances = SIMPLIFY_TOLERANCES if tolerances is None else tolerances
+    try:
+        with open(f"{cache_dir}/metadata.json") as metadata_file:
+            metadata = json.load(metadata_file)
+    except FileNotFoundError:
+        return False
+    if metadata['tolerances'] != dict(tolerances) or not all(
+            os.path.exists(geometry_cache_paths(level, cache_dir)['geojson']) for level in tolerances):
+        return False
+    return not os.path.exists(geojson_path) or metadata['source'] == source_version(geojson_path)
+
+
+_geojson: Dict[str, dict] = dict()
+
+
+def geometry_available(geojson_path=LAD_GEOJSON_PATH, cache_dir=GEOMETRY_CACHE_DIR) -> bool:
+    """Whether lad_geojson can give the shapes - either the cache or the GeoJSON to build it from is there"""
+    return os.path.exists(geojson_path) or geometry_cache_is_current(geojson_path, cache_dir)
+
+
+def lad_geojson(level='low', geojson_path=LAD_GEOJSON_PATH, cache_dir=GEOMETRY_CACHE_DIR) -> dict:
+    """The simplified district shapes at a level of detail (one of SIMPLIFY_TOLERANCES) as a GeoJSON
+    FeatureCollection whose feature ids are the LAD20CD codes, ready to pass to plotly. Read from the cache once per
+    process, (re)building the cache first if it is missing or older than the GeoJSON."""
+    path = geometry_cache_paths(level, cache_dir)['geojson']
+    if path not in _geojson:
+        if not geometry_cache_is_current(geojson_path, cache_dir):
+            build_geometry_cache(geojson_path, cache_dir)
+        with open(path) as geojson_file:
+            _geojson[path] = json.load(geojson_file)
+    return _geojson[path]
+
+
+def static_geojson(level='low', static_dir=STATIC_DIR, geojson_path=LAD_GEOJSON_PATH,
+                   cache_dir=GEOMETRY_CACHE_DIR) -> str:
+    """Puts a copy of the cached GeoJSON for a level of detail in streamlit's static folder (if the one there is
+    missing or older) and returns the URL it is served at, for a plotly choropleth's geojson. The browser then
+    fetches the shapes itself, once, and the figures the dashboard sends only carry the codes and values."""
+    if not geometry_cache_is_current(geojson_path, cache_dir):
+        build_geometry_cache(geojson_path, cache_dir)
+    source_path = geometry_cache_paths(level, cache_dir)['geojson']
+    static_path = f"{static_dir}/lad_{level}.geojson"
+    if not os.path.exists(static_path) or os.path.getmtime(static_path) < os.path.getmtime(source_path):
+        os.makedirs(static_dir, exist_ok=True)
+        temporary_path = f"{static_path}.{os.getpid()}.tmp"
+        shutil.copyfile(source_path, temporary_path)
+        os.replace(temporary_path, static_path)
+    # the version stops the browser using a copy of the shapes from before the cache was rebuilt
+    return f"app/static/lad_{level}.geojson?v={os.stat(source_path).st_mtime_ns}"
+
+
+def lad_geometry(level='low', cache_dir=GEOMETRY_CACHE_DIR):
+    """The simplified district shapes at a level of detail as a GeoDataFrame indexed by code (needs geopandas)"""
+    import geopandas
+    return geopandas.read_parquet(geometry_cache_paths(level, cache_dir)['parquet'])
+
+
+def choropleth_values(geojson: dict, values: pd.Series) -> np.ndarray:
+    """'values' (indexed by code) in the order of the GeoJSON's features, NaN for areas without a value - so a
+    map of new figures over the same shapes is just this array"""
+    codes = [feature['id'] for feature in geojson['features']]
+    return values.groupby(level=0).last().reindex(codes).to_numpy(dtype=float)
@@ -1,48 +1,142 @@
-import pandas as pd
+import csv
+import glob
 import os
+import sys
+from typing import Dict, Iterable, List
+
+import pandas as pd
+import pyarrow as pa
 import pyspark.sql
+import pyspark.sql.functions as f
+import pyspark.sql.types as T
+
+from src import schema_tools
+from src import storage_tools
+
+
+# local mode settings, sized for our feeds (a few hundred MB at most) rather than spark's cluster defaults -
+# 200 shuffle partitions would be mostly empty tasks
+SPARK_CORES = '*'
+SPARK_SHUFFLE_PARTITIONS = 8
+SPARK_DRIVER_MEMORY = '2g'
+SPARK_CONFIG = {'spark.ui.enabled': 'false',
+                'spark.sql.execution.arrow.pyspark.enabled': 'true'}
+
+_spark = None
 
 
 def python_location():
-    """work out the location of the python interpretter - this is needed for Pyspark to initialise"""
-    import subprocess
-    import pathlib
-    with subprocess.Popen("where python", shell=True, stdout=subprocess.PIPE) as subprocess_return:
-        python_exe_paths = subprocess_return.stdout.read().decode('utf-8').split('\r\n')
-        env_path = pathlib.Path([x for x in python_exe_paths if '\\envs\\' in x][0])
-    return str(env_path)
-
-
-def initialise_spark():
-    """This function creates a spark session if one doesn't already exist (i.e. within databricks this will do nothing)"""
-    if 'spark' not in locals():
+    """work out the location of the python interpretter - this is needed for Pyspark to initialise. It is the one
+    running this code, unless PYSPARK_PYTHON already says otherwise"""
+    return os.environ.get("PYSPARK_PYTHON", sys.executable)
+
+
+def initialise_spark(cores=SPARK_CORES, shuffle_partitions=SPARK_SHUFFLE_PARTITIONS,
+                     driver_memory=SPARK_DRIVER_MEMORY, config: Dict[str, str] = None) -> pyspark.sql.SparkSession:
+    """This function creates a spark session if one doesn't already exist (i.e. within databricks this will do nothing).
+    The session is only created the first time this is called - importing this module doesn't start a JVM - and is
+    then reused for the rest of the process, so the settings only apply to that first call."""
+    global _spark
+    if _spark is None:
+        _spark = pyspark.sql.SparkSession.getActiveSession()
+    if _spark is None:
         os.environ["PYSPARK_PYTHON"] = python_location()
-        spark = pyspark.sql.SparkSession.builder.getOrCreate()
-        spark.sparkContext.setLogLevel("ERROR")
-    return spark
+        builder = (pyspark.sql.SparkSession.builder.master(f"local[{cores}]")
+                   .config('spark.sql.shuffle.partitions', shuffle_partitions)
+                   .config('spark.driver.memory', driver_memory))
+        for key, value in dict(SPARK_CONFIG, **(config or dict())).items():
+            builder = builder.config(key, value)
+        _spark = builder.getOrCreate()
+        _spark.sparkContext.setLogLevel("ERROR")
+    return _spark
+
+
+def spark_type(column: str) -> T.DataType:
+    """The spark type a saved feed column is read as. Dates are saved as yyyy-MM-dd (csv) or timestamps
+    (parquet), the area names/codes, age breakdowns and other labels as strings, and the metrics - which the
+    csvs hold as floats, i.e. "240.0" - as doubles."""
+    if column == 'date':
+        return T.DateType()
+    if column in schema_tools.FIELD_DTYPES:
+        return T.DoubleType() if schema_tools.FIELD_DTYPES[column] in ('Int32', 'float32') else T.StringType()
+    return T.StringType() if pa.types.is_string(storage_tools.FIELD_TYPES.get(column, pa.float64())) else T.DoubleType()
+
+
+def spark_schema(columns: Iterable[str]) -> T.StructType:
+    """The explicit schema for a feed with the given columns (see spark_type), so reading a csv doesn't need
+    the extra full pass over the file that inferSchema costs"""
+    return T.StructType([T.StructField(column, spark_type(column), nullable=True) for column in columns])
+
+
+def csv_columns(path: str) -> List[str]:
+    """The header of a csv file, or of the first part file in a directory of them (as spark writes)"""
+    if os.path.isdir(path):
+        path = sorted(glob.glob(f"{path}/part-*.csv") + glob.glob(f"{path}/part-*.csv.*"))[0]
+    with open(path) as csv_file:
+        return next(csv.reader(csv_file))
 
 
 class DataStore(object):
     """this class acts as a middle man between the ETL processes and wherever the data is being stored.
-    Iniially this will just be locally in CSV files"""
-    def __init__(self, source='local', data_format='csv', spark_session=initialise_spark()):
+    Iniially this will just be locally in CSV files, or in partitioned parquet tables laid out like
+    the storage_tools datasets - areatype=<areatype>/month=<yyyy-MM>/part-....parquet - which are written by the
+    executors and pruned by areatype and date on read"""
+    def __init__(self, source='local', data_format='csv', spark_session: pyspark.sql.SparkSession = None):
         self.source = source
         self.format = data_format
-        self.spark = spark_session
+        self._spark = spark_session
+
+    @property
+    def spark(self) -> pyspark.sql.SparkSession:
+        """the session given, or else the process' one (see initialise_spark), started on first use"""
+        if self._spark is None:
+            self._spark = initialise_spark()
+        return self._spark
 
-    def get_table(self, table_name):
-        """Extract the 'table_name' data from the 'source' (where it is stored in the specified 'format'"""
+    def get_table(self, table_name, columns: List[str] = None, areatypes: List[str] = None, date_from=None,
+                  date_to=None) -> pyspark.sql.DataFrame:
+        """Extract the 'table_name' data from the 'source' (where it is stored in the specified 'format').
+        csvs are read with an explicit schema (see spark_schema) rather than inferring one. For parquet
+        the areatype and date filters prune whole partitions (and row groups) before anything is read."""
         if self.source=='local' and self.format == 'csv':
-            #pdf_table = pd.read_csv(table_name)
-            #sdf_table = self.spark.createDataFrame(pdf_table)
-            sdf_table = self.spark.read.load(table_name, format='csv', sep=',', inferSchema='true',header='true')
+            sdf_table = self.spark.read.csv(table_name, schema=spark_schema(csv_columns(table_name)), header=True,
+                                            sep=',')
+        elif self.source=='local' and self.format == 'parquet':
+            # the areatype=/month= directories come back as columns, and filters on them prune the partitions
+            sdf_table = self.spark.read.parquet(table_name)
+        else:
+            raise ValueError(f"unsupported source/format: {self.source}/{self.format}")
+
+        has_month = 'month' in sdf_table.columns
+        if areatypes is not None:
+            sdf_table = sdf_table.filter(f.col('areatype').isin(list(areatypes)))
+        if date_from is not None:
+            date_from = pd.Timestamp(date_from)
+            if has_month:
+                sdf_table = sdf_table.filter(f.col('month') >= f"{date_from:%Y-%m}")
+            sdf_table = sdf_table.filter(f.col('date') >= f.lit(date_from.date()))
+        if date_to is not None:
+            date_to = pd.Timestamp(date_to)
+            if has_month:
+                sdf_table = sdf_table.filter(f.col('month') <= f"{date_to:%Y-%m}")
+            sdf_table = sdf_table.filter(f.col('date') <= f.lit(date_to.date()))
+        if columns is not None:
+            sdf_table = sdf_table.select(*columns)
 
         return sdf_table
 
-    def save_table(self, sdf, table_name):
-        """save the 'table_name' to the 'source' in the specified 'format'"""
+    def save_table(self, sdf, table_name, partition_columns: List[str] = None):
+        """save the 'table_name' to the 'source' in the specified 'format'. The executors each write their own
+        part files - nothing is collected onto the driver. parquet tables are partitioned by
+        'partition_columns' (storage_tools.PARTITION_COLUMNS, areatype and month, by default), with the data
+        shuffled so each partition is written by one task rather than as a scatter of small files."""
         if self.source=='local' and self.format == 'csv':
-            # Need to take a dataframe and save it in the required format or whatever.
-            #sdf.repartition(1).write.csv(table_name) # struggling to get this to work
-            sdf.toPandas().to_csv(table_name, index=False, sep=',')
-
+            sdf.write.mode('overwrite').csv(table_name, header=True, sep=',')
+        elif self.source=='local' and self.format == 'parquet':
+            partition_columns = storage_tools.PARTITION_COLUMNS if partition_columns is None else partition_columns
+            if 'month' in partition_columns and 'month' not in sdf.columns:
+                sdf = sdf.withColumn('month', f.date_format('date', 'yyyy-MM'))
+            (sdf.repartition(*partition_columns).write.partitionBy(*partition_columns)
+             .mode('overwrite').parquet(table_name))
+        else:
+            raise ValueError(f"unsupported source/format: {self.source}/{self.format}")
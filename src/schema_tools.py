@@ -0,0 +1,136 @@
+"""The in-memory dtypes for the NHSE API fields.
+
+The feeds are mostly repeats of a handful of area names and codes plus whole-number counts, so holding them as
+object strings and float64 wastes most of the memory they take up. Every loader runs its frames through
+apply_schema, which makes
+    date                    -> datetime64
+    areatype, name, code    -> category
+    *Rate fields            -> float32
+    everything else (counts)-> nullable Int32
+and english_only filters on the (few hundred) code categories rather than running a regex over every row.
+"""
+from typing import Dict, Iterable
+
+import numpy as np
+import pandas as pd
+
+# the columns get_paginated_dataset pulls by default: {column name it comes out as: API field name}
+API_STRUCTURE = {'date': 'date',
+                 'areatype': 'areaType',
+                 'name': 'areaName',
+                 'code': 'areaCode',
+                 'newCasesByPublishDate': 'newCasesByPublishDate',
+                 'cumCasesByPublishDate': 'cumCasesByPublishDate',
+                 'cumCasesBySpecimenDateRate': 'cumCasesBySpecimenDateRate',
+                 'newCasesBySpecimenDate': 'newCasesBySpecimenDate',
+                 'cumCasesBySpecimenDate': 'cumCasesBySpecimenDate',
+                 'maleCases': 'maleCases',
+                 'femaleCases': 'femaleCases',
+                 'newPillarOneTestsByPublishDate': 'newPillarOneTestsByPublishDate',
+                 'cumPillarOneTestsByPublishDate': 'cumPillarOneTestsByPublishDate',
+                 'newPillarTwoTestsByPublishDate': 'newPillarTwoTestsByPublishDate',
+                 'cumPillarTwoTestsByPublishDate': 'cumPillarTwoTestsByPublishDate',
+                 'newPillarThreeTestsByPublishDate': 'newPillarThreeTestsByPublishDate',
+                 'cumPillarThreeTestsByPublishDate': 'cumPillarThreeTestsByPublishDate',
+                 'newPillarFourTestsByPublishDate': 'newPillarFourTestsByPublishDate',
+                 'cumPillarFourTestsByPublishDate': 'cumPillarFourTestsByPublishDate',
+                 'newAdmissions': 'newAdmissions',
+                 'cumAdmissions': 'cumAdmissions',
+                 'cumAdmissionsByAge': 'cumAdmissionsByAge',
+                 'cumTestsByPublishDate': 'cumTestsByPublishDate',
+                 'newTestsByPublishDate': 'newTestsByPublishDate',
+                 'covidOccupiedMVBeds': 'covidOccupiedMVBeds',
+                 'hospitalCases': 'hospitalCases',
+                 'plannedCapacityByPublishDate': 'plannedCapacityByPublishDate',
+                 'newDeaths28DaysByPublishDate': 'newDeaths28DaysByPublishDate',
+                 'cumDeaths28DaysByPublishDate': 'cumDeaths28DaysByPublishDate',
+                 'cumDeaths28DaysByPublishDateRate': 'cumDeaths28DaysByPublishDateRate',
+                 'newDeaths28DaysByDeathDate': 'newDeaths28DaysByDeathDate',
+                 'cumDeaths28DaysByDeathDate': 'cumDeaths28DaysByDeathDate',
+                 'cumDeaths28DaysByDeathDateRate': 'cumDeaths28DaysByDeathDateRate'}
+
+AREA_COLUMNS = ['areatype', 'name', 'code']
+# the age breakdowns are nested lists (or their csv strings) - see covid_data.make_age_table
+AGE_FIELDS = ['maleCases', 'femaleCases', 'cumAdmissionsByAge']
+
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def field_dtype(field: str):
+    """The in-memory dtype for one API field (None for fields which are left as they are)"""
+    if field == 'date':
+        return 'datetime64[ns]'
+    if field in AREA_COLUMNS:
+        return 'category'
+    if field in AGE_FIELDS:
+        return None
+    if field.endswith('Rate'):
+        return 'float32'
+    return 'Int32'
+
+
+FIELD_DTYPES = {field: field_dtype(field) for field in API_STRUCTURE}
+
+
+def to_count(column: pd.Series) -> pd.Series:
+    """Converts a count column to nullable Int32, falling back to float32 if it holds anything which isn't a
+    whole number that fits in 32 bits"""
+    values = pd.to_numeric(column, errors='coerce')
+    known = values.dropna()
+    if ((known % 1) != 0).any() or (known.abs() > INT32_MAX).any():
+        return values.astype('float32')
+    return values.astype('Int32')
+
+
+def apply_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """Returns df with each of its API fields converted to the FIELD_DTYPES dtype. Columns which aren't API
+    fields (and the index) are left alone."""
+    converted = dict()
+    for column in df.columns:
+        dtype = FIELD_DTYPES.get(column)
+        if dtype is None or df[column].dtype == dtype:
+            continue
+        if dtype == 'Int32':
+            converted[column] = to_count(df[column])
+        elif dtype == 'float32':
+            converted[column] = pd.to_numeric(df[column], errors='coerce').astype('float32')
+        elif dtype == 'datetime64[ns]':
+            converted[column] = pd.to_datetime(df[column]).astype('datetime64[ns]')
+        else:
+            converted[column] = df[column].astype(dtype)
+    return df.assign(**converted) if converted else df
+
+
+def concat_feeds(frames: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """pd.concat for feeds which have been through apply_schema. pd.concat turns categoricals back into object
+    strings unless every frame has the same categories, so the categories are unioned first."""
+    frames = list(frames)
+    for column in AREA_COLUMNS:
+        if not all(column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype) for df in frames):
+            continue
+        categories = pd.api.types.union_categoricals([df[column].array for df in frames]).categories
+        frames = [df.assign(**{column: df[column].cat.set_categories(categories)}) for df in frames]
+    return pd.concat(frames, axis=0, sort=False)
+
+
+def english_only(df: pd.DataFrame, code_column='code') -> pd.DataFrame:
+    """The rows of df whose area code isn't Welsh, Scottish or Northern Irish (i.e. doesn't contain W, S or N).
+    The codes are only checked once per category, then rows are picked out through their category numbers."""
+    codes = df[code_column]
+    if not isinstance(codes.dtype, pd.CategoricalDtype):
+        codes = codes.astype('category')
+    categories = codes.cat.categories.astype(str)
+    # missing codes are category number -1, which picks out the False on the end
+    keep = np.append(~categories.str.contains('[WSN]', regex=True), False)
+    return df[keep[codes.cat.codes.to_numpy()]]
+
+
+def memory_report(frames: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """The in-memory size of each frame (in MB) as loaded, and after apply_schema"""
+    rows = []
+    for name, df in frames.items():
+        before = df.memory_usage(deep=True).sum() / 1e6
+        after = apply_schema(df).memory_usage(deep=True).sum() / 1e6
+        rows.append(dict(frame=name, rows=len(df), before_mb=before, after_mb=after, saving=1 - after / before))
+    return pd.DataFrame(rows).set_index('frame')
+
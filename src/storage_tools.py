@@ -0,0 +1,149 @@
+"""Columnar (parquet) storage for the NHSE API feeds.
+
+Each feed is saved as a hive-partitioned parquet dataset, i.e.
+    data/parquet/england_nhse/areatype=nation/month=2020-03/england_nhse-0.parquet
+so readers can skip whole areatypes and months without opening them, and only read the columns they ask for.
+The directories can be read straight back by Spark too (see pyspark_tools.DataStore).
+"""
+import os
+import shutil
+from typing import Iterable, List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+DEFAULT_ROOT = './data/parquet'
+
+PARTITION_COLUMNS = ['areatype', 'month']
+PARTITIONING = ds.partitioning(pa.schema([('areatype', pa.string()), ('month', pa.string())]), flavor='hive')
+
+# anything in a feed not listed here is a numeric metric, stored as float64. Dates are microsecond timestamps, as
+# spark can't read nanosecond ones
+FIELD_TYPES = {'date': pa.timestamp('us'),
+               'areatype': pa.string(),
+               'month': pa.string(),
+               'name': pa.string(),
+               'code': pa.string(),
+               'maleCases': pa.string(),
+               'femaleCases': pa.string(),
+               'cumAdmissionsByAge': pa.string(),
+               'metric': pa.string(),
+               'sex': pa.string(),
+               'age_band': pa.string()}
+
+
+def feed_schema(columns: Iterable[str]) -> pa.Schema:
+    """The explicit arrow schema for a feed with the given columns"""
+    return pa.schema([(column, FIELD_TYPES.get(column, pa.float64())) for column in columns])
+
+
+def dataset_path(dataset_name: str, root: str = DEFAULT_ROOT) -> str:
+    return f"{root}/{dataset_name}"
+
+
+def write_feed(df_feed: pd.DataFrame, dataset_name: str, root: str = DEFAULT_ROOT) -> str:
+    """Saves a (cleaned) feed as a parquet dataset partitioned by areatype and month, replacing whatever
+    was saved under that dataset_name before. Returns the path of the dataset."""
+    df_feed = df_feed.reset_index() if 'date' not in df_feed.columns else df_feed.copy()
+    df_feed['date'] = pd.to_datetime(df_feed['date'])
+    df_feed['month'] = df_feed['date'].dt.strftime('%Y-%m')
+    df_feed = df_feed.sort_values([column for column in ['code', 'date'] if column in df_feed.columns])
+
+    table = pa.Table.from_pandas(df_feed, schema=feed_schema(df_feed.columns), preserve_index=False)
+
+    path = dataset_path(dataset_name, root)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    ds.write_dataset(table, path, format='parquet', partitioning=PARTITIONING,
+                     basename_template=f"{dataset_name}-{{i}}.parquet")
+    return path
+
+
+def feed_record_batch(df_batch: pd.DataFrame, schema: pa.Schema) -> pa.RecordBatch:
+    """A batch of feed rows (i.e. one page from the API) as an arrow batch with the given schema. Columns the
+    batch doesn't have are filled with nulls, and the nested age breakdowns are stored in their string form,
+    as they are in the csvs."""
+    dates = pd.to_datetime(df_batch['date'])
+    columns = dict(date=dates, month=dates.to_numpy().astype('datetime64[M]').astype(str))
+    for column in schema.names:
+        if column in columns:
+            continue
+        if column not in df_batch.columns:
+            columns[column] = None
+        elif pa.types.is_string(schema.field(column).type) and df_batch[column].dtype == object:
+            columns[column] = df_batch[column].map(lambda value: str(value) if isinstance(value, (list, dict)) else value)
+        else:
+            columns[column] = df_batch[column]
+    df_batch = pd.DataFrame(columns, index=df_batch.index)[schema.names]
+    return pa.RecordBatch.from_pandas(df_batch, schema=schema, preserve_index=False)
+
+
+def write_feed_batches(batches: Iterable[pd.DataFrame], dataset_name: str, columns: Iterable[str],
+                       root: str = DEFAULT_ROOT) -> str:
+    """Streams batches of feed rows (all with the given columns) into a parquet dataset laid out like write_feed's,
+    replacing whatever was saved under that dataset_name before. Each batch is written out as it comes, so only
+    one is held in memory at a time - the rows aren't sorted on disk, but read_feed sorts them as it reads.
+    Returns the path of the dataset."""
+    schema = feed_schema([column for column in columns if column != 'month'] + ['month'])
+
+    path = dataset_path(dataset_name, root)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    ds.write_dataset((feed_record_batch(df_batch, schema) for df_batch in batches if len(df_batch) > 0), path,
+                     schema=schema, format='parquet', partitioning=PARTITIONING,
+                     basename_template=f"{dataset_name}-{{i}}.parquet")
+    return path
+
+
+def feed_columns(dataset_name: str, root: str = DEFAULT_ROOT) -> List[str]:
+    """The columns held in a saved feed (without opening any of the data)"""
+    dataset = ds.dataset(dataset_path(dataset_name, root), format='parquet', partitioning=PARTITIONING)
+    return [column for column in dataset.schema.names if column != 'month']
+
+
+def read_feed(dataset_name: str, root: str = DEFAULT_ROOT, columns: List[str] = None, areatypes: List[str] = None,
+              date_from=None, date_to=None) -> pd.DataFrame:
+    """Loads a feed saved by write_feed. Only the requested columns are read, and the areatype and date
+    filters are pushed down into the reader - partitions outside them are never opened, and row groups
+    outside the date range are skipped using the parquet statistics."""
+    dataset = ds.dataset(dataset_path(dataset_name, root), format='parquet', partitioning=PARTITIONING)
+
+    filter_expression = None
+    conditions = []
+    if areatypes is not None:
+        conditions.append(ds.field('areatype').isin(list(areatypes)))
+    if date_from is not None:
+        date_from = pd.Timestamp(date_from)
+        conditions += [ds.field('month') >= f"{date_from:%Y-%m}", ds.field('date') >= date_from]
+    if date_to is not None:
+        date_to = pd.Timestamp(date_to)
+        conditions += [ds.field('month') <= f"{date_to:%Y-%m}", ds.field('date') <= date_to]
+    for condition in conditions:
+        filter_expression = condition if filter_expression is None else filter_expression & condition
+
+    if columns is None:
+        columns = feed_columns(dataset_name, root)
+    df_feed = dataset.to_table(columns=list(columns), filter=filter_expression).to_pandas()[list(columns)]
+
+    sort_columns = [column for column in ['code', 'date'] if column in df_feed.columns]
+    if sort_columns:
+        df_feed = df_feed.sort_values(sort_columns)
+    return df_feed.reset_index(drop=True)
+
+
+def convert_csv_feeds(data_dir: str = './data', root: str = DEFAULT_ROOT) -> List[str]:
+    """One-off conversion of every "<dataset_name>_feed.csv" in data_dir into a parquet dataset under root"""
+    converted = []
+    for file_name in sorted(os.listdir(data_dir)):
+        if not file_name.endswith('_feed.csv'):
+            continue
+        dataset_name = file_name[:-len('_feed.csv')]
+        df_feed = pd.read_csv(f"{data_dir}/{file_name}", parse_dates=['date'])
+        converted.append(write_feed(df_feed, dataset_name, root))
+        print(f"{file_name} -> {converted[-1]}")
+    return converted
+
+
+if __name__ == '__main__':
+    convert_csv_feeds()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import src.cache_tools
+import src.fetch_tools
+
+
+class StubServerHandler(BaseHTTPRequestHandler):
+    """Serves "/found" with an ETag (answering a matching If-None-Match with a 304) and a 404 for anything else"""
+    etag = '"v1"'
+    requests_seen = []
+
+    def do_GET(self):
+        self.requests_seen.append(self.path)
+        if not self.path.startswith('/found'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = f"content {self.etag}".encode()
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self) -> None:
+        StubServerHandler.requests_seen = []
+        StubServerHandler.etag = '"v1"'
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubServerHandler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.cache_dir = tempfile.mkdtemp()
+        self.session = src.fetch_tools.make_session(pool_size=1)
+
+    def tearDown(self) -> None:
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_fresh_responses_come_from_the_cache(self):
+        cache = src.cache_tools.ResponseCache(self.cache_dir)
+
+        responses = [cache.get(self.session, f"{self.base_url}/found", params=dict(page=1)) for _ in range(3)]
+
+        self.assertEqual([response.text for response in responses], ['content "v1"'] * 3)
+        self.assertEqual(len(StubServerHandler.requests_seen), 1)
+        self.assertEqual(cache.stats, dict(miss=1, hit=2))
+
+    def test_cache_dir_is_made_on_the_first_store(self):
+        cache = src.cache_tools.ResponseCache(f"{self.cache_dir}/http")
+        self.assertFalse(os.path.exists(cache.cache_dir))
+
+        cache.get(self.session, f"{self.base_url}/found")
+        self.assertTrue(os.path.isdir(cache.cache_dir))
+        self.assertIsNotNone(cache.load(cache.key(f"{self.base_url}/found")))
+
+    def test_stale_responses_are_revalidated(self):
+        cache = src.cache_tools.ResponseCache(self.cache_dir, ttls=dict(default=0))
+
+        cache.get(self.session, f"{self.base_url}/found")
+        self.assertEqual(cache.get(self.session, f"{self.base_url}/found").text, 'content "v1"')
+        StubServerHandler.etag = '"v2"'
+        self.assertEqual(cache.get(self.session, f"{self.base_url}/found").text, 'content "v2"')
+
+        self.assertEqual(cache.stats, dict(miss=2, revalidated=1))
+
+    def test_not_found_is_remembered(self):
+        cache = src.cache_tools.ResponseCache(self.cache_dir)
+
+        for _ in range(3):
+            self.assertEqual(cache.get(self.session, f"{self.base_url}/missing", source='apple_mobility').status_code, 404)
+
+        self.assertEqual(len(StubServerHandler.requests_seen), 1)
+        self.assertEqual(cache.stats, dict(negative_miss=1, negative_hit=2))
+
+    def test_least_recently_used_are_evicted(self):
+        cache = src.cache_tools.ResponseCache(self.cache_dir, max_bytes=30, evict_every=1)
+
+        for page in range(1, 4):
+            cache.get(self.session, f"{self.base_url}/found", params=dict(page=page))
+        cache.get(self.session, f"{self.base_url}/found", params=dict(page=3))
+
+        self.assertIsNone(cache.load(cache.key(f"{self.base_url}/found", dict(page=1))))
+        self.assertIsNotNone(cache.load(cache.key(f"{self.base_url}/found", dict(page=3))))
+        self.assertEqual(cache.stats['hit'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
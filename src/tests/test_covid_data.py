@@ -0,0 +1,408 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+import zipfile
+
+import numpy as np
+import pandas as pd
+import scipy.interpolate
+
+import covid_data
+
+
+def make_feed(dates, codes=('E12000001', 'E12000002'), value=1.0):
+    """Make a raw (uncleaned) region feed, as it comes back from the API"""
+    return pd.DataFrame([dict(date=f"{date:%Y-%m-%d}", areatype='region', name=f"region {code}", code=code,
+                              newCasesByPublishDate=value)
+                         for date in pd.to_datetime(list(dates)) for code in codes])
+
+
+class TestIncrementalFeedUpdate(unittest.TestCase):
+    def setUp(self) -> None:
+        self.data_directory = tempfile.mkdtemp()
+        self.today = pd.Timestamp.today().normalize()
+        self.stored_dates = pd.date_range(self.today - pd.Timedelta(days=30), self.today - pd.Timedelta(days=3))
+        covid_data.clean_data(make_feed(self.stored_dates)).to_csv(f"{self.data_directory}/region_nhse_feed.csv")
+
+    def tearDown(self) -> None:
+        os.remove(f"{self.data_directory}/region_nhse_feed.csv")
+        os.rmdir(self.data_directory)
+
+    def fake_api(self, filters, *args, **kwargs):
+        """Returns a single day of revised data (value=2) for whatever date the filters ask for"""
+        date = [f for f in filters if f.startswith('date=')][0].split('=')[1]
+        return make_feed([date], value=2.0)
+
+    def test_only_recent_dates_are_pulled(self):
+        with unittest.mock.patch.object(covid_data, 'get_paginated_dataset', side_effect=self.fake_api) as api:
+            covid_data.incremental_feed_update('region_nhse', self.data_directory, revision_days=2)
+
+        pulled_dates = sorted(call.args[0][-1] for call in api.call_args_list)
+        self.assertEqual(pulled_dates[0], f"date={self.today - pd.Timedelta(days=5):%Y-%m-%d}")
+        self.assertEqual(pulled_dates[-1], f"date={self.today:%Y-%m-%d}")
+
+    def test_revisions_replace_stored_records(self):
+        with unittest.mock.patch.object(covid_data, 'get_paginated_dataset', side_effect=self.fake_api):
+            df_merged = covid_data.incremental_feed_update('region_nhse', self.data_directory, revision_days=2)
+
+        df_merged = df_merged.reset_index()
+        self.assertFalse(df_merged.duplicated(['areatype', 'date', 'code']).any())
+        self.assertEqual(df_merged['date'].nunique(), 31)
+        revised = df_merged['date'] >= self.today - pd.Timedelta(days=5)
+        self.assertTrue((df_merged.loc[revised, 'newCasesByPublishDate'] == 2).all())
+        self.assertTrue((df_merged.loc[~revised, 'newCasesByPublishDate'] == 1).all())
+
+    def test_stale_areas_are_ignored(self):
+        df_feed = pd.concat([make_feed(self.stored_dates),
+                             make_feed([self.today - pd.Timedelta(days=60)], codes=['E07000001'])]).reset_index(drop=True)
+
+        start_date = covid_data.refresh_start_date(df_feed, revision_days=0)
+
+        self.assertEqual(start_date, self.stored_dates[-1])
+
+
+class TestGetData(unittest.TestCase):
+    def setUp(self) -> None:
+        self.data_directory = tempfile.mkdtemp()
+        self.feed_path = f"{self.data_directory}/region_nhse_feed.csv"
+        covid_data.clean_data(make_feed(pd.date_range('2021-01-01', '2021-01-10'))).to_csv(self.feed_path)
+
+    def tearDown(self) -> None:
+        os.remove(self.feed_path)
+        os.rmdir(self.data_directory)
+
+    def test_files_load_lazily_and_are_cached(self):
+        data_pack = covid_data.get_data(self.data_directory)
+        self.assertEqual(list(data_pack), ['region_nhse_feed'])
+
+        with unittest.mock.patch.object(covid_data.pd, 'read_csv', wraps=pd.read_csv) as read_csv:
+            data_pack = covid_data.get_data(self.data_directory, columns=['newCasesByPublishDate'])
+            read_csv.assert_not_called()
+            df_first = data_pack['region_nhse_feed']
+            df_second = data_pack['region_nhse_feed']
+
+        self.assertIs(df_first, df_second)
+        self.assertEqual(read_csv.call_count, 2)  # the header, then the data
+
+    def test_cache_invalidated_when_file_changes(self):
+        df_before = covid_data.get_data(self.data_directory)['region_nhse_feed']
+
+        covid_data.clean_data(make_feed(pd.date_range('2021-01-01', '2021-01-11'))).to_csv(self.feed_path)
+        os.utime(self.feed_path, ns=(0, os.stat(self.feed_path).st_mtime_ns + 10 ** 9))
+        df_after = covid_data.get_data(self.data_directory)['region_nhse_feed']
+
+        self.assertEqual(len(df_after), len(df_before) + 2)
+
+    def test_columns_and_filters(self):
+        df = covid_data.get_data(self.data_directory, columns=['newCasesByPublishDate'], areatypes=['region'],
+                                 date_from='2021-01-03', date_to='2021-01-04')['region_nhse_feed']
+
+        self.assertEqual(df.columns.tolist(), ['areatype', 'date', 'name', 'code', 'newCasesByPublishDate'])
+        self.assertEqual(df['date'].dt.day.unique().tolist(), [3, 4])
+
+
+class TestRemoveOutliersRolling(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        n_days = 300
+        self.series = pd.Series(100 + 10 * np.sin(np.arange(n_days) / 10) + rng.normal(0, 1, n_days),
+                                index=pd.date_range('2020-03-01', periods=n_days), name='newAdmissions')
+        self.spikes = [50, 120, 200]
+        self.series.iloc[self.spikes] += [200, 150, -300]
+
+    def test_equivalent_to_loop_version(self):
+        window_length = 20
+        cleaned = covid_data.remove_outliers_rolling(self.series, window_length=window_length)
+        # the loop version lags by a day: its value at i is the cleaned value at i-1
+        cleaned_loop = covid_data.remove_outlier_window_loop(self.series, window_length=window_length).shift(-1)
+
+        compared = slice(window_length - 1, -1)
+        differences = (cleaned - cleaned_loop).iloc[compared].abs()
+        self.assertEqual(differences[differences > 1e-9].index.tolist(), self.series.index[self.spikes].tolist())
+        # both replace the spikes with something close to the underlying curve
+        self.assertTrue((differences < 5).all())
+
+    def test_grouped_matches_single_series(self):
+        df_feed = pd.concat([pd.DataFrame(dict(code=code, date=self.series.index, newAdmissions=self.series.values * scale))
+                             for code, scale in [('E12000001', 1), ('E12000002', 3)]]).reset_index(drop=True)
+
+        df_cleaned = covid_data.remove_outliers_grouped(df_feed, ['newAdmissions'])
+
+        for code, scale in [('E12000001', 1), ('E12000002', 3)]:
+            expected = covid_data.remove_outliers_rolling(self.series * scale)
+            np.testing.assert_allclose(df_cleaned.loc[df_cleaned['code'] == code, 'newAdmissions'].values,
+                                       expected.values)
+
+
+class TestInterpolateEarlyData(unittest.TestCase):
+    def setUp(self) -> None:
+        dates = pd.date_range('2020-02-01', periods=100)
+        self.df_wide = pd.DataFrame({'starts late': np.r_[[np.nan] * 60, np.arange(1.0, 41.0)],
+                                     'starts early': np.r_[[np.nan] * 10, np.full(90, 5.0)],
+                                     'no data': np.nan}, index=dates)
+
+    def test_ramp_matches_pchip(self):
+        df_interpolated = covid_data.interpolate_early_frame(self.df_wide[['starts late', 'no data']],
+                                                             noise_scale_factor=0)
+
+        series = df_interpolated['starts late'].dropna()
+        known = np.r_[np.arange(20, 41), np.arange(60, 100)]
+        positions = df_interpolated.index.get_indexer(series.index)
+        expected = scipy.interpolate.PchipInterpolator(known, np.r_[np.zeros(21), np.arange(1.0, 41.0)])(positions)
+        np.testing.assert_allclose(series.to_numpy(), expected, atol=1e-9)
+        self.assertEqual(series.index[0], pd.Timestamp('2020-02-21'))
+        self.assertTrue(df_interpolated['no data'].isna().all())
+
+    def test_ramp_matches_pchip_when_the_second_day_is_missing(self):
+        df_wide = pd.DataFrame({'gap': [np.nan] * 60 + [10, np.nan, 12, 13, 14]},
+                               index=pd.date_range('2020-02-01', periods=65))
+
+        series = covid_data.interpolate_early_frame(df_wide, noise_scale_factor=0)['gap']
+
+        known = np.r_[np.arange(20, 41), [60, 62, 63, 64]]
+        expected = scipy.interpolate.PchipInterpolator(known, np.r_[np.zeros(21), [10, 12, 13, 14]])(np.arange(20, 61))
+        np.testing.assert_allclose(series.iloc[20:61].to_numpy(), expected, atol=1e-9)
+        self.assertTrue(np.isnan(series.iloc[61]))
+
+    def test_extends_back_before_the_first_row(self):
+        df_interpolated = covid_data.interpolate_early_frame(self.df_wide)
+
+        self.assertEqual(df_interpolated.index[0], pd.Timestamp('2020-01-02'))
+        self.assertEqual(df_interpolated['starts early'].first_valid_index(), pd.Timestamp('2020-01-02'))
+        pd.testing.assert_frame_equal(df_interpolated.loc[self.df_wide.index[60]:], self.df_wide.iloc[60:], check_freq=False)
+
+    def test_seeded_noise_is_reproducible(self):
+        df_first = covid_data.interpolate_early_frame(self.df_wide, seed=1)
+
+        pd.testing.assert_frame_equal(covid_data.interpolate_early_frame(self.df_wide, seed=1), df_first)
+        self.assertFalse(covid_data.interpolate_early_frame(self.df_wide, seed=2).equals(df_first))
+
+    def test_feed_matches_frame(self):
+        df_feed = (self.df_wide[['starts late', 'starts early']].rename_axis('date').reset_index()
+                   .melt(id_vars='date', var_name='code', value_name='newCasesBySpecimenDate').dropna()
+                   .assign(areatype='region'))
+
+        df_interpolated = covid_data.interpolate_early_feed(df_feed, ['newCasesBySpecimenDate'], seed=0)
+
+        df_expected = covid_data.interpolate_early_frame(
+            self.df_wide[['starts early', 'starts late']].rename_axis(columns='code'), seed=0)
+        for code in ['starts early', 'starts late']:
+            df_area = df_interpolated[df_interpolated['code'] == code]
+            np.testing.assert_allclose(df_area['newCasesBySpecimenDate'].to_numpy(), df_expected[code].dropna().to_numpy())
+            self.assertEqual(df_area['areatype'].unique().tolist(), ['region'])
+        self.assertEqual(df_interpolated.columns.tolist(), df_feed.columns.tolist())
+
+    def test_names_and_dtypes_are_kept(self):
+        series = self.df_wide['starts late'].rename(None)
+        self.assertIsNone(covid_data.interpolate_early_data(series, seed=0).name)
+        self.assertEqual(covid_data.interpolate_early_data(series.rename('cases'), seed=0).name, 'cases')
+
+        df_feed = (self.df_wide[['starts late']].rename_axis('date').reset_index()
+                   .melt(id_vars='date', var_name='code', value_name='newCasesBySpecimenDate').dropna()
+                   .astype(dict(code='category')))
+        df_interpolated = covid_data.interpolate_early_feed(df_feed, ['newCasesBySpecimenDate'], seed=0)
+        self.assertIsInstance(df_interpolated['code'].dtype, pd.CategoricalDtype)
+
+
+class TestAgeTable(unittest.TestCase):
+    def setUp(self) -> None:
+        self.df_feed = pd.DataFrame(dict(
+            areatype='nation', date=['2021-01-01', '2021-01-02'], name='England', code='E92000001',
+            newAdmissions=[1.0, 2.0],
+            maleCases=[[{'age': '5_to_9', 'rate': 1.5, 'value': 3}, {'age': '90+', 'rate': 2.5, 'value': 4}], []],
+            femaleCases=[[{'age': '0_to_4', 'rate': 0.5, 'value': 1}], [{'age': '0_to_4', 'rate': 0.0, 'value': 0}]],
+            cumAdmissionsByAge=[None, [{'age': '85+', 'rate': 10.0, 'value': 7}]]))
+
+    def test_lists_and_csv_strings_give_the_same_table(self):
+        df_from_lists = covid_data.make_age_table(self.df_feed)
+        df_from_strings = covid_data.make_age_table(
+            self.df_feed.assign(**{column: self.df_feed[column].map(lambda x: None if x is None else str(x))
+                                   for column in covid_data.AGE_COLUMNS}))
+
+        pd.testing.assert_frame_equal(df_from_lists, df_from_strings)
+        self.assertEqual(len(df_from_lists), 5)
+        self.assertEqual(df_from_lists.columns.tolist(), covid_data.AGE_TABLE_KEY_COLUMNS + ['value', 'rate'])
+
+    def test_categorical_age_bands_are_ordered(self):
+        df_ages = covid_data.make_age_table(self.df_feed)
+
+        self.assertEqual(df_ages['age_band'].cat.categories.tolist(), ['0_to_4', '5_to_9', '85+', '90+'])
+        self.assertTrue(df_ages['age_band'].cat.ordered)
+        self.assertEqual(df_ages.loc[df_ages['metric'] == 'cumAdmissions', 'sex'].tolist(), ['all'])
+
+    def test_split_and_reload(self):
+        data_directory = tempfile.mkdtemp()
+        df_feed, df_ages = covid_data.split_age_data(covid_data.clean_data(self.df_feed))
+        df_ages.to_csv(f"{data_directory}/england_nhse_ages.csv", index=False)
+
+        df_loaded = covid_data.get_age_table('england_nhse', data_directory)
+
+        os.remove(f"{data_directory}/england_nhse_ages.csv")
+        os.rmdir(data_directory)
+        self.assertEqual(df_feed.columns.tolist(), ['code', 'newAdmissions'])
+        pd.testing.assert_frame_equal(df_loaded, df_ages, check_categorical=False, check_dtype=False)
+        self.assertEqual(df_loaded['age_band'].cat.categories.tolist(), ['0_to_4', '5_to_9', '85+', '90+'])
+
+
+class TestStreamingIngest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp()
+        dates = pd.date_range('2021-01-25', '2021-02-05')
+        records = [dict(date=f"{date:%Y-%m-%d}", areatype='region', name=f"region {code}", code=code,
+                        newAdmissions=i, cumCasesBySpecimenDateRate=i / 2,
+                        maleCases=[{'age': '0_to_4', 'rate': 0.5, 'value': i}])
+                   for i, date in enumerate(dates) for code in ['E12000001', 'E12000002', 'W92000004']]
+        self.pages = [(page_number + 1, records[start:start + 5])
+                      for page_number, start in enumerate(range(0, len(records), 5))]
+        # keep the fetchers' default cache out of the repo's data directory
+        cache = covid_data.cache_tools.ResponseCache(f"{self.root}/http")
+        default_cache = unittest.mock.patch.object(covid_data.cache_tools, 'default_cache', return_value=cache)
+        default_cache.start()
+        self.addCleanup(default_cache.stop)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.root)
+
+    def fake_pages(self, *args, **kwargs):
+        return iter(self.pages)
+
+    def test_pages_are_typed_batches(self):
+        with unittest.mock.patch.object(covid_data.fetch_tools, 'iter_paginated', side_effect=self.fake_pages):
+            page_frames = list(covid_data.iter_paginated_dataset(["areaType=region"]))
+
+        self.assertEqual(len(page_frames), len(self.pages))
+        self.assertEqual(page_frames[0]['newAdmissions'].dtype, 'Int32')
+        self.assertIsInstance(page_frames[0]['code'].dtype, pd.CategoricalDtype)
+
+    def test_streamed_feed_matches_in_memory_pull(self):
+        with unittest.mock.patch.object(covid_data.fetch_tools, 'iter_paginated', side_effect=self.fake_pages):
+            df_in_memory = covid_data.clean_data(covid_data.get_paginated_dataset(["areaType=region"])
+                                                 .dropna(how='all', axis=1).sort_values(['code', 'date']))
+            df_streamed = covid_data.streamed_feed('region_nhse', self.root)
+
+        self.assertEqual(sorted(df_streamed.columns), sorted(df_in_memory.columns))
+        pd.testing.assert_frame_equal(df_streamed.reset_index()[['date', 'code', 'newAdmissions']],
+                                      df_in_memory.reset_index()[['date', 'code', 'newAdmissions']],
+                                      check_dtype=False, check_categorical=False)
+        self.assertEqual(covid_data.make_age_table(df_streamed.reset_index())['value'].sum(),
+                         covid_data.make_age_table(df_in_memory.reset_index())['value'].sum())
+
+
+class TestGoogleMobility(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache_dir = tempfile.mkdtemp()
+        self.archive_path = f"{self.cache_dir}/Region_Mobility_Report_CSVs.zip"
+        columns = 'country_region_code,country_region,sub_region_1,sub_region_2,date,parks_percent_change_from_baseline'
+        reports = {'2020_GB_Region_Mobility_Report.csv': ['GB,United Kingdom,,,2020-12-30,1',
+                                                          'GB,United Kingdom,,,2020-12-31,2',
+                                                          'GB,United Kingdom,York,,2020-12-31,3',
+                                                          'GB,United Kingdom,Bath,,2020-12-31,4'],
+                   '2021_GB_Region_Mobility_Report.csv': ['GB,United Kingdom,,,2021-01-01,5',
+                                                          'GB,United Kingdom,Bath,,2021-01-01,6'],
+                   '2020_NA_Region_Mobility_Report.csv': ['NA,Namibia,,,2020-12-31,7']}
+        with zipfile.ZipFile(self.archive_path, 'w') as zip_file:
+            for name, rows in reports.items():
+                zip_file.writestr(name, '\n'.join([columns] + rows) + '\n')
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.cache_dir)
+
+    def google_mobility(self, **kwargs):
+        with unittest.mock.patch.object(covid_data.fetch_tools, 'download_file', return_value=False):
+            return covid_data.google_mobility(cache_dir=self.cache_dir, **kwargs)
+
+    def test_sorted_without_sorting_afterwards(self):
+        df = self.google_mobility()
+
+        pd.testing.assert_frame_equal(df, df.sort_values(covid_data.GOOGLE_MOBILITY_SORT_COLUMNS).reset_index(drop=True))
+        self.assertEqual(df['parks_percent_change_from_baseline'].tolist(), [4, 6, 3, 1, 2, 5])
+
+    def test_filters_and_columns(self):
+        df = self.google_mobility(sub_regions=['Bath'], date_from='2021-01-01',
+                                  columns=['sub_region_1', 'date', 'parks_percent_change_from_baseline'])
+
+        self.assertEqual(df.columns.tolist(), ['sub_region_1', 'date', 'parks_percent_change_from_baseline'])
+        self.assertEqual(df['parks_percent_change_from_baseline'].tolist(), [6])
+
+    def test_country_codes_are_not_missing_values(self):
+        df = self.google_mobility(country_filter='_NA_')
+
+        self.assertEqual(df['country_region_code'].tolist(), ['NA'])
+
+
+def make_trust_workbook(sheets, header=14) -> bytes:
+    """A workbook laid out like the NHSE weekly trust admissions file: "header" blank rows, then a row per trust
+    with a column per date"""
+    dates = pd.date_range('2020-10-01', periods=4).to_pydatetime().tolist()
+    workbook = io.BytesIO()
+    with pd.ExcelWriter(workbook) as writer:
+        for sheet_number, sheet in enumerate(sheets):
+            df_sheet = pd.DataFrame([['London', 'R1K', 'Trust A'] + [sheet_number * 10 + day for day in range(4)],
+                                     ['Midlands', 'RJE', 'Trust B'] + [None, 1, 2, 3]],
+                                    columns=['NHS England Region', 'Code', 'Name'] + dates)
+            df_sheet.to_excel(writer, sheet_name=sheet, startrow=header, index=False)
+    return workbook.getvalue()
+
+
+class TestTrustAdmissions(unittest.TestCase):
+    def setUp(self) -> None:
+        self.output_dir = tempfile.mkdtemp()
+        self.sheets = ['Hosp ads & diag', 'New hosp cases']
+        self.workbook = make_trust_workbook(self.sheets)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.output_dir)
+
+    def trust_admissions(self, **kwargs):
+        kwargs = dict(dict(sheets=self.sheets), **kwargs)
+        with unittest.mock.patch.object(covid_data, 'get_cached_content', return_value=self.workbook) as download:
+            df_long = covid_data.trust_admissions('https://example.com/weekly.xlsx', output_dir=self.output_dir,
+                                                  **kwargs)
+        return df_long, download.call_count
+
+    def test_long_format(self):
+        df_long, _ = self.trust_admissions()
+
+        self.assertEqual(df_long.columns.tolist(), covid_data.TRUST_ADMISSIONS_COLUMNS)
+        self.assertEqual(len(df_long), 2 * 7)
+        self.assertEqual(df_long.loc[(df_long['code'] == 'R1K') & (df_long['metric'] == 'New hosp cases'),
+                                     'value'].tolist(), [10, 11, 12, 13])
+
+    def test_repeat_runs_are_cache_hits(self):
+        df_first, first_downloads = self.trust_admissions()
+        df_second, second_downloads = self.trust_admissions()
+
+        self.assertEqual((first_downloads, second_downloads), (1, 0))
+        pd.testing.assert_frame_equal(df_first, df_second)
+
+    def test_different_sheets_are_not_cache_hits(self):
+        df_first, _ = self.trust_admissions(sheets=self.sheets[:1])
+        df_second, second_downloads = self.trust_admissions()
+        df_third, third_downloads = self.trust_admissions(sheets=None)
+
+        self.assertEqual((second_downloads, third_downloads), (1, 1))
+        self.assertEqual(df_first['metric'].unique().tolist(), self.sheets[:1])
+        self.assertEqual(df_second['metric'].unique().tolist(), self.sheets)
+        pd.testing.assert_frame_equal(df_second, df_third)
+
+    def test_parallel_parse_matches(self):
+        df_single = covid_data.parse_trust_workbook(self.workbook, self.sheets)
+        df_parallel = covid_data.parse_trust_workbook(self.workbook, self.sheets, max_workers=2)
+
+        pd.testing.assert_frame_equal(df_single, df_parallel)
+
+    def test_wide_matches_sheet_by_sheet_read(self):
+        df_long, _ = self.trust_admissions()
+
+        df_expected = pd.DataFrame([pd.read_excel(io.BytesIO(self.workbook), sheet_name=sheet, header=14)
+                                    .set_index(['NHS England Region', 'Code', 'Name']).rename_axis('date', axis=1)
+                                    .stack().dropna().rename(sheet) for sheet in self.sheets]).T
+        pd.testing.assert_frame_equal(covid_data.wide_trust_admissions(df_long), df_expected, check_dtype=False,
+                                      check_index_type=False, check_column_type=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
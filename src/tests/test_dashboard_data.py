@@ -0,0 +1,49 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import dashboard_data
+
+
+class TestDashboardData(unittest.TestCase):
+    def setUp(self) -> None:
+        self.df_feeds = pd.DataFrame(dict(
+            areatype=['region'] * 4 + ['nation'] * 2 + ['nation'],
+            date=['2021-01-01', '2021-01-02'] * 3 + ['2021-01-01'],
+            name=['North East', 'North East', 'London', 'London', 'England', 'England', 'Wales'],
+            code=['E12000001', 'E12000001', 'E12000007', 'E12000007', 'E92000001', 'E92000001', 'W92000004'],
+            newAdmissions=[1, 2, 3, 4, 5, 6, 7],
+            hospitalCases=[np.nan, np.nan, 10, 11, 12, 13, 14]))
+        self.data = dashboard_data.DashboardData(self.df_feeds)
+
+    def test_options(self):
+        self.assertEqual(self.data.areatype_options, ['region', 'nation'])
+        self.assertEqual(self.data.areaname_options['nation'], ['England'])
+        self.assertEqual(self.data.metric_options('region', ['North East']), ['newAdmissions'])
+        self.assertEqual(self.data.metric_options('region', ['North East', 'London']),
+                         ['newAdmissions', 'hospitalCases'])
+
+    def test_select_matches_full_frame_filter(self):
+        df_selected = self.data.select('region', ['London', 'North East'], ['newAdmissions', 'hospitalCases'])
+
+        df_expected = (self.df_feeds[self.df_feeds['areatype'].isin(['region'])]
+                       .assign(date=lambda df: pd.to_datetime(df['date']))
+                       .set_index(['date', 'areatype', 'name'])
+                       .rename_axis(columns='metric')[['newAdmissions', 'hospitalCases']]
+                       .stack().dropna().rename('value').reset_index())
+        sort_columns = ['name', 'date', 'metric']
+        pd.testing.assert_frame_equal(df_selected.sort_values(sort_columns).reset_index(drop=True),
+                                      df_expected.sort_values(sort_columns).reset_index(drop=True),
+                                      check_dtype=False)
+
+    def test_values_on_a_date_by_code(self):
+        values = self.data.values_on('region', 'hospitalCases', '2021-01-02')
+        self.assertEqual(values.index.tolist(), ['E12000007', 'E12000001'])
+        self.assertEqual(values['E12000007'], 11)
+        self.assertTrue(np.isnan(values['E12000001']))
+        self.assertEqual(self.data.latest_date('region', 'hospitalCases'), pd.Timestamp('2021-01-02'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import contextlib
+import io
+import unittest
+
+import numpy as np
+import pandas as pd
+import statsmodels.tsa.stattools as stattools
+
+import src.data_tools
+
+
+class TestFindOptimumLagsBatch(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        n_days = 200
+        self.lags = [0, 4, 9, 13]
+        columns = dict()
+        for pair, lag in enumerate(self.lags):
+            signal = np.convolve(rng.normal(size=n_days + 20), np.ones(7) / 7, mode='same')
+            columns[f"x{pair}"] = signal[20:] + rng.normal(0, 0.05, n_days)
+            columns[f"y{pair}"] = signal[20 + lag:] if lag else signal[20:]
+            columns[f"y{pair}"] = np.concatenate([columns[f"y{pair}"], np.full(lag, np.nan)])
+        self.df = pd.DataFrame(columns)
+        self.pairs = [(f"x{pair}", f"y{pair}") for pair in range(len(self.lags))]
+
+    def test_matches_statsmodels_ccf(self):
+        max_lag = 20
+        correlations = src.data_tools.cross_correlations(self.df[['x1', 'x2']].to_numpy(), self.df[['y1', 'y2']].to_numpy(),
+                                                         max_lag=max_lag)
+
+        for column, (x_column, y_column) in enumerate([('x1', 'y1'), ('x2', 'y2')]):
+            df_pair = self.df[[x_column, y_column]].dropna()
+            expected = stattools.ccf(df_pair[x_column].values, df_pair[y_column].values)[:max_lag + 1]
+            np.testing.assert_allclose(correlations[:, column], expected, atol=1e-10)
+
+    def test_finds_each_pairs_lag(self):
+        df_lags = src.data_tools.find_optimum_lags_batch(self.df, self.pairs, max_lag=20)
+
+        self.assertEqual(df_lags['optimum_lag'].tolist(), self.lags)
+        self.assertTrue((df_lags['peak_correlation'] > 0.9).all())
+
+    def test_agrees_with_find_optimum_lags(self):
+        df_lags = src.data_tools.find_optimum_lags_batch(self.df, self.pairs, max_lag=len(self.df))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = [src.data_tools.find_optimum_lags(self.df[[x_column, y_column]]) for x_column, y_column in self.pairs]
+        self.assertEqual(df_lags['optimum_lag'].tolist(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
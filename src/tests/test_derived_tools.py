@@ -0,0 +1,74 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import src.derived_tools
+
+
+class TestDerivedMetrics(unittest.TestCase):
+    def setUp(self) -> None:
+        dates = pd.date_range('2020-09-01', periods=40)
+        self.df_feed = pd.DataFrame([dict(areatype='region', date=date, name=f"region {code}", code=code,
+                                          newCasesBySpecimenDate=float(day * scale),
+                                          newCasesByPublishDate=float(scale),
+                                          cumCasesBySpecimenDate=1000.0 * scale,
+                                          cumCasesBySpecimenDateRate=10.0)
+                                     for code, scale in [('E12000001', 1), ('E12000002', 2)]
+                                     for day, date in enumerate(dates)]).set_index(['areatype', 'date', 'name'])
+        self.population = src.derived_tools.update_population(
+            src.derived_tools.load_population('./no_such_population_lookup.csv'), self.df_feed)
+        self.tests = pd.DataFrame(dict(newPillarTwoTestsByPublishDate=4.0), index=dates)
+
+    def test_population_estimated_from_rates(self):
+        self.assertEqual(self.population.to_dict(), {'E12000001': 10_000_000, 'E12000002': 20_000_000})
+
+    def test_reference_population_wins(self):
+        population = src.derived_tools.update_population(pd.Series({'E12000001': 5.0}, name='population'),
+                                                         self.df_feed)
+
+        self.assertEqual(population.to_dict(), {'E12000001': 5.0, 'E12000002': 20_000_000})
+
+    def test_derived_columns(self):
+        df_derived = src.derived_tools.derive_metrics(self.df_feed, self.population, self.tests)
+        df_area = df_derived[df_derived['code'] == 'E12000002'].set_index('date')
+
+        rolling_mean = df_area['newCasesBySpecimenDateRollingMean']
+        self.assertTrue(rolling_mean.iloc[:6].isna().all())
+        self.assertEqual(rolling_mean.iloc[6], np.mean(np.arange(7) * 2))
+        np.testing.assert_allclose(df_area['newCasesBySpecimenDateRollingMeanPer100k'], rolling_mean / 200)
+        np.testing.assert_allclose(df_area['newCasesByPublishDatePerUKPillarTwoTest'], 0.5)
+        self.assertEqual(df_area['newCasesBySpecimenDateRollingMeanScaled'].max(), 1)
+        self.assertNotIn('newAdmissionsRollingMean', df_derived.columns)
+
+    def test_per_100k_skipped_without_populations(self):
+        df_derived = src.derived_tools.derive_metrics(self.df_feed, pd.Series({'E12000009': 1e6}), self.tests)
+
+        self.assertIn('newCasesBySpecimenDateRollingMean', df_derived.columns)
+        self.assertNotIn('newCasesBySpecimenDateRollingMeanPer100k', df_derived.columns)
+
+    def test_rolling_mean_does_not_bridge_missing_days(self):
+        df_feed = self.df_feed.drop(index=pd.Timestamp('2020-09-20'), level='date')
+
+        rolling_mean = (src.derived_tools.derive_metrics(df_feed).set_index(['code', 'date'])
+                        .loc['E12000001', 'newCasesBySpecimenDateRollingMean'])
+
+        self.assertTrue(rolling_mean.loc['2020-09-21':'2020-09-26'].isna().all())
+        self.assertEqual(rolling_mean.loc['2020-09-27'], np.mean(np.arange(20, 27)))
+
+    def test_incremental_update_matches_full(self):
+        df_feed = self.df_feed.reset_index()
+        df_existing = src.derived_tools.derive_metrics(df_feed[df_feed['date'] <= '2020-09-25'], self.population,
+                                                       self.tests)
+        # plus an area which is new to the feed
+        df_feed = pd.concat([df_feed, df_feed[df_feed['code'] == 'E12000001'].assign(code='E12000003',
+                                                                                      name='region E12000003')])
+
+        df_updated = src.derived_tools.update_derived(df_feed, df_existing, self.population, self.tests)
+
+        pd.testing.assert_frame_equal(df_updated, src.derived_tools.derive_metrics(df_feed, self.population,
+                                                                                   self.tests))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+import src.feature_tools
+
+
+class TestFeatureGraph(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store_dir = tempfile.mkdtemp()
+        self.calls = []
+        self.df_cases = pd.DataFrame(dict(code=['E1', 'E1', 'E2'], newCases=[1.0, 2.0, 5.0]))
+
+        def total_cases(df_cases):
+            self.calls.append('total_cases')
+            return df_cases.groupby('code', as_index=False)['newCases'].sum()
+
+        def mean_cases(df_cases):
+            self.calls.append('mean_cases')
+            return df_cases.groupby('code', as_index=False)['newCases'].mean()
+
+        def cases_summary(df_total, df_mean):
+            self.calls.append('cases_summary')
+            return df_total.merge(df_mean, on='code', suffixes=('_total', '_mean'))
+
+        self.total = self.feature(total_cases, self.df_cases)
+        self.mean = self.feature(mean_cases, self.df_cases)
+        self.summary = self.feature(cases_summary, None, inputs=[self.total, self.mean])
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.store_dir)
+
+    def feature(self, feature_function, source, inputs=None, name=None) -> src.feature_tools.DataFeature:
+        return src.feature_tools.DataFeature('area code', src.feature_tools.FeaturePipeline(feature_function, source),
+                                             inputs=inputs, name=name, store_dir=self.store_dir)
+
+    def test_inputs_run_first(self):
+        recomputed = self.summary.update()
+
+        self.assertEqual(sorted(recomputed), ['cases_summary', 'mean_cases', 'total_cases'])
+        self.assertEqual(self.calls[-1], 'cases_summary')
+        self.assertEqual(self.summary.feature_data['newCases_total'].tolist(), [3.0, 5.0])
+        self.assertEqual(self.summary.feature_data['newCases_mean'].tolist(), [1.5, 5.0])
+
+    def test_unchanged_features_are_not_recomputed(self):
+        self.summary.update()
+
+        self.assertEqual(self.summary.update(), [])
+        self.assertEqual(len(self.calls), 3)
+
+    def test_only_changed_upstream_is_recomputed(self):
+        self.summary.update()
+        self.mean.feature_pipeline.source = self.df_cases.assign(newCases=[1.0, 2.0, 6.0])
+
+        recomputed = self.summary.update()
+
+        self.assertEqual(sorted(recomputed), ['cases_summary', 'mean_cases'])
+        self.assertEqual(self.summary.feature_data['newCases_mean'].tolist(), [1.5, 6.0])
+
+    def test_outputs_are_persisted(self):
+        self.summary.update()
+        summary_again = self.feature(self.summary.feature_pipeline.feature_function, None,
+                                     inputs=[self.feature(self.total.feature_pipeline.feature_function, self.df_cases),
+                                             self.feature(self.mean.feature_pipeline.feature_function, self.df_cases)])
+
+        self.assertEqual(summary_again.update(), [])
+        pd.testing.assert_frame_equal(summary_again.feature_data, self.summary.feature_data)
+        self.assertEqual(len(os.listdir(f"{self.store_dir}/{self.summary.store_key}")), 2)
+
+    def test_cycles_are_rejected(self):
+        self.total.inputs.append(self.summary)
+
+        with self.assertRaises(ValueError):
+            self.summary.update()
+
+    def test_features_with_the_same_name_are_kept_apart(self):
+        maximum = self.feature(lambda df_cases: df_cases.groupby('code', as_index=False)['newCases'].max(),
+                               self.df_cases)
+        minimum = self.feature(lambda df_cases: df_cases.groupby('code', as_index=False)['newCases'].min(),
+                               self.df_cases)
+        self.assertNotEqual(maximum.store_key, minimum.store_key)
+        self.assertNotIn('<', maximum.store_key)
+
+        with self.assertRaises(ValueError):
+            src.feature_tools.FeatureGraph([maximum, minimum])
+
+        minimum = self.feature(minimum.feature_pipeline.feature_function, self.df_cases, name='minimum')
+        src.feature_tools.FeatureGraph([maximum, minimum]).update()
+        self.assertEqual(maximum.feature_data['newCases'].tolist(), [2.0, 5.0])
+        self.assertEqual(minimum.feature_data['newCases'].tolist(), [1.0, 5.0])
+        self.assertEqual(len(os.listdir(self.store_dir)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
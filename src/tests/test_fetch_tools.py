@@ -0,0 +1,170 @@
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import src.cache_tools
+import src.fetch_tools
+
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    """Pretends to be the coronavirus API: serves 'n_pages' pages of 'page_size' records, failing the first
+    request for each page in 'flaky_pages' with a 503"""
+    n_pages = 7
+    page_size = 3
+    flaky_pages = set()
+    requests_seen = []
+
+    def do_GET(self):
+        page = int(parse_qs(urlparse(self.path).query)['page'][0])
+        self.requests_seen.append(page)
+
+        if page in self.flaky_pages and self.requests_seen.count(page) == 1:
+            self.send_response(503)
+            self.end_headers()
+            return
+        if page > self.n_pages:
+            self.send_response(204)
+            self.end_headers()
+            return
+
+        body = json.dumps(dict(
+            data=[dict(page=page, row=row) for row in range(self.page_size)],
+            pagination=dict(next=f"/v1/data?page={page + 1}" if page < self.n_pages else None,
+                            last=f"/v1/data?page={self.n_pages}"),
+        )).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestFetchPaginated(unittest.TestCase):
+    def setUp(self) -> None:
+        StubAPIHandler.requests_seen = []
+        StubAPIHandler.flaky_pages = set()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubAPIHandler)
+        self.endpoint = f"http://127.0.0.1:{self.server.server_port}/v1/data"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pages_come_back_in_order(self):
+        pages = src.fetch_tools.fetch_paginated(self.endpoint, dict(format='json'), max_workers=3)
+
+        self.assertEqual([page_number for page_number, _ in pages], list(range(1, 8)))
+        self.assertEqual([record['page'] for _, records in pages for record in records],
+                         [page for page in range(1, 8) for _ in range(3)])
+
+    def test_start_and_end_page(self):
+        pages = src.fetch_tools.fetch_paginated(self.endpoint, dict(format='json'), start_page=2, end_page=5)
+
+        self.assertEqual([page_number for page_number, _ in pages], [2, 3, 4])
+        self.assertTrue(all(page < 5 for page in StubAPIHandler.requests_seen))
+
+    def test_failed_pages_are_retried(self):
+        StubAPIHandler.flaky_pages = {2, 5}
+
+        pages = src.fetch_tools.fetch_paginated(self.endpoint, dict(format='json'), max_workers=4,
+                                                backoff_factor=0.01)
+
+        self.assertEqual(len(pages), 7)
+        self.assertEqual(StubAPIHandler.requests_seen.count(2), 2)
+
+    def test_gives_up_after_max_retries(self):
+        StubAPIHandler.flaky_pages = {1}
+
+        with self.assertRaises(RuntimeError):
+            src.fetch_tools.fetch_paginated(self.endpoint, dict(format='json'), max_retries=0)
+
+    def test_iter_paginated_only_runs_ahead_by_max_workers(self):
+        pages = src.fetch_tools.iter_paginated(self.endpoint, dict(format='json'), max_workers=2)
+
+        first_page_number, _ = next(pages)
+        pages.close()
+
+        self.assertEqual(first_page_number, 1)
+        self.assertLessEqual(max(StubAPIHandler.requests_seen), 3)
+
+    def test_pages_through_a_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        cache = src.cache_tools.ResponseCache(cache_dir)
+
+        pages = src.fetch_tools.fetch_paginated(self.endpoint, dict(format='json'), max_workers=3, cache=cache)
+        requests_made = len(StubAPIHandler.requests_seen)
+        pages_again = src.fetch_tools.fetch_paginated(self.endpoint, dict(format='json'), max_workers=3, cache=cache)
+
+        shutil.rmtree(cache_dir)
+        self.assertEqual(pages_again, pages)
+        self.assertEqual(len(StubAPIHandler.requests_seen), requests_made)
+        self.assertGreaterEqual(cache.stats['hit'], len(pages))
+
+    def test_backoff_is_capped(self):
+        self.assertEqual(src.fetch_tools.backoff_delay(0, backoff_factor=1, max_backoff=5), 1)
+        self.assertEqual(src.fetch_tools.backoff_delay(10, backoff_factor=1, max_backoff=5), 5)
+
+
+class StubFileHandler(BaseHTTPRequestHandler):
+    """Serves one file with an ETag, answering a matching If-None-Match with a 304"""
+    content = b'0123456789' * 1000
+    etag = '"v1"'
+    full_downloads = 0
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        StubFileHandler.full_downloads += 1
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.content)))
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloadFile(unittest.TestCase):
+    def setUp(self) -> None:
+        StubFileHandler.full_downloads = 0
+        StubFileHandler.etag = '"v1"'
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubFileHandler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/archive.zip"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.directory = tempfile.mkdtemp()
+        self.path = f"{self.directory}/archive.zip"
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_unchanged_file_is_not_downloaded_again(self):
+        self.assertTrue(src.fetch_tools.download_file(self.url, self.path, chunk_size=1000))
+        self.assertFalse(src.fetch_tools.download_file(self.url, self.path))
+
+        self.assertEqual(StubFileHandler.full_downloads, 1)
+        with open(self.path, 'rb') as file:
+            self.assertEqual(file.read(), StubFileHandler.content)
+
+    def test_changed_file_is_downloaded_again(self):
+        src.fetch_tools.download_file(self.url, self.path)
+        StubFileHandler.etag = '"v2"'
+
+        self.assertTrue(src.fetch_tools.download_file(self.url, self.path))
+        self.assertEqual(StubFileHandler.full_downloads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
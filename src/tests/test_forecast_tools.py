@@ -0,0 +1,177 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import src.forecast_tools
+
+
+def make_feed(codes=('E40000003', 'E40000005'), n_actual=80, n_forecast=7, seed=0):
+    """Admissions which follow cases, for a few areas, with the last n_forecast days of admissions unknown"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for code in codes:
+        cases = 100 + np.cumsum(rng.normal(0, 5, n_actual + n_forecast))
+        admissions = 0.1 * cases + rng.normal(0, 1, n_actual + n_forecast)
+        admissions[n_actual:] = np.nan
+        frames.append(pd.DataFrame(dict(code=code, date=pd.date_range('2021-01-01', periods=n_actual + n_forecast),
+                                        newCasesBySpecimenDate=cases, newAdmissions=admissions)))
+    return pd.concat(frames, ignore_index=True)
+
+
+class TestFitSarimaxByArea(unittest.TestCase):
+    def test_predictions_and_report(self):
+        df_feed = make_feed()
+
+        df_predictions, df_report = src.forecast_tools.fit_sarimax_by_area(
+            df_feed, 'newAdmissions', 'newCasesBySpecimenDate', order=(1, 0, 0), max_workers=2)
+
+        self.assertEqual(df_report['code'].tolist(), ['E40000003', 'E40000005'])
+        self.assertTrue((df_report['status'] == 'ok').all())
+        self.assertTrue((df_report['fit_seconds'] > 0).all())
+        counts = df_predictions.groupby(['code', 'type']).size()
+        self.assertEqual(counts[('E40000003', 'insample')], 80)
+        self.assertEqual(counts[('E40000005', 'forecast')], 7)
+        self.assertTrue((df_predictions['lower'] <= df_predictions['upper']).all())
+
+    def test_same_as_fitting_in_process(self):
+        df_feed = make_feed(codes=['E40000003'])
+
+        df_pool, _ = src.forecast_tools.fit_sarimax_by_area(df_feed, 'newAdmissions', 'newCasesBySpecimenDate',
+                                                            order=(1, 0, 0), max_workers=2)
+        df_serial, _ = src.forecast_tools.fit_sarimax_by_area(df_feed, 'newAdmissions', 'newCasesBySpecimenDate',
+                                                              order=(1, 0, 0), max_workers=1)
+
+        pd.testing.assert_frame_equal(df_pool, df_serial)
+
+    def test_failed_area_is_reported(self):
+        df_feed = pd.concat([make_feed(codes=['E40000003']),
+                             make_feed(codes=['E40000005'], n_actual=0)], ignore_index=True)
+
+        df_predictions, df_report = src.forecast_tools.fit_sarimax_by_area(
+            df_feed, 'newAdmissions', 'newCasesBySpecimenDate', order=(1, 0, 0), max_workers=1)
+
+        self.assertEqual(df_report.set_index('code')['status'].to_dict(), {'E40000003': 'ok', 'E40000005': 'failed'})
+        self.assertEqual(df_predictions['code'].unique().tolist(), ['E40000003'])
+
+
+class TestModelCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = src.forecast_tools.ModelCache(self.cache_dir)
+        rng = np.random.default_rng(1)
+        self.exog = 100 + np.cumsum(rng.normal(0, 5, 101))
+        self.endog = 0.1 * self.exog + rng.normal(0, 1, 101)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.cache_dir)
+
+    def fit(self, n_days, **kwargs):
+        return src.forecast_tools.fit_sarimax_cached(self.cache, 'E40000003', self.endog[:n_days], self.exog[:n_days],
+                                                     'newAdmissions', 'newCasesBySpecimenDate', order=(1, 0, 0),
+                                                     **kwargs)
+
+    def test_unchanged_data_reuses_fit(self):
+        model_fit_first, how_first = self.fit(100)
+        model_fit_second, how_second = self.fit(100)
+
+        self.assertEqual((how_first, how_second), ('miss', 'hit'))
+        np.testing.assert_allclose(model_fit_second.params, model_fit_first.params)
+        np.testing.assert_allclose(model_fit_second.fittedvalues, model_fit_first.fittedvalues)
+
+    def test_new_days_are_appended(self):
+        model_fit_first, _ = self.fit(100)
+        model_fit_append, how_append = self.fit(101)
+        _, how_warm = self.fit(101, refit='warm')
+
+        self.assertEqual(how_append, 'append')
+        self.assertEqual(model_fit_append.nobs, 101)
+        np.testing.assert_allclose(model_fit_append.params, model_fit_first.params)
+        self.assertEqual(how_warm, 'hit')  # the appended fit was cached for the 101 days
+
+    def test_appended_parameters_are_refitted_after_a_while(self):
+        self.fit(90)
+        hows = [self.fit(n_days, refit_after_days=5)[1] for n_days in range(91, 98)]
+
+        # re-estimated once the parameters were fitted to data 6 days shorter, then appended to again
+        self.assertEqual(hows, ['append'] * 5 + ['warm', 'append'])
+        self.assertEqual(self.cache.get(self.cache.key('E40000003', 'newAdmissions', 'newCasesBySpecimenDate',
+                                                       (1, 0, 0)))['fitted_observations'], 96)
+
+    def test_revised_history_is_warm_started(self):
+        self.fit(100)
+        self.endog[95] += 5
+
+        _, how = self.fit(101)
+        _, how_again = self.fit(101)
+
+        self.assertEqual((how, how_again), ('warm', 'hit'))
+
+    def test_warm_start_with_maxiter(self):
+        self.fit(100)
+        model_fit, how = self.fit(101, refit='warm', maxiter=3)
+
+        self.assertEqual(how, 'warm')
+        self.assertLessEqual(model_fit.mle_retvals['iterations'], 3)
+
+    def test_least_recently_used_are_evicted(self):
+        cache = src.forecast_tools.ModelCache(self.cache_dir, max_entries=2)
+        for n, area in enumerate(['a', 'b', 'c']):
+            cache.put(area, dict(n=n))
+            os.utime(cache.path(area), (n, n))
+        cache.get('a')
+
+        cache.evict()
+
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['a.json', 'c.json'])
+
+    def test_batch_reports_cache_use(self):
+        df_feed = make_feed()
+        kwargs = dict(order=(1, 0, 0), max_workers=1, cache_dir=self.cache_dir)
+
+        _, df_report_first = src.forecast_tools.fit_sarimax_by_area(df_feed, 'newAdmissions', 'newCasesBySpecimenDate', **kwargs)
+        _, df_report_second = src.forecast_tools.fit_sarimax_by_area(df_feed, 'newAdmissions', 'newCasesBySpecimenDate', **kwargs)
+
+        self.assertEqual(df_report_first['cache'].tolist(), ['miss', 'miss'])
+        self.assertEqual(df_report_second['cache'].tolist(), ['hit', 'hit'])
+
+
+class TestSearchOrders(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(2)
+        self.endog = np.zeros(150)
+        for t in range(2, 150):  # an AR(2) process
+            self.endog[t] = 0.6 * self.endog[t - 1] + 0.3 * self.endog[t - 2] + rng.normal()
+        self.endog += 50
+
+    def test_ranks_and_prunes(self):
+        df_search = src.forecast_tools.search_orders(self.endog, p_values=[0, 1, 2], d_values=[0], q_values=[0, 1],
+                                                     n_origins=3, horizon=5, prune_factor=1.2, max_workers=2)
+
+        self.assertEqual(len(df_search), 6)
+        self.assertEqual(df_search['rank'].tolist(), list(range(1, 7)))
+        self.assertTrue(df_search['order'].iloc[0][0] >= 1)
+        self.assertTrue((df_search['total_fit_seconds'] > 0).all())
+        pruned = df_search[df_search['pruned_after'].notna()]
+        self.assertTrue((pruned['rounds'] == pruned['pruned_after']).all())
+        self.assertIn((0, 0, 0), pruned['order'].tolist())
+
+    def test_same_as_searching_in_process(self):
+        search_kwargs = dict(p_values=[0, 1], d_values=[0], q_values=[0], n_origins=2, horizon=5)
+        df_pool = src.forecast_tools.search_orders(self.endog, max_workers=2, **search_kwargs)
+        df_serial = src.forecast_tools.search_orders(self.endog, max_workers=1, **search_kwargs)
+
+        pd.testing.assert_frame_equal(df_pool.drop(columns=['total_fit_seconds', 'mean_fit_seconds']),
+                                      df_serial.drop(columns=['total_fit_seconds', 'mean_fit_seconds']))
+
+    def test_origins_must_fit_in_the_series(self):
+        with self.assertRaises(ValueError):
+            src.forecast_tools.search_orders(self.endog[:20], p_values=[1], d_values=[0], q_values=[0],
+                                             n_origins=4, horizon=5, max_workers=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
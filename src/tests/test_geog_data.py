@@ -0,0 +1,126 @@
+import importlib.util
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import src.geog_data
+
+
+class TestAreaHierarchy(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        # Adur is a district of West Sussex, Hartlepool a unitary authority
+        cls.hierarchy = src.geog_data.AreaHierarchy.from_lookups(ltla_utla_lookup={'E07000223': 'E10000032'})
+
+    def ancestor_code(self, areatype, code, level):
+        area_id = self.hierarchy.ids_for([areatype], [code])[0]
+        ancestor_id = self.hierarchy.ancestor(level)[area_id]
+        return self.hierarchy.code[ancestor_id] if ancestor_id >= 0 else None
+
+    def test_unitary_authority_is_its_own_utla(self):
+        self.assertEqual(self.ancestor_code('ltla', 'E06000001', 'utla'), 'E06000001')
+        self.assertEqual(self.ancestor_code('ltla', 'E06000001', 'region'), 'E12000001')
+        self.assertEqual(self.ancestor_code('ltla', 'E06000001', 'nation'), 'E92000001')
+
+    def test_districts_go_through_their_county(self):
+        self.assertEqual(self.ancestor_code('ltla', 'E07000223', 'utla'), 'E10000032')
+        self.assertEqual(self.ancestor_code('utla', 'E10000032', 'region'), 'E12000008')
+        # without a county lookup a district still has a region
+        self.assertIsNone(self.ancestor_code('ltla', 'E07000224', 'utla'))
+        self.assertEqual(self.ancestor_code('ltla', 'E07000224', 'region'), 'E12000008')
+
+    def test_unknown_areas(self):
+        self.assertEqual(self.hierarchy.ids_for(['ltla', 'nowhere'], ['E99999999', 'E06000001'])[0], -1)
+        self.assertIn('E07000004', self.hierarchy.unplaced('region')['code'].tolist())
+
+    def test_roll_up_and_check(self):
+        ltla_codes = self.hierarchy.code[(self.hierarchy.level == 0) & (self.hierarchy.ancestor('region') >= 0)]
+        dates = pd.date_range('2021-01-01', periods=3)
+        df_ltla = pd.DataFrame(dict(areatype='ltla', date=np.tile(dates, len(ltla_codes)), name='an ltla',
+                                    code=np.repeat(ltla_codes, len(dates)), newCasesByPublishDate=2.0))
+
+        df_region = self.hierarchy.roll_up(df_ltla, ['newCasesByPublishDate'])
+
+        self.assertEqual(len(df_region), 9 * len(dates))
+        north_east = df_region[df_region['code'] == 'E12000001']
+        self.assertEqual(north_east['name'].iloc[0], 'North East')
+        self.assertEqual(north_east['newCasesByPublishDate'].tolist(), [2.0 * north_east['areas'].iloc[0]] * 3)
+        self.assertEqual(df_region.drop_duplicates('code')['areas'].sum(), len(ltla_codes))
+
+        df_published = df_region.drop(columns='areas').copy()
+        df_published.loc[df_published['code'] == 'E12000007', 'newCasesByPublishDate'] *= 1.5
+        df_mismatches = self.hierarchy.check_roll_up(df_ltla, df_published, ['newCasesByPublishDate'])
+        self.assertEqual(df_mismatches['code'].unique().tolist(), ['E12000007'])
+        self.assertEqual(len(df_mismatches), len(dates))
+
+
+class TestGeometryCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = f"{self.temporary_dir.name}/geometry"
+        self.geojson_path = f"{self.temporary_dir.name}/lad.geojson"
+        # a square district with a dent in one side, and a triangle next to it
+        square = [[0, 0], [0.5, 0.0001], [1, 0], [1, 1], [0, 1], [0, 0]]
+        triangle = [[1, 0], [2, 0], [1, 1], [1, 0]]
+        with open(self.geojson_path, 'w') as geojson_file:
+            json.dump(dict(type='FeatureCollection', features=[
+                dict(type='Feature', properties=dict(LAD20CD='E06000001', LAD20NM='Square'),
+                     geometry=dict(type='Polygon', coordinates=[square])),
+                dict(type='Feature', properties=dict(LAD20CD='E06000002', LAD20NM='Triangle'),
+                     geometry=dict(type='Polygon', coordinates=[triangle]))]), geojson_file)
+
+    def tearDown(self) -> None:
+        self.temporary_dir.cleanup()
+        src.geog_data._geojson.clear()
+
+    def test_round_coordinates(self):
+        self.assertEqual(src.geog_data.round_coordinates([[[0.1234567, 1.0], [2.9999999, 3]]], precision=3),
+                         [[[0.123, 1.0], [3.0, 3]]])
+
+    def test_choropleth_values_follow_the_feature_order(self):
+        geojson = dict(features=[dict(id='E06000002'), dict(id='E06000001'), dict(id='E06000003')])
+        values = pd.Series([1.0, 2.0], index=['E06000001', 'E06000002'])
+        np.testing.assert_array_equal(src.geog_data.choropleth_values(geojson, values), [2.0, 1.0, np.nan])
+
+    @unittest.skipUnless(importlib.util.find_spec('geopandas'), "building the cache needs geopandas")
+    def test_build_and_load(self):
+        metadata = src.geog_data.build_geometry_cache(self.geojson_path, self.cache_dir,
+                                                      tolerances=dict(low=0.01, high=0.00001))
+        self.assertTrue(src.geog_data.geometry_cache_is_current(self.geojson_path, self.cache_dir,
+                                                                tolerances=dict(low=0.01, high=0.00001)))
+        self.assertLess(metadata['levels']['low']['vertices'], metadata['levels']['high']['vertices'])
+
+        with open(f"{self.cache_dir}/lad_low.geojson") as geojson_file:
+            geojson = json.load(geojson_file)
+        self.assertEqual([feature['id'] for feature in geojson['features']], ['E06000001', 'E06000002'])
+        self.assertEqual(len(geojson['features'][0]['geometry']['coordinates'][0]), 5)  # the dent is gone
+        self.assertEqual(src.geog_data.lad_geometry('high', self.cache_dir).loc['E06000002', 'name'], 'Triangle')
+
+    def test_cached_geojson_is_used_without_the_source(self):
+        os.makedirs(self.cache_dir)
+        geojson = dict(type='FeatureCollection', features=[dict(type='Feature', id='E06000001', properties={},
+                                                                 geometry=None)])
+        for level in src.geog_data.SIMPLIFY_TOLERANCES:
+            with open(f"{self.cache_dir}/lad_{level}.geojson", 'w') as geojson_file:
+                json.dump(geojson, geojson_file)
+        with open(f"{self.cache_dir}/metadata.json", 'w') as metadata_file:
+            json.dump(dict(source=None, tolerances=src.geog_data.SIMPLIFY_TOLERANCES), metadata_file)
+
+        missing_path = f"{self.temporary_dir.name}/missing.geojson"
+        self.assertTrue(src.geog_data.geometry_available(missing_path, self.cache_dir))
+        self.assertEqual(src.geog_data.lad_geojson('medium', missing_path, self.cache_dir), geojson)
+        self.assertFalse(src.geog_data.geometry_cache_is_current(missing_path, self.cache_dir,
+                                                                 tolerances=dict(low=0.1)))
+
+        url = src.geog_data.static_geojson('low', f"{self.temporary_dir.name}/static", missing_path, self.cache_dir)
+        self.assertTrue(url.startswith('app/static/lad_low.geojson?v='))
+        with open(f"{self.temporary_dir.name}/static/lad_low.geojson") as geojson_file:
+            self.assertEqual(json.load(geojson_file), geojson)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,50 +1,130 @@
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 import unittest.mock
+
+import pandas as pd
+import pyspark.sql
+import pyspark.sql.types as T
+
 import src.pyspark_tools
+import src.storage_tools
 
 
 class Test(unittest.TestCase):
     def test_python_location(self):
 
-        path = src.pyspark_tools.python_location()
+        with unittest.mock.patch.dict(os.environ, clear=True):
+            path = src.pyspark_tools.python_location()
 
-        self.assertIsInstance(path,str)
+        self.assertEqual(path, sys.executable)
 
     def test_initialise_spark(self):
+        # in a fresh interpreter, as otherwise it would adopt whichever session another test started first
+        check = ("import src.pyspark_tools as pyspark_tools; "
+                 "spark = pyspark_tools.initialise_spark(); "
+                 "assert spark.sql('SELECT 1').collect()[0][0] == 1; "
+                 "assert pyspark_tools.initialise_spark() is spark; "
+                 "assert spark.conf.get('spark.sql.shuffle.partitions') == str(pyspark_tools.SPARK_SHUFFLE_PARTITIONS)")
+
+        subprocess.run([sys.executable, '-c', check], check=True)
+
+    def test_import_does_not_start_spark(self):
+        # in a fresh interpreter, as this one may already have a session
+        check = ("import src.pyspark_tools, src.feature_tools, pyspark; "
+                 "src.pyspark_tools.DataStore(); "
+                 "assert pyspark.SparkContext._gateway is None and pyspark.SparkContext._active_spark_context is None")
+
+        subprocess.run([sys.executable, '-c', check], check=True)
 
-        spark = src.pyspark_tools.initialise_spark()
+    def test_spark_schema(self):
+        schema = src.pyspark_tools.spark_schema(['areatype', 'date', 'name', 'code', 'newAdmissions', 'maleCases',
+                                                 'newCasesBySpecimenDateRollingRate', 'value'])
 
-        self.assertTrue(spark.sql("SELECT 1"))
+        self.assertEqual([field.dataType for field in schema.fields],
+                         [T.StringType(), T.DateType(), T.StringType(), T.StringType(), T.DoubleType(),
+                          T.StringType(), T.DoubleType(), T.DoubleType()])
 
 
 class TestDataStore(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.spark = pyspark.sql.SparkSession.builder.master('local[1]').appName('test_pyspark_tools') \
+            .config('spark.sql.shuffle.partitions', 2).getOrCreate()
+
     def setUp(self) -> None:
-        self.datastore = src.pyspark_tools.DataStore()
-        self.test_filepath = './test_me.csv'
+        self.directory = tempfile.mkdtemp()
+        dates = pd.date_range('2020-03-25', '2020-05-05')
+        self.df_feed = pd.DataFrame([dict(areatype=areatype, date=date, name=f"{areatype} {code}", code=code,
+                                          newAdmissions=float(i))
+                                     for areatype, code in [('region', 'E12000001'), ('nation', 'E92000001')]
+                                     for i, date in enumerate(dates)])
+        self.test_sdf = self.spark.createDataFrame(self.df_feed).withColumn('date', pyspark.sql.functions.to_date('date'))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
 
-        with open(self.test_filepath, "wb") as f:
-            f.write(b"test\n1")
+    def test_csv_round_trip(self):
+        datastore = src.pyspark_tools.DataStore(data_format='csv', spark_session=self.spark)
+        test_filepath = f"{self.directory}/test_me.csv"
+        self.df_feed.assign(date=self.df_feed['date'].dt.strftime('%Y-%m-%d')).to_csv(test_filepath, index=False)
 
-        self.test_sdf = self.datastore.get_table(self.test_filepath)
+        sdf = datastore.get_table(test_filepath)
+        self.assertEqual(sdf.count(), len(self.df_feed))
+        self.assertEqual(dict(sdf.dtypes), dict(date='date', areatype='string', name='string', code='string',
+                                                newAdmissions='double'))
 
-    def tearDown(self) -> None:
-        os.remove(self.test_filepath)
+        datastore.save_table(sdf, f"{self.directory}/test2.csv")
+        self.assertEqual(datastore.get_table(f"{self.directory}/test2.csv").count(), len(self.df_feed))
+
+    def test_parquet_is_partitioned_by_areatype_and_month(self):
+        datastore = src.pyspark_tools.DataStore(data_format='parquet', spark_session=self.spark)
+        path = f"{self.directory}/test_nhse"
+
+        datastore.save_table(self.test_sdf, path)
+
+        self.assertEqual(sorted(name for name in os.listdir(path) if name.startswith('areatype=')),
+                         ['areatype=nation', 'areatype=region'])
+        self.assertEqual(sorted(os.listdir(f"{path}/areatype=region")),
+                         ['month=2020-03', 'month=2020-04', 'month=2020-05'])
+        self.assertEqual(datastore.get_table(path).count(), len(self.df_feed))
+
+    def test_filters_prune_partitions(self):
+        datastore = src.pyspark_tools.DataStore(data_format='parquet', spark_session=self.spark)
+        path = f"{self.directory}/test_nhse"
+        datastore.save_table(self.test_sdf, path)
+
+        sdf = datastore.get_table(path, columns=['date', 'code', 'newAdmissions'], areatypes=['region'],
+                                  date_from='2020-04-01', date_to='2020-04-30')
+
+        # the files were listed when the table was loaded, so reading any but the one partition would now fail
+        for input_file in sdf.inputFiles():
+            if 'areatype=region/month=2020-04' not in input_file:
+                os.remove(input_file[len('file:'):] if input_file.startswith('file:') else input_file)
+
+        self.assertEqual(sdf.columns, ['date', 'code', 'newAdmissions'])
+        self.assertEqual(sdf.count(), 30)
+
+    def test_reads_storage_tools_datasets(self):
+        datastore = src.pyspark_tools.DataStore(data_format='parquet', spark_session=self.spark)
+        src.storage_tools.write_feed(self.df_feed.set_index(['areatype', 'date', 'name']), 'test_nhse',
+                                     root=self.directory)
 
-    def test_get_table(self):
+        sdf = datastore.get_table(src.storage_tools.dataset_path('test_nhse', self.directory), areatypes=['nation'])
 
-        self.assertEqual(self.test_sdf.count(), 1)
+        self.assertEqual(sdf.count(), len(self.df_feed) / 2)
 
-    def test_save_table(self):
-        # setup
-        test_save_table_file = 'test2.csv'
-        self.datastore.save_table(self.test_sdf, test_save_table_file)
+    def test_unsupported_format(self):
+        datastore = src.pyspark_tools.DataStore(data_format='delta', spark_session=self.spark)
 
-        # test
-        self.assertTrue(os.path.isfile(test_save_table_file))
+        with self.assertRaises(ValueError):
+            datastore.get_table(f"{self.directory}/test_nhse")
+        with self.assertRaises(ValueError):
+            datastore.save_table(self.test_sdf, f"{self.directory}/test_nhse")
 
-        # teardown
-        os.remove(test_save_table_file)
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
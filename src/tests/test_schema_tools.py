@@ -0,0 +1,54 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import src.schema_tools
+
+
+class TestApplySchema(unittest.TestCase):
+    def setUp(self) -> None:
+        self.df_feed = pd.DataFrame(dict(areatype='region', date=['2021-01-01', '2021-01-02', '2021-01-03'],
+                                         name=['North East', 'North East', 'Wales'],
+                                         code=['E12000001', 'E12000001', 'W92000004'],
+                                         newAdmissions=[1.0, np.nan, 3.0],
+                                         cumCasesBySpecimenDateRate=[0.5, 1.5, 2.5],
+                                         hospitalCases=[1.5, 2.0, 3.0],
+                                         notAnApiField=[1.0, 2.0, 3.0]))
+
+    def test_dtypes(self):
+        dtypes = src.schema_tools.apply_schema(self.df_feed).dtypes
+
+        self.assertEqual(dtypes['date'], 'datetime64[ns]')
+        self.assertTrue(all(isinstance(dtypes[column], pd.CategoricalDtype) for column in ['areatype', 'name', 'code']))
+        self.assertEqual(dtypes['newAdmissions'], 'Int32')
+        self.assertEqual(dtypes['cumCasesBySpecimenDateRate'], 'float32')
+        # counts which aren't whole numbers fall back to float32, anything else is left alone
+        self.assertEqual(dtypes['hospitalCases'], 'float32')
+        self.assertEqual(dtypes['notAnApiField'], 'float64')
+
+    def test_values_kept(self):
+        df_applied = src.schema_tools.apply_schema(self.df_feed)
+
+        pd.testing.assert_frame_equal(df_applied.assign(date=df_applied['date'].dt.strftime('%Y-%m-%d')),
+                                      self.df_feed, check_dtype=False, check_categorical=False)
+
+    def test_english_only_matches_regex(self):
+        df_applied = src.schema_tools.apply_schema(self.df_feed)
+        df_expected = self.df_feed[~self.df_feed['code'].str.contains('[WSN]')]
+
+        self.assertEqual(src.schema_tools.english_only(df_applied).index.tolist(), df_expected.index.tolist())
+        self.assertEqual(src.schema_tools.english_only(self.df_feed).index.tolist(), df_expected.index.tolist())
+
+    def test_concat_keeps_categories(self):
+        frames = [src.schema_tools.apply_schema(self.df_feed.iloc[:2]),
+                  src.schema_tools.apply_schema(self.df_feed.iloc[2:])]
+
+        df_concat = src.schema_tools.concat_feeds(frames)
+
+        self.assertIsInstance(df_concat['code'].dtype, pd.CategoricalDtype)
+        self.assertEqual(df_concat['code'].tolist(), self.df_feed['code'].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+import src.storage_tools
+
+
+class TestFeedStorage(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.mkdtemp()
+        dates = pd.date_range('2020-03-25', '2020-05-05')
+        self.df_feed = pd.DataFrame([dict(areatype=areatype, date=date, name=f"{areatype} {code}", code=code,
+                                          newAdmissions=float(i), maleCases="[{'age': '0_to_4', 'value': 0}]")
+                                     for areatype, code in [('region', 'E12000001'), ('nation', 'E92000001')]
+                                     for i, date in enumerate(dates)]).set_index(['areatype', 'date', 'name'])
+        src.storage_tools.write_feed(self.df_feed, 'test_nhse', root=self.root)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.root)
+
+    def test_partitioned_by_areatype_and_month(self):
+        path = src.storage_tools.dataset_path('test_nhse', self.root)
+
+        self.assertEqual(sorted(os.listdir(path)), ['areatype=nation', 'areatype=region'])
+        self.assertEqual(sorted(os.listdir(f"{path}/areatype=region")),
+                         ['month=2020-03', 'month=2020-04', 'month=2020-05'])
+
+    def test_round_trip(self):
+        df_read = src.storage_tools.read_feed('test_nhse', root=self.root)
+        df_expected = self.df_feed.reset_index().sort_values(['code', 'date']).reset_index(drop=True)
+
+        pd.testing.assert_frame_equal(df_read[df_expected.columns], df_expected, check_dtype=False)
+
+    def test_column_projection_and_filters(self):
+        df_read = src.storage_tools.read_feed('test_nhse', root=self.root, columns=['date', 'code', 'newAdmissions'],
+                                              areatypes=['region'], date_from='2020-04-01', date_to='2020-04-30')
+
+        self.assertEqual(df_read.columns.tolist(), ['date', 'code', 'newAdmissions'])
+        self.assertEqual(len(df_read), 30)
+        self.assertEqual(df_read['code'].unique().tolist(), ['E12000001'])
+        self.assertEqual(df_read['date'].min(), pd.Timestamp('2020-04-01'))
+
+    def test_batches_match_single_write(self):
+        df_expected = self.df_feed.reset_index()
+        batches = [df_expected.iloc[start:start + 10] for start in range(0, len(df_expected), 10)]
+        src.storage_tools.write_feed_batches(batches, 'test_nhse_batches', columns=df_expected.columns, root=self.root)
+
+        df_read = src.storage_tools.read_feed('test_nhse_batches', root=self.root)
+        pd.testing.assert_frame_equal(df_read, src.storage_tools.read_feed('test_nhse', root=self.root))
+
+    def test_rewrite_replaces_old_data(self):
+        src.storage_tools.write_feed(self.df_feed.head(3), 'test_nhse', root=self.root)
+
+        self.assertEqual(len(src.storage_tools.read_feed('test_nhse', root=self.root)), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import src.validation_tools
+
+
+class TestValidateFeed(unittest.TestCase):
+    def setUp(self) -> None:
+        dates = pd.date_range('2021-01-01', periods=10)
+        self.df_feed = pd.DataFrame([dict(areatype='ltla', date=date, name=f"ltla {code}", code=code,
+                                          newCasesByPublishDate=float(day), cumCasesByPublishDate=float(10 * day),
+                                          cumCasesBySpecimenDateRate=1.5)
+                                     for code in ['E06000001', 'E06000002']
+                                     for day, date in enumerate(dates)])
+
+    def violations(self, df_feed):
+        df_violations, _ = src.validation_tools.validate_feed(df_feed.set_index(['areatype', 'date', 'name']),
+                                                              'ltla_nhse')
+        return df_violations.astype(dict(rule=str, field=str, code=str))
+
+    def test_clean_feed(self):
+        df_violations, df_summary = src.validation_tools.validate_feed(self.df_feed, 'ltla_nhse')
+        self.assertEqual(len(df_violations), 0)
+        self.assertEqual(df_violations.columns.tolist(), src.validation_tools.VIOLATION_COLUMNS)
+        self.assertEqual(df_summary['violations'].sum(), 0)
+        self.assertIn(('non_decreasing', 'cumCasesByPublishDate'),
+                      list(zip(df_summary['rule'], df_summary['field'])))
+        self.assertNotIn('non_decreasing', df_summary.loc[df_summary['field'] == 'cumCasesBySpecimenDateRate', 'rule']
+                         .tolist())
+
+    def test_negative_and_falling_values(self):
+        df_feed = self.df_feed.copy()
+        df_feed.loc[3, 'newCasesByPublishDate'] = -2
+        df_feed.loc[5, 'cumCasesByPublishDate'] = np.nan  # the fall is still seen across the missing day
+        df_feed.loc[6, 'cumCasesByPublishDate'] = 35
+
+        df_violations = self.violations(df_feed)
+        self.assertEqual(df_violations[['rule', 'field', 'code', 'value']].values.tolist(), [
+            ['non_negative', 'newCasesByPublishDate', 'E06000001', -2.0],
+            ['non_decreasing', 'cumCasesByPublishDate', 'E06000001', -5.0]])
+        self.assertEqual(df_violations['date'].tolist(), [pd.Timestamp('2021-01-04'), pd.Timestamp('2021-01-07')])
+
+    def test_duplicates_and_gaps(self):
+        # the next area's first day mustn't count as a gap or duplicate of the last area's last day
+        df_feed = pd.concat([self.df_feed.drop(index=[12, 13, 14]), self.df_feed.iloc[[2]]])
+
+        df_violations = self.violations(df_feed)
+        self.assertEqual(df_violations[['rule', 'code']].values.tolist(), [['duplicate_key', 'E06000001'],
+                                                                          ['date_gap', 'E06000002']])
+        np.testing.assert_array_equal(df_violations['value'], [np.nan, 3.0])
+        self.assertEqual(df_violations['date'].tolist(), [pd.Timestamp('2021-01-03'), pd.Timestamp('2021-01-06')])
+
+    def test_summary(self):
+        df_feed = self.df_feed.copy()
+        df_feed.loc[[1, 11, 12], 'newCasesByPublishDate'] = -1
+        _, df_summary = src.validation_tools.validate_feed(df_feed, 'ltla_nhse')
+
+        negative = df_summary.set_index(['rule', 'field']).loc[('non_negative', 'newCasesByPublishDate')]
+        self.assertEqual((negative['rows'], negative['violations'], negative['areas']), (20, 3, 2))
+        self.assertEqual((negative['first_date'], negative['last_date']),
+                         (pd.Timestamp('2021-01-02'), pd.Timestamp('2021-01-03')))
+        self.assertIn('non_negative[newCasesByPublishDate]: 3', src.validation_tools.summary_report(df_summary))
+
+
+if __name__ == '__main__':
+    unittest.main()
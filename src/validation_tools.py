@@ -0,0 +1,127 @@
+"""Data-quality checks for the NHSE feeds, run over each cleaned feed as download_and_save_data saves it, so bad
+records are found at ingest rather than later in a notebook. The checks only flag records, they don't change the feed.
+
+FIELD_RULES says which rules each API field is checked against (see field_rules):
+    not_null - the field is missing
+    non_negative - the value is below zero (counts and rates can't be)
+    non_decreasing - a cumulative series falls from one reported value to the next, for an area
+and FEED_RULES are checked once per feed:
+    duplicate_key - more than one record for an area (code) on a date
+    date_gap - dates missing between an area's first and last records
+
+validate_feed gives the violations as a compact long table (VIOLATION_COLUMNS) plus a summary of every check run.
+All the checks are vectorised over the whole feed, sorted once by (code, date), rather than looping over areas.
+"""
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src import schema_tools
+
+VIOLATION_COLUMNS = ['dataset', 'rule', 'field', 'code', 'date', 'value']
+SUMMARY_COLUMNS = ['dataset', 'rule', 'field', 'rows', 'violations', 'areas', 'first_date', 'last_date']
+FEED_RULES = ['duplicate_key', 'date_gap']
+
+
+def field_rules(field: str) -> List[str]:
+    """The rules one API field is checked against"""
+    if field in ('date', 'code'):
+        return ['not_null']
+    if field in schema_tools.AREA_COLUMNS or field in schema_tools.AGE_FIELDS:
+        return []
+    if field.startswith('cum') and not field.endswith('Rate'):
+        return ['non_negative', 'non_decreasing']
+    return ['non_negative']
+
+
+FIELD_RULES = {field: field_rules(field) for field in schema_tools.API_STRUCTURE}
+
+
+def key_column(df_feed: pd.DataFrame, column: str):
+    """A key column of the feed, whether it is a column or (as in a cleaned feed) an index level - read straight
+    from the index as resetting it would copy the whole feed"""
+    return df_feed[column] if column in df_feed.columns else df_feed.index.get_level_values(column)
+
+
+def validate_feed(df_feed: pd.DataFrame, dataset_name='', rules: Dict[str, List[str]] = None,
+                  feed_rules: List[str] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Checks a (cleaned) feed against the FIELD_RULES of the fields it has and the FEED_RULES. Returns
+        violations - a row per record which breaks a rule (VIOLATION_COLUMNS), where value is the field's value,
+                     except for non_decreasing (how far it fell) and date_gap (how many days are missing before date)
+        summary - a row per check run (SUMMARY_COLUMNS), including those which found nothing"""
+    rules = FIELD_RULES if rules is None else rules
+    feed_rules = FEED_RULES if feed_rules is None else feed_rules
+
+    # the areas as integer ids (missing codes are -1), so nothing below touches the code strings
+    area_ids, area_codes = pd.factorize(key_column(df_feed, 'code'))
+    area_codes = pd.Index(area_codes).astype(str)
+    dates = pd.to_datetime(key_column(df_feed, 'date')).to_numpy(dtype='datetime64[ns]')
+    order = np.lexsort((dates, area_ids))
+    dates, area_ids = dates[order], area_ids[order]
+    same_area = np.append(False, (area_ids[1:] == area_ids[:-1]) & (area_ids[1:] >= 0))
+
+    checks = []  # (rule, field, positions in the sorted feed, values)
+    if 'duplicate_key' in feed_rules:
+        duplicated = same_area & np.append(False, dates[1:] == dates[:-1])
+        checks.append(('duplicate_key', 'date', np.flatnonzero(duplicated), None))
+    if 'date_gap' in feed_rules:
+        missing_days = np.append(0, np.diff(dates).astype('timedelta64[D]').astype(np.int64) - 1)
+        gaps = np.flatnonzero(same_area & (missing_days > 0) & ~np.isnat(dates) & ~np.roll(np.isnat(dates), 1))
+        checks.append(('date_gap', 'date', gaps, missing_days[gaps]))
+
+    for field, field_rule_names in rules.items():
+        if not field_rule_names or (field not in df_feed.columns and field not in df_feed.index.names):
+            continue
+        if field in ('date', 'code'):
+            missing = (np.isnat(dates) if field == 'date' else
+                       (area_ids < 0) | np.append(area_codes == 'null', False)[area_ids])
+            if 'not_null' in field_rule_names:
+                checks.append(('not_null', field, np.flatnonzero(missing), None))
+            continue
+        values = pd.to_numeric(key_column(df_feed, field), errors='coerce').astype(float).to_numpy()[order]
+        if 'not_null' in field_rule_names:
+            checks.append(('not_null', field, np.flatnonzero(np.isnan(values)), None))
+        if 'non_negative' in field_rule_names:
+            negative = np.flatnonzero(values < 0)
+            checks.append(('non_negative', field, negative, values[negative]))
+        if 'non_decreasing' in field_rule_names:
+            # each reported value against the area's previous reported one, so missing days are stepped over
+            known = np.flatnonzero(~np.isnan(values))
+            changes = np.diff(values[known])
+            fell = np.flatnonzero((area_ids[known][1:] == area_ids[known][:-1]) & (changes < 0))
+            checks.append(('non_decreasing', field, known[fell + 1], changes[fell]))
+
+    checks = [(rule, field, check_positions, np.full(len(check_positions), np.nan) if values is None else values)
+              for rule, field, check_positions, values in checks]
+    check_sizes = [len(check_positions) for _, _, check_positions, _ in checks]
+    positions = np.concatenate([check_positions for _, _, check_positions, _ in checks] + [np.array([], dtype=int)])
+    df_violations = pd.DataFrame(dict(
+        dataset=pd.Categorical.from_codes(np.zeros(len(positions), dtype=int), [dataset_name]),
+        rule=pd.Categorical(np.repeat([rule for rule, _, _, _ in checks], check_sizes)),
+        field=pd.Categorical(np.repeat([field for _, field, _, _ in checks], check_sizes)),
+        code=pd.Categorical.from_codes(area_ids[positions], area_codes),
+        date=dates[positions],
+        value=np.concatenate([values for _, _, _, values in checks] + [np.array([])]).astype(float)))
+
+    summary_rows = []
+    for rule, field, check_positions, _ in checks:
+        check_dates = dates[check_positions]
+        summary_rows.append(dict(dataset=dataset_name, rule=rule, field=field, rows=len(df_feed),
+                                 violations=len(check_positions), areas=len(np.unique(area_ids[check_positions])),
+                                 first_date=check_dates.min() if len(check_positions) else pd.NaT,
+                                 last_date=check_dates.max() if len(check_positions) else pd.NaT))
+    df_summary = pd.DataFrame(summary_rows, columns=SUMMARY_COLUMNS)
+    return df_violations, df_summary
+
+
+def summary_report(df_summary: pd.DataFrame) -> str:
+    """A line per dataset of the checks which found anything, for printing"""
+    df_found = df_summary[df_summary['violations'] > 0]
+    lines = []
+    for dataset_name, df_dataset in df_summary.groupby('dataset', sort=False):
+        df_dataset_found = df_found[df_found['dataset'] == dataset_name]
+        found = ', '.join(f"{row.rule}[{row.field}]: {row.violations}" for row in df_dataset_found.itertuples())
+        lines.append(f"{dataset_name}: {len(df_dataset)} checks, {df_dataset_found['violations'].sum()} violations"
+                     + (f" ({found})" if found else ''))
+    return '\n'.join(lines)
@@ -4,32 +4,18 @@ import pandas as pd
 #import covid_data
 import streamlit as st
 import plotly.express as px
+import plotly.graph_objects as go
 import numpy as np
-#import geopandas as gpd
+from dashboard_data import load_dashboard_data
+from src import geog_data
 
 #data_pack = covid_data.get_data()
 st.set_page_config(layout='wide')
 st.write('# COVID-19 Dashboard')
 
-def get_nhse_feed_local_data():
-    """Gets the local csv files for the NHSE feed and combines them into one pandas dataframe"""
-    df = pd.concat([
-                pd.read_csv("data/uk_nhse_feed.csv"),#.tail(100),
-                pd.read_csv("data/england_nhse_feed.csv"),#.tail(100),
-                pd.read_csv("data/region_nhse_feed.csv"),
-                pd.read_csv("data/nhsregion_nhse_feed.csv"),
-                pd.read_csv("data/utla_nhse_feed.csv"),#.tail(100),
-                pd.read_csv("data/ltla_nhse_feed.csv"),#.tail(100),
-                    ],
-               axis=0)
-    return df
-
-def filter_english_only(df):
-    return df[~df['code'].str.contains('[WSN]')]
-
-
-df = get_nhse_feed_local_data()
-df = filter_english_only(df)
+# the feeds are loaded and indexed once per server process, rather than on every widget interaction
+cache_resource = getattr(st, 'cache_resource', None) or st.cache(allow_output_mutation=True)
+dashboard_data = cache_resource(load_dashboard_data)()
 
 
 col1, col2, col3 = st.columns(3)
@@ -44,10 +30,10 @@ col1, col2, col3 = st.columns(3)
 #
 # st.write(fig)
 
-areatype_options = df['areatype'].unique()
+areatype_options = dashboard_data.areatype_options
 areatype_selection = col1.selectbox('areatype', areatype_options, index=0, key=None, help=None, on_change=None, args=None, kwargs=None)
 
-areaname_options = df[df['areatype'].isin([areatype_selection])]['name'].unique().tolist()
+areaname_options = dashboard_data.areaname_options[areatype_selection]
 if len(areaname_options) < 10:
     default_areaname_options = areaname_options
 else:
@@ -57,10 +43,7 @@ areaname_multiselection = col2.multiselect('areaname', areaname_options,default_
 if len(areaname_multiselection) < 1:
     areaname_multiselection = default_areaname_options
 
-metric_options = (df[df['areatype'].isin([areatype_selection]) & df['name'].isin(areaname_multiselection)]
-                  .dropna(axis=1, how='all')
-                  .drop(['areatype','date','name','code'],axis=1).columns.tolist()
-)
+metric_options = dashboard_data.metric_options(areatype_selection, areaname_multiselection)
 metric_selection_default = metric_options,metric_options[0]
 metric_selection = col3.multiselect('metric', metric_options,metric_options[0])
 if len(metric_selection) < 1:
@@ -68,16 +51,10 @@ if len(metric_selection) < 1:
 
 
 # region cases graph
-df_regions = (df[df['areatype'].isin([areatype_selection])
-                 & df['name'].isin(areaname_multiselection)
-                 ]
-              .set_index(['date','areatype','name'])
-              .rename_axis(columns='metric')[metric_selection]
-              .stack().rename('value').reset_index()
-              )
+df_regions = dashboard_data.select(areatype_selection, areaname_multiselection, metric_selection)
 
 date_options = np.sort(df_regions['date'].unique())
-date_from_index_lambda = lambda x: date_options[x]
+date_from_index_lambda = lambda x: pd.Timestamp(date_options[x]).strftime('%Y-%m-%d')
 
 date_range = st.select_slider('date_range', options=list(range(0,len(date_options))), value=(0, len(date_options)-1),format_func=date_from_index_lambda)
 
@@ -99,6 +76,34 @@ fig_region_cases.update_layout(legend=dict(
 ))
 
 st.plotly_chart(fig_region_cases,use_container_width=True)
+
+# ltla map. The simplified shapes come from the geometry cache (see geog_data.build_geometry_cache) and are served
+# as a static file, which the browser fetches itself - so the figure sent on each rerun is just the shapes' url, the
+# area codes and the values for the chosen metric and date
+if 'ltla' in dashboard_data.frames and geog_data.geometry_available():
+    st.write("### ltla map")
+    map_col1, map_col2, map_col3 = st.columns(3)
+    map_metric = map_col1.selectbox('map metric', dashboard_data.metric_options('ltla', dashboard_data.areaname_options['ltla']))
+    map_detail = map_col2.radio('map detail', list(geog_data.SIMPLIFY_TOLERANCES), index=0)
+    map_dates = dashboard_data.frames['ltla'].index.get_level_values('date').unique().sort_values()
+    map_date = map_col3.select_slider('map date', options=list(map_dates),
+                                      value=dashboard_data.latest_date('ltla', map_metric),
+                                      format_func=lambda date: pd.Timestamp(date).strftime('%Y-%m-%d'))
+
+    lad_geojson = cache_resource(geog_data.lad_geojson)(map_detail)
+    lad_geojson_url = cache_resource(geog_data.static_geojson)(map_detail)
+    lad_codes = [feature['id'] for feature in lad_geojson['features']]
+    map_values = geog_data.choropleth_values(lad_geojson, dashboard_data.values_on('ltla', map_metric, map_date))
+
+    fig_ltla_map = go.Figure(go.Choropleth(geojson=lad_geojson_url,
+                                           featureidkey='id',
+                                           locations=lad_codes,
+                                           z=map_values,
+                                           colorbar=dict(title=map_metric)))
+    fig_ltla_map.update_geos(fitbounds="locations", visible=False, projection_type="mercator")
+    fig_ltla_map.update_layout(margin=dict(l=0, r=0, t=0, b=0))
+    st.plotly_chart(fig_ltla_map, use_container_width=True)
+
 # #
 # # # scale data by UK-wide number of tests
 # # df_regions_scaled = (df_regions[['date', 'name','code', 'newCasesByPublishDate']]
@@ -107,20 +112,6 @@ st.plotly_chart(fig_region_cases,use_container_width=True)
 # # fig_region_cases = px.line(df_regions_scaled, x='date', y='newCases_perUKPillarTwoTest', color='name', title='newCasesByPublishDate per Region per UK Pillar 2 test count')
 # # st.write(fig_region_cases)
 # #
-# # st.write("### simple map")
-# #
-# # df_local_auth_shapes = gpd.read_file('./shapefiles/Local_Authority_Districts_(December_2020)_UK_BGC.geojson').set_index('LAD20CD')
-# #
-# # # ToDo: bring in ltla figures to plot on the map.
-# #
-# # fig_regions_scaled_cases_map = px.choropleth(df_local_auth_shapes,
-# #               geojson=df_local_auth_shapes.geometry,
-# #               locations=df_local_auth_shapes.index,
-# #               color=np.random.randn(len(df_local_auth_shapes)),
-# #               projection="mercator")
-# # fig_regions_scaled_cases_map.update_geos(fitbounds="locations", visible=False)
-# #
-# # st.write(fig_regions_scaled_cases_map)
 # print()
 #
 #